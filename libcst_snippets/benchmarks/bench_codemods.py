@@ -0,0 +1,105 @@
+"""
+Benchmark each codemod, and all of them combined, over synthetic model and view modules,
+reporting parse, transform and codegen time and peak memory.
+
+    python -m benchmarks.bench_codemods --models 20 --columns 50 --views 500
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+from typing import Dict, Sequence
+
+import libcst as cst
+from libcst.codemod import CodemodContext
+
+from codemods.combined import AVAILABLE_CODEMODS, CombinedCodemodCommand
+
+from .synthetic import generate_models_module, generate_views_module
+
+
+def run_once(codemods: Sequence[str], source: str) -> Dict[str, float]:
+    command = CombinedCodemodCommand(CodemodContext(), codemods=codemods)
+
+    start = time.perf_counter()
+    tree = cst.parse_module(source)
+    parsed = time.perf_counter()
+    tree = command.transform_module(tree)
+    transformed = time.perf_counter()
+    tree.code
+    generated = time.perf_counter()
+
+    return {
+        "parse": parsed - start,
+        "transform": transformed - parsed,
+        "codegen": generated - transformed,
+    }
+
+
+def peak_memory(codemods: Sequence[str], source: str) -> int:
+    # Measured in a separate run, as tracing allocations slows everything down
+    tracemalloc.start()
+    try:
+        run_once(codemods, source)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(
+    codemods: Sequence[str], source: str, repeat: int, memory: bool = True
+) -> Dict[str, float]:
+    runs = [run_once(codemods, source) for _ in range(repeat)]
+    # Keep the fastest run of each step, the least disturbed by anything else
+    result = {step: min(run[step] for run in runs) for step in runs[0]}
+    if memory:
+        result["peak_memory_mb"] = peak_memory(codemods, source) / (1024 * 1024)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--models", type=int, default=20)
+    parser.add_argument("--columns", type=int, default=50)
+    parser.add_argument("--views", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Skip measuring peak memory, which needs a much slower traced run.",
+    )
+    parser.add_argument("--json", action="store_true", help="Output JSON.")
+    args = parser.parse_args()
+
+    sources = {
+        "models": generate_models_module(args.models, args.columns),
+        "views": generate_views_module(args.views),
+    }
+    cases = [([name], name) for name in AVAILABLE_CODEMODS]
+    cases.append((list(AVAILABLE_CODEMODS), "combined"))
+
+    results = {}
+    for source_name, source in sources.items():
+        for codemods, label in cases:
+            results[f"{source_name}/{label}"] = benchmark(
+                codemods, source, args.repeat, memory=not args.no_memory
+            )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    width = max(len(name) for name in results)
+    print(
+        f"{'':<{width}}  {'parse':>8}  {'transform':>9}  {'codegen':>8}  {'peak MB':>8}"
+    )
+    for name, result in results.items():
+        memory = result.get("peak_memory_mb")
+        print(
+            f"{name:<{width}}  {result['parse']:8.3f}  {result['transform']:9.3f}  "
+            f"{result['codegen']:8.3f}  {'-' if memory is None else f'{memory:.1f}':>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
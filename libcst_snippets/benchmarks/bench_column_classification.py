@@ -0,0 +1,75 @@
+"""
+Compare the per-column cost of classifying Column(...) calls with repeated matchers (as
+ColumnToMappedCommand used to) against the single argument scan in classify_column_call.
+
+    python -m benchmarks.bench_column_classification --columns 500
+"""
+
+import argparse
+import timeit
+
+import libcst as cst
+import libcst.matchers as m
+
+from codemods.sa_column_to_mapped import (
+    call_has_no_kwarg_nullable,
+    call_has_nullable_false,
+    call_has_nullable_true,
+    call_has_primary_key_true,
+    classify_column_call,
+    column_call_with_name_and_type,
+    column_call_with_type,
+    resolve_column_py_type_and_is_optional,
+)
+
+from .synthetic import generate_models_module
+
+
+def column_calls(source: str):
+    module = cst.parse_module(source)
+    return m.findall(module, m.Call(func=m.Name(value="Column")))
+
+
+def classify_with_matchers(col_call: cst.Call):
+    # visit_Assign, process_column_call and resolve_py_type_and_is_optional each matched
+    # the call again.
+    for _ in range(2):
+        if not m.matches(col_call, column_call_with_name_and_type):
+            m.matches(col_call, column_call_with_type)
+    if m.matches(col_call, call_has_no_kwarg_nullable) & m.matches(
+        col_call, call_has_primary_key_true
+    ):
+        return
+    if m.matches(col_call, call_has_no_kwarg_nullable):
+        return
+    if m.matches(col_call, call_has_nullable_true):
+        return
+    m.matches(col_call, call_has_nullable_false)
+
+
+def classify_with_scan(col_call: cst.Call):
+    column = classify_column_call(col_call)
+    resolve_column_py_type_and_is_optional(column)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--columns", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    calls = column_calls(generate_models_module(1, args.columns))
+    for label, classify in [
+        ("matchers", classify_with_matchers),
+        ("scan", classify_with_scan),
+    ]:
+        best = min(
+            timeit.repeat(
+                lambda: [classify(call) for call in calls], number=1, repeat=args.repeat
+            )
+        )
+        print(f"{label:<10} {1e6 * best / len(calls):8.1f} us/column")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare finding eligible views and their require statements with matchers (as
+RouteRedecorateCommand used to) against the single pre-scan in scan_view_function, and
+time the whole codemod, over a module with thousands of views.
+
+    python -m benchmarks.bench_route_redecorator --views 3000
+"""
+
+import argparse
+import time
+import timeit
+
+import libcst as cst
+import libcst.matchers as m
+from libcst.codemod import CodemodContext
+
+from codemods.route_redecorator import (
+    RouteRedecorateCommand,
+    eligible_view_function_matcher,
+    require_call_stmt_matcher,
+    scan_view_function,
+)
+
+from .synthetic import generate_views_module
+
+
+def find_with_matchers(functions):
+    # visit_FunctionDef matched the whole function, get_require_stmts then scanned the
+    # body again, and leave_SimpleStatementLine matched every statement a third time.
+    for func in functions:
+        if m.matches(func, eligible_view_function_matcher):
+            [s for s in func.body.body if m.matches(s, require_call_stmt_matcher)]
+            [s for s in func.body.body if m.matches(s, require_call_stmt_matcher)]
+
+
+def find_with_scan(functions):
+    for func in functions:
+        scan = scan_view_function(func)
+        if scan is not None and scan.eligible:
+            scan.require_stmts[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--views", type=int, default=3000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    source = generate_views_module(args.views)
+    tree = cst.parse_module(source)
+    functions = m.findall(tree, m.FunctionDef())
+    for label, find in [("matchers", find_with_matchers), ("scan", find_with_scan)]:
+        best = min(timeit.repeat(lambda: find(functions), number=1, repeat=args.repeat))
+        print(f"{label:<10} {1e6 * best / len(functions):8.1f} us/view")
+
+    start = time.perf_counter()
+    RouteRedecorateCommand(CodemodContext()).transform_module(tree)
+    print(f"codemod    {time.perf_counter() - start:8.3f} s for {len(functions)} views")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Generators for synthetic modules that exercise the codemods' hot paths.
+"""
+
+COLUMN_TEMPLATES = [
+    "    c{i} = Column(Integer, primary_key=True)\n",
+    "    c{i} = Column(String(50), nullable=False, index=True)\n",
+    '    c{i} = Column("col_{i}", DateTime, nullable=True, default=now)\n',
+    "    c{i} = Column(Boolean, default=False, server_default=text('false'))\n",
+    "    c{i} = Column(JSONB)\n",
+    "    c{i} = Column(Numeric(10, 2), nullable=False)\n",
+]
+
+MODEL_METHODS = """
+    @classmethod
+    def get_active(cls, session):
+        return session.query(cls).filter(cls.c0.is_(True)).all()
+
+    def describe(self):
+        return f"{self.__class__.__name__}({self.c0})"
+"""
+
+VIEW_TEMPLATE = """
+@bp.route("/items/{i}", methods=["GET", "POST"])
+def view_{i}(item_id):
+    item = get_item(item_id)
+    g.user.require(PERMISSION_{p})
+    if item is None:
+        abort(404)
+    for child in item.children:
+        log(child)
+    return render_template("item.html", item=item)
+"""
+
+
+def generate_models_module(n_models: int, n_columns: int) -> str:
+    """
+    A module of n_models SQLAlchemy models, each with n_columns Column(...) attributes and
+    a classmethod taking a session.
+    """
+    parts = [
+        "from sqlalchemy import Boolean, Column, DateTime, Integer, Numeric, String, text\n",
+        "from sqlalchemy.dialects.postgresql import JSONB\n",
+        "from .base import Base\n",
+    ]
+    for model in range(n_models):
+        parts.append(f"\n\nclass Model{model}(Base):\n")
+        parts.append(f'    __tablename__ = "model_{model}"\n')
+        parts.extend(
+            COLUMN_TEMPLATES[i % len(COLUMN_TEMPLATES)].format(i=i)
+            for i in range(n_columns)
+        )
+        parts.append(MODEL_METHODS)
+    return "".join(parts)
+
+
+def generate_views_module(n_views: int, n_permissions: int = 5) -> str:
+    """
+    A Flask blueprint module with n_views views, each making a single g.user.require(...) call.
+    """
+    parts = ["from flask import Blueprint, abort, g, render_template\n\n"]
+    parts.extend(f'PERMISSION_{p} = "permission_{p}"\n' for p in range(n_permissions))
+    parts.append('\nbp = Blueprint("items", __name__)\n')
+    parts.extend(VIEW_TEMPLATE.format(i=i, p=i % n_permissions) for i in range(n_views))
+    return "".join(parts)
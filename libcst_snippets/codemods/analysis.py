@@ -0,0 +1,282 @@
+from collections import Counter
+from typing import Any, Dict, List, Mapping, Optional, Type
+
+import libcst as cst
+from libcst.codemod import CodemodCommand
+from libcst.metadata import MetadataWrapper, PositionProvider
+
+from .profiling import matches
+from .route_redecorator import RouteRedecorateCommand, scan_view_function
+from .sa_annotate_session_codemod import AddSessionTypeAnnotationCommand
+from .sa_column_audit import ColumnAuditCommand, audit_model
+from .sa_eager_load import EagerLoadRelationshipsCommand
+from .sa_query_to_select import QueryToSelectCommand, parse_query_chain
+from .sa_column_to_mapped import (
+    ColumnToMappedCommand,
+    classify_column_call,
+    column_def_matcher,
+    resolve_column_py_type_and_is_optional,
+)
+
+
+class Analyzer(cst.CSTVisitor):
+    """
+    A read-only counterpart to a codemod: visits a module with the codemod's options and
+    counts what the codemod would do, without transforming the tree or generating code.
+    Analyzers can also record details of individual sites, for reports.
+    """
+
+    def __init__(self, command: CodemodCommand) -> None:
+        super().__init__()
+        self.command = command
+        self.stats: Counter = Counter()
+        self.records: List[Dict[str, Any]] = []
+        self.module: Optional[cst.Module] = None
+        self._positions: Optional[Mapping[cst.CSTNode, Any]] = None
+
+    def visit_Module(self, node: cst.Module) -> bool:
+        self.module = node
+        detector = getattr(self.command, "model_detector", None)
+        if detector is not None:
+            detector.visit_module(self.command.context, node)
+        return True
+
+    def line_of(self, node: cst.CSTNode) -> Optional[int]:
+        """
+        The line a node starts on. Positions are only computed, for the whole module, the
+        first time this is called.
+        """
+        if self._positions is None:
+            self._positions = MetadataWrapper(
+                self.module, unsafe_skip_copy=True
+            ).resolve(PositionProvider)
+        position = self._positions.get(node)
+        return position.start.line if position is not None else None
+
+    def record(self, node: cst.CSTNode, **fields: Any) -> None:
+        """
+        Record a site for the report, with the file and line of the node.
+        """
+        self.records.append(
+            {
+                "filename": self.command.context.filename,
+                "line": self.line_of(node),
+                **fields,
+            }
+        )
+
+    def is_model(self, node: cst.ClassDef) -> bool:
+        return self.command.model_detector.is_model(self.command.context, node)
+
+
+class ColumnToMappedAnalyzer(Analyzer):
+    command: ColumnToMappedCommand
+
+    def __init__(self, command: ColumnToMappedCommand) -> None:
+        super().__init__(command)
+        self.in_model = False
+
+    def visit_ClassDef(self, node: cst.ClassDef) -> bool:
+        if self.is_model(node):
+            self.in_model = True
+            self.stats["models"] += 1
+        return True
+
+    def leave_ClassDef(self, original_node: cst.ClassDef) -> None:
+        self.in_model = False
+
+    def visit_Assign(self, node: cst.Assign) -> bool:
+        if self.in_model and matches(node, column_def_matcher, "column_def_matcher"):
+            self.stats["columns"] += 1
+            column = classify_column_call(node.value)
+            if column is None:
+                # The codemod fails on these
+                self.stats["columns_not_understood"] += 1
+                return True
+            py_type, _ = resolve_column_py_type_and_is_optional(
+                column, self.command.sa_types
+            )
+            if py_type:
+                self.stats["columns_typed"] += 1
+            else:
+                self.stats["columns_untyped"] += 1
+        return True
+
+
+class AnnotateSessionAnalyzer(Analyzer):
+    command: AddSessionTypeAnnotationCommand
+
+    def visit_Module(self, node: cst.Module) -> bool:
+        self.command.param_finder.reset()
+        return super().visit_Module(node)
+
+    def visit_ClassDef(self, node: cst.ClassDef) -> bool:
+        self.command.param_finder.enter_class(self.is_model(node))
+        return True
+
+    def leave_ClassDef(self, original_node: cst.ClassDef) -> None:
+        self.command.param_finder.leave_class()
+
+    def visit_FunctionDef(self, node: cst.FunctionDef) -> bool:
+        self.command.param_finder.enter_function(node)
+        return True
+
+    def visit_Await(self, node: cst.Await) -> bool:
+        self.command.param_finder.visit_await(node)
+        return True
+
+    def leave_FunctionDef(self, original_node: cst.FunctionDef) -> None:
+        function = self.command.param_finder.leave_function()
+        for param in function.params:
+            if param.annotation:
+                self.stats["session_params_already_annotated"] += 1
+            else:
+                self.stats["session_params_to_annotate"] += 1
+                if function.is_async and self.command.async_session:
+                    self.stats["session_params_to_annotate.async"] += 1
+
+
+class QueryToSelectAnalyzer(Analyzer):
+    command: QueryToSelectCommand
+
+    def visit_Module(self, node: cst.Module) -> bool:
+        self.module = node
+        self.command.enter_module(node)
+        return True
+
+    def visit_ClassDef(self, node: cst.ClassDef) -> bool:
+        self.command.enter_class(node)
+        return True
+
+    def leave_ClassDef(self, original_node: cst.ClassDef) -> None:
+        self.command.leave_class()
+
+    def visit_Call(self, node: cst.Call) -> bool:
+        chain = parse_query_chain(node, self.command.session_names)
+        if chain is not None:
+            self.stats["queries"] += 1
+            if self.command.is_model_target(chain.target):
+                self.stats[f"queries_to_rewrite.{chain.terminal}"] += 1
+            else:
+                self.stats["queries_rejected.not_a_model"] += 1
+        return True
+
+
+class EagerLoadAnalyzer(Analyzer):
+    command: EagerLoadRelationshipsCommand
+
+    def visit_Module(self, node: cst.Module) -> bool:
+        super().visit_Module(node)
+        for site in self.command.find_sites(node):
+            self.stats["n_plus_one_sites"] += 1
+            self.stats["lazy_loaded_relationships"] += len(site.relationships)
+            self.record(
+                site.query.root,
+                loop_line=self.line_of(site.loop),
+                model=node.code_for_node(site.query.target),
+                relationships=list(site.relationships),
+                style=site.query.style,
+            )
+        # The sites are found in one pass over the module
+        return False
+
+
+class ColumnAuditAnalyzer(Analyzer):
+    command: ColumnAuditCommand
+
+    def visit_ClassDef(self, node: cst.ClassDef) -> bool:
+        if not self.is_model(node):
+            return True
+        self.stats["models"] += 1
+        for definition, column in audit_model(node):
+            self.stats["columns"] += 1
+            self.stats["columns_indexed"] += column.indexed
+            self.stats["columns_unique"] += column.unique
+            self.stats["primary_keys"] += column.primary_key
+            self.stats["foreign_keys"] += len(column.foreign_keys)
+            fk_without_index = bool(column.foreign_keys) and not column.indexed
+            self.stats["foreign_keys_without_index"] += fk_without_index
+            self.record(
+                definition,
+                model=node.name.value,
+                column=column.attribute,
+                name=column.name or column.attribute,
+                type=column.type,
+                primary_key=column.primary_key,
+                index=column.index,
+                unique=column.unique,
+                nullable=column.nullable,
+                foreign_keys=column.foreign_keys,
+                indexed=column.indexed,
+                fk_without_index=fk_without_index,
+            )
+        return True
+
+
+class RouteRedecorateAnalyzer(Analyzer):
+    command: RouteRedecorateCommand
+
+    def __init__(self, command: RouteRedecorateCommand) -> None:
+        super().__init__(command)
+        self.inside_eligible_view_function: Optional[cst.FunctionDef] = None
+
+    def visit_FunctionDef(self, node: cst.FunctionDef) -> bool:
+        scan = scan_view_function(node, self.command.patterns)
+        if scan is None:
+            return True
+        self.stats["views"] += 1
+        if scan.has_permission_route:
+            self.stats["views_rejected.permission_already_set"] += 1
+        elif not scan.require_stmts:
+            self.stats["views_rejected.no_require_call"] += 1
+        elif len(scan.require_stmts) > 1:
+            # The codemod's "exactly one require call" rule
+            self.stats["views_rejected.multiple_require_calls"] += 1
+        elif self.inside_eligible_view_function is not None:
+            # The codemod fails on these
+            self.stats["views_rejected.nested_view"] += 1
+        elif not self.command.extract_call_from_require_stmt(
+            scan.require_stmts[0]
+        ).args:
+            # The codemod fails on these too
+            self.stats["views_rejected.require_call_without_permission"] += 1
+        else:
+            self.stats["views_eligible"] += 1
+            self.inside_eligible_view_function = node
+            if self.command.project_index is not None:
+                # Permissions that are neither literals nor constants in the project
+                resolved, _ = self.command.resolve_permission(
+                    self.command.get_permission(node, scan)
+                )
+                if not resolved:
+                    self.stats["views_eligible.permission_unresolved"] += 1
+        return True
+
+    def leave_FunctionDef(self, original_node: cst.FunctionDef) -> None:
+        if self.inside_eligible_view_function is original_node:
+            self.inside_eligible_view_function = None
+
+
+# Analyzers for the codemods in combined.AVAILABLE_CODEMODS, by the same names.
+AVAILABLE_ANALYZERS: Dict[str, Type[Analyzer]] = {
+    "column_to_mapped": ColumnToMappedAnalyzer,
+    "annotate_session": AnnotateSessionAnalyzer,
+    "query_to_select": QueryToSelectAnalyzer,
+    "eager_load": EagerLoadAnalyzer,
+    "column_audit": ColumnAuditAnalyzer,
+    "route_redecorate": RouteRedecorateAnalyzer,
+}
+
+
+def merge_analysis(
+    total: Dict[str, Counter], analysis: Mapping[str, Mapping[str, int]]
+) -> Dict[str, Counter]:
+    """
+    Add one file's stats to the running totals.
+    :param total: Stats per codemod, updated in place
+    :param analysis: Stats per codemod for one file
+    :return: The updated totals
+    """
+    for name, stats in analysis.items():
+        total.setdefault(name, Counter()).update(stats)
+    return total
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+from importlib.metadata import version
+from typing import Mapping, Optional, Tuple
+
+DEFAULT_CACHE_DIR = ".codemod_cache"
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# First byte of a cache entry
+NO_CHANGE = b"0"
+CHANGED = b"1"
+
+
+def codemods_source_hash() -> str:
+    """
+    Hash the source of this package, so that editing a codemod invalidates cached results.
+    """
+    digest = hashlib.sha256()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for filename in sorted(os.listdir(package_dir)):
+        if filename.endswith(".py"):
+            with open(os.path.join(package_dir, filename), "rb") as file:
+                digest.update(file.read())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    An on-disk cache of codemod results, keyed by the content hash of the source, the
+    codemods and their options and the LibCST version. Each entry records either that the
+    codemods made no change or the transformed source.
+
+    Reading an entry marks it as recently used, and prune() evicts the least recently
+    used entries once the cache is bigger than max_size bytes.
+    """
+
+    def __init__(
+        self, directory: str = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_MAX_SIZE
+    ) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.salt = "\0".join((version("libcst"), codemods_source_hash()))
+
+    def key(self, source: str, codemod_name: str, options: Mapping[str, object]) -> str:
+        """
+        Build the cache key for running a codemod with the given options over the source.
+        :param source: Python source code
+        :param codemod_name: Name identifying the codemod (or codemods) being run
+        :param options: Options the codemod was constructed with
+        :return: The key
+        """
+        digest = hashlib.sha256()
+        digest.update(self.salt.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(codemod_name.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(source.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> Tuple[bool, Optional[str]]:
+        """
+        Look up a result.
+        :param key: The cache key
+        :return: Whether the key was found, and the transformed source or None if the
+            codemods made no change
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return False, None
+        os.utime(path)
+        if data[:1] == CHANGED:
+            return True, data[1:].decode("utf-8")
+        return True, None
+
+    def put(self, key: str, code: Optional[str]) -> None:
+        """
+        Store a result.
+        :param key: The cache key
+        :param code: The transformed source, or None if the codemods made no change
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = NO_CHANGE if code is None else CHANGED + code.encode("utf-8")
+        # Write then rename, so parallel runs never read a partial entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def prune(self) -> int:
+        """
+        Evict the least recently used entries until the cache fits in max_size bytes.
+        :return: The number of entries evicted
+        """
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+            evicted += 1
+        return evicted
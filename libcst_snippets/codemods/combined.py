@@ -0,0 +1,177 @@
+import argparse
+import inspect
+import time
+from collections import Counter
+from typing import Any, Dict, List, Mapping, Sequence, Tuple, Type
+
+import libcst as cst
+from libcst.codemod import Codemod, CodemodCommand, CodemodContext
+
+from .analysis import AVAILABLE_ANALYZERS
+from .route_redecorator import RouteRedecorateCommand
+from .sa_annotate_session_codemod import AddSessionTypeAnnotationCommand
+from .sa_column_audit import ColumnAuditCommand
+from .sa_column_to_mapped import ColumnToMappedCommand
+from .sa_eager_load import EagerLoadRelationshipsCommand
+from .sa_query_to_select import QueryToSelectCommand
+
+
+# Codemods that can be combined, in the order they are applied to a module.
+AVAILABLE_CODEMODS: Dict[str, Type[CodemodCommand]] = {
+    "column_to_mapped": ColumnToMappedCommand,
+    "annotate_session": AddSessionTypeAnnotationCommand,
+    "query_to_select": QueryToSelectCommand,
+    "eager_load": EagerLoadRelationshipsCommand,
+    "column_audit": ColumnAuditCommand,
+    "route_redecorate": RouteRedecorateCommand,
+}
+
+# Codemods run when none are named. Rewriting queries changes what they return (a
+# sequence rather than a list) and eager loading changes how they load, so those are only
+# run when asked for. The column audit only reports, with --analyze.
+DEFAULT_CODEMODS = ("column_to_mapped", "annotate_session", "route_redecorate")
+
+
+def codemod_options(
+    codemod_cls: Type[CodemodCommand], options: Mapping[str, object]
+) -> Dict[str, object]:
+    """
+    Pick out the options that the given codemod's constructor accepts.
+    :param codemod_cls: The codemod class
+    :param options: All options given to the combined codemod
+    :return: The subset of options to pass to the codemod class
+    """
+    params = inspect.signature(codemod_cls.__init__).parameters
+    return {
+        name: value
+        for name, value in options.items()
+        if name in params and name not in ("self", "context")
+    }
+
+
+class CombinedCodemodCommand(CodemodCommand):
+    DESCRIPTION = (
+        "Run several codemods over one parsed module, "
+        "generating code and resolving imports once."
+    )
+
+    @staticmethod
+    def add_args(arg_parser: argparse.ArgumentParser) -> None:
+        arg_parser.add_argument(
+            "--codemods",
+            nargs="+",
+            choices=list(AVAILABLE_CODEMODS),
+            default=list(DEFAULT_CODEMODS),
+            help="The codemods to run, applied in the order they are listed.",
+        )
+        arg_parser.add_argument(
+            "--continue-on-error",
+            action="store_true",
+            help="Record and skip constructs a codemod doesn't support, and carry on "
+            "transforming the rest of the file.",
+        )
+        for codemod_cls in AVAILABLE_CODEMODS.values():
+            codemod_cls.add_args(arg_parser)
+
+    def __init__(
+        self,
+        context: CodemodContext,
+        codemods: Sequence[str] = DEFAULT_CODEMODS,
+        **options: object,
+    ) -> None:
+        super().__init__(context)
+        unknown = [name for name in codemods if name not in AVAILABLE_CODEMODS]
+        if unknown:
+            raise ValueError(f"Unknown codemods: {', '.join(unknown)}")
+        self.codemod_names = tuple(codemods)
+        self.options = options
+        self.commands: Tuple[Tuple[str, Codemod], ...] = tuple(
+            (
+                name,
+                AVAILABLE_CODEMODS[name](
+                    context,
+                    **codemod_options(AVAILABLE_CODEMODS[name], options),
+                ),
+            )
+            for name in self.codemod_names
+        )
+        # Codemods that passed the pre-screen for the current source
+        self.selected_commands = self.commands
+        # Cumulative seconds spent in each codemod (and the shared import pass)
+        self.timings: Counter = Counter()
+        # Number of files each codemod was skipped for by its pre-screen
+        self.prescreen_skips: Counter = Counter()
+        # Sites recorded by each analyzer in the last analysis, for reports
+        self.records: Dict[str, List[Dict[str, Any]]] = {}
+
+    def cache_key_options(self) -> Dict[str, object]:
+        """
+        Options identifying what this codemod does, for use in cache keys. Codemods whose
+        behaviour depends on more than their options (e.g. the contents of a file named
+        by an option) provide a cache_fingerprint() method.
+        """
+        key_options = dict(self.options)
+        for name, command in self.commands:
+            fingerprint = getattr(command, "cache_fingerprint", None)
+            if fingerprint is not None:
+                key_options[f"{name}.fingerprint"] = fingerprint()
+        return key_options
+
+    def should_transform(self, source: str) -> bool:
+        """
+        Cheaply check, without parsing, which codemods could change the source. Only
+        those codemods are run by the next transform.
+        :param source: Python source code
+        :return: Whether any codemod could change the source
+        """
+        selected = []
+        for name, command in self.commands:
+            if command.should_transform(source):
+                selected.append((name, command))
+            else:
+                self.prescreen_skips[name] += 1
+        self.selected_commands = tuple(selected)
+        return bool(self.selected_commands)
+
+    def analyze_module(self, tree: cst.Module) -> Dict[str, Counter]:
+        """
+        Count what each selected codemod would change, visiting the tree read-only
+        instead of transforming it.
+        :param tree: The parsed module
+        :return: Stats per codemod
+        """
+        analysis = {}
+        self.records = {}
+        for name, command in self.selected_commands:
+            command.context = self.context
+            start = time.perf_counter()
+            analyzer = AVAILABLE_ANALYZERS[name](command)
+            tree.visit(analyzer)
+            self.timings[name] += time.perf_counter() - start
+            analysis[name] = analyzer.stats
+            if analyzer.records:
+                self.records[name] = analyzer.records
+        self.selected_commands = self.commands
+        return analysis
+
+    def transform_module_impl(self, tree: cst.Module) -> cst.Module:
+        for name, command in self.selected_commands:
+            command.context = self.context
+            start = time.perf_counter()
+            # Codemod.transform_module rather than CodemodCommand.transform_module,
+            # so that needed imports are gathered and added once for all codemods.
+            tree = Codemod.transform_module(command, tree)
+            self.timings[name] += time.perf_counter() - start
+        return tree
+
+    def transform_module(self, tree: cst.Module) -> cst.Module:
+        # Whatever isn't spent inside a codemod is metadata resolution and the
+        # shared import pass, so attribute it to "imports".
+        codemods_before = sum(self.timings[name] for name in self.codemod_names)
+        start = time.perf_counter()
+        tree = super().transform_module(tree)
+        elapsed = time.perf_counter() - start
+        codemods_after = sum(self.timings[name] for name in self.codemod_names)
+        self.timings["imports"] += elapsed - (codemods_after - codemods_before)
+        self.selected_commands = self.commands
+        return tree
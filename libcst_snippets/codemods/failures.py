@@ -0,0 +1,89 @@
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import libcst as cst
+from libcst.codemod import CodemodContext
+from libcst.metadata import PositionProvider
+
+# Key in CodemodContext.scratch for the failures recorded while transforming a module
+FAILURES_KEY = "failures.recorded"
+
+
+@dataclass(frozen=True)
+class CodemodFailure:
+    """
+    A construct that a codemod doesn't support and skipped.
+    """
+
+    filename: Optional[str]
+    line: Optional[int]
+    column: Optional[int]
+    codemod: str
+    reason: str
+
+    def __str__(self) -> str:
+        location = ":".join(
+            str(part)
+            for part in (self.filename or "<unknown>", self.line, self.column)
+            if part is not None
+        )
+        return f"{location}: {self.codemod}: {self.reason}"
+
+
+class UnsupportedConstructError(ValueError):
+    """
+    Raised by a codemod for a construct it doesn't support, unless it is continuing on
+    errors.
+    """
+
+    def __init__(self, failure: CodemodFailure) -> None:
+        super().__init__(str(failure))
+        self.failure = failure
+
+
+def node_position(
+    context: CodemodContext, node: cst.CSTNode
+) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Find where a node of the module being transformed starts. Positions are only
+    computed, for the whole module, the first time this is called.
+    :param context: The codemod's context, with the metadata wrapper for the module
+    :param node: A node of the original (not updated) tree
+    :return: The line and (1-based) column, or Nones if they can't be found
+    """
+    if context.wrapper is None:
+        return None, None
+    position = context.wrapper.resolve(PositionProvider).get(node)
+    if position is None:
+        return None, None
+    return position.start.line, position.start.column + 1
+
+
+class RecordsFailures:
+    """
+    Mixin for codemods that can skip constructs they don't support. By default these
+    raise UnsupportedConstructError; with continue_on_error set they are recorded in
+    context.scratch[FAILURES_KEY] and the rest of the module is still transformed.
+    """
+
+    context: CodemodContext
+    continue_on_error: bool = False
+
+    def unsupported(self, node: cst.CSTNode, reason: str) -> None:
+        """
+        Raise or record a failure for a node the codemod can't handle. Callers skip the
+        node if this returns.
+        :param node: The node, from the original tree
+        :param reason: Why the node isn't supported
+        """
+        line, column = node_position(self.context, node)
+        failure = CodemodFailure(
+            self.context.filename, line, column, type(self).__name__, reason
+        )
+        if not self.continue_on_error:
+            raise UnsupportedConstructError(failure)
+        self.context.scratch.setdefault(FAILURES_KEY, []).append(failure)
+
+
+def recorded_failures(context: CodemodContext) -> List[CodemodFailure]:
+    return context.scratch.get(FAILURES_KEY, [])
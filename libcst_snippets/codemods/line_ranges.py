@@ -0,0 +1,92 @@
+import re
+import subprocess
+from typing import Dict, List, Sequence, Tuple
+
+import libcst as cst
+from libcst.codemod import CodemodContext
+from libcst.metadata import PositionProvider
+
+# Key in CodemodContext.scratch for the line ranges codemods are restricted to. When it
+# isn't set, codemods change the whole module.
+CHANGED_LINES_KEY = "line_ranges.changed"
+
+LineRanges = List[Tuple[int, int]]
+
+_hunk_header_re = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+
+def _git_diff(base_ref: str, paths: Sequence[str], *options: str) -> str:
+    return subprocess.run(
+        ["git", "diff", "--relative", "--no-color", *options, base_ref, "--", *paths],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+def changed_python_files(base_ref: str, paths: Sequence[str] = ()) -> List[str]:
+    """
+    Find the Python files that differ between a git ref and the working tree.
+    :param base_ref: The ref to compare against, e.g. origin/main
+    :param paths: Only look under these paths
+    :return: The changed (but not deleted) Python files, relative to the current directory
+    """
+    output = _git_diff(base_ref, paths, "--name-only", "--diff-filter=d")
+    return sorted(name for name in output.splitlines() if name.endswith(".py"))
+
+
+def parse_changed_lines(diff: str) -> Dict[str, LineRanges]:
+    """
+    Parse a diff made with -U0 into the line ranges added or changed in each new file.
+    Hunks that only delete lines are ignored.
+    :param diff: The diff
+    :return: Inclusive (first, last) line ranges by filename
+    """
+    ranges: Dict[str, LineRanges] = {}
+    current = None
+    for line in diff.splitlines():
+        if line.startswith("+++ "):
+            name = line[4:]
+            current = None if name == "/dev/null" else name[2:]
+            if current is not None:
+                ranges.setdefault(current, [])
+            continue
+        match = _hunk_header_re.match(line)
+        if match and current is not None:
+            start = int(match.group(1))
+            count = int(match.group(2) or 1)
+            if count:
+                ranges[current].append((start, start + count - 1))
+    return ranges
+
+
+def changed_lines(base_ref: str, filenames: Sequence[str]) -> Dict[str, LineRanges]:
+    """
+    Find the lines of each file added or changed since a git ref.
+    :param base_ref: The ref to compare against
+    :param filenames: The files, relative to the current directory
+    :return: Line ranges by filename
+    """
+    if not filenames:
+        return {}
+    return parse_changed_lines(_git_diff(base_ref, filenames, "-U0"))
+
+
+def in_changed_lines(context: CodemodContext, node: cst.CSTNode) -> bool:
+    """
+    Whether a codemod may change a node, given the line ranges in context.scratch.
+    Positions are only computed, for the whole module, when ranges are set.
+    :param context: The codemod's context, with the metadata wrapper for the module
+    :param node: A node of the original (not updated) tree
+    :return: True if the node overlaps a changed line, or no ranges are set
+    """
+    ranges = context.scratch.get(CHANGED_LINES_KEY)
+    if ranges is None or context.wrapper is None:
+        return True
+    position = context.wrapper.resolve(PositionProvider).get(node)
+    if position is None:
+        return True
+    return any(
+        first <= position.end.line and position.start.line <= last
+        for first, last in ranges
+    )
@@ -0,0 +1,124 @@
+import functools
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, TypeVar, Union
+
+import libcst as cst
+import libcst.matchers as m
+
+F = TypeVar("F", bound=Callable)
+
+
+@dataclass
+class MatcherProfile:
+    """
+    Call counts, hits and cumulative time for each named matcher or predicate.
+    """
+
+    calls: Counter = field(default_factory=Counter)
+    hits: Counter = field(default_factory=Counter)
+    seconds: Counter = field(default_factory=Counter)
+
+    def record(self, name: str, hit: bool, seconds: float) -> None:
+        self.calls[name] += 1
+        self.hits[name] += hit
+        self.seconds[name] += seconds
+
+    def update(self, other: "MatcherProfile") -> None:
+        self.calls.update(other.calls)
+        self.hits.update(other.hits)
+        self.seconds.update(other.seconds)
+
+    def as_dict(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        """
+        The stats by name, most expensive first, for JSON output.
+        """
+        return {
+            name: {
+                "calls": self.calls[name],
+                "hits": self.hits[name],
+                "hit_rate": self.hits[name] / self.calls[name],
+                "seconds": self.seconds[name],
+            }
+            for name, _ in self.seconds.most_common()
+        }
+
+    def format_table(self) -> str:
+        """
+        Format the stats as a table, most expensive first.
+        """
+        stats = self.as_dict()
+        width = max([len(name) for name in stats] + [len("matcher")])
+        lines = [
+            f"{'matcher':<{width}}  {'calls':>9}  {'hits':>9}  {'hit %':>6}  "
+            f"{'total':>10}  {'per call':>10}"
+        ]
+        for name, row in stats.items():
+            lines.append(
+                f"{name:<{width}}  {row['calls']:>9}  {row['hits']:>9}  "
+                f"{100 * row['hit_rate']:>5.1f}%  {row['seconds']:>9.3f}s  "
+                f"{1e6 * row['seconds'] / row['calls']:>8.2f}us"
+            )
+        return "\n".join(lines)
+
+
+# The profile being recorded in this process, if profiling is on
+_active_profile: Optional[MatcherProfile] = None
+
+
+def start_profiling() -> MatcherProfile:
+    """
+    Start recording matcher stats in this process, in a new profile.
+    """
+    global _active_profile
+    _active_profile = MatcherProfile()
+    return _active_profile
+
+
+def stop_profiling() -> Optional[MatcherProfile]:
+    """
+    Stop recording matcher stats.
+    :return: The profile recorded since start_profiling(), if any
+    """
+    global _active_profile
+    profile, _active_profile = _active_profile, None
+    return profile
+
+
+def profiled(name: Optional[str] = None) -> Callable[[F], F]:
+    """
+    Decorate a predicate so that, while profiling, its calls are recorded under the
+    given name (by default the function's name). A call is a hit if the result is truthy.
+    When profiling is off the only overhead is checking that it is off.
+    """
+
+    def decorator(func: F) -> F:
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = _active_profile
+            if profile is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            profile.record(label, bool(result), time.perf_counter() - start)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def matches(node: cst.CSTNode, matcher: m.BaseMatcherNode, name: str) -> bool:
+    """
+    Like m.matches, but recorded under the given name while profiling.
+    """
+    profile = _active_profile
+    if profile is None:
+        return m.matches(node, matcher)
+    start = time.perf_counter()
+    result = m.matches(node, matcher)
+    profile.record(name, result, time.perf_counter() - start)
+    return result
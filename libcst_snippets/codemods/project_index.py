@@ -0,0 +1,504 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple, Union
+
+import libcst as cst
+from libcst.helpers import (
+    calculate_module_and_package,
+    get_absolute_module_from_package,
+    get_full_name_for_node,
+)
+from libcst.metadata import (
+    MetadataWrapper,
+    QualifiedNameSource,
+    Scope,
+    ScopeProvider,
+)
+
+from .sa_common import (
+    DECLARATIVE_BASE_CLASSES,
+    DECLARATIVE_BASE_FACTORIES,
+    relationship_attributes,
+)
+
+DEFAULT_INDEX_PATH = ".codemod_index.json"
+
+# Bump when the information stored per file changes, to rebuild old indexes
+INDEX_VERSION = 2
+
+Constant = Union[str, int, float, bool, None]
+
+
+@dataclass
+class FileIndex:
+    """
+    What one module defines at the top level. Names of other things are absolute
+    qualified names, e.g. app.models.base.Base.
+    """
+
+    # sha256 of the file's content
+    hash: str
+    module: str
+    package: str
+    # Names defined in the module, and what kind of thing each is (class, function,
+    # constant, variable or import)
+    symbols: Dict[str, str] = field(default_factory=dict)
+    # Imported names and what they refer to
+    imports: Dict[str, str] = field(default_factory=dict)
+    # Classes and their bases
+    classes: Dict[str, List[str]] = field(default_factory=dict)
+    # Names bound to a declarative base, e.g. by Base = declarative_base()
+    declarative: List[str] = field(default_factory=list)
+    # Names assigned a literal, e.g. ADMIN_PERMISSION = "admin"
+    constants: Dict[str, Constant] = field(default_factory=dict)
+    # Classes' relationship attributes, for classes that have any
+    relationships: Dict[str, List[str]] = field(default_factory=dict)
+
+
+def absolute_name(qualified_name: str, package: str) -> str:
+    """
+    Make a qualified name from LibCST's scope analysis absolute, e.g. .base.Base in package
+    app.models is app.models.base.Base.
+    """
+    n_dots = len(qualified_name) - len(qualified_name.lstrip("."))
+    if not n_dots:
+        return qualified_name
+    base = get_absolute_module_from_package(package or None, None, n_dots)
+    rest = qualified_name[n_dots:]
+    if base is None:
+        return rest
+    return f"{base}.{rest}"
+
+
+def _qualified_names(
+    scope: Scope, node: cst.CSTNode, module: str, package: str
+) -> List[str]:
+    names = []
+    for qualified_name in scope.get_qualified_names_for(node):
+        if qualified_name.source == QualifiedNameSource.LOCAL:
+            names.append(f"{module}.{qualified_name.name}")
+        elif qualified_name.source == QualifiedNameSource.IMPORT:
+            names.append(absolute_name(qualified_name.name, package))
+        else:
+            names.append(qualified_name.name)
+    if not names:
+        # Not bound in the module, e.g. a star import
+        name = get_full_name_for_node(node)
+        if name is not None:
+            names.append(name)
+    return names
+
+
+def _literal(node: cst.BaseExpression) -> Tuple[bool, Constant]:
+    if isinstance(node, cst.SimpleString):
+        return True, node.evaluated_value
+    if isinstance(node, cst.Integer):
+        return True, int(node.value, 0)
+    if isinstance(node, cst.Float):
+        return True, float(node.value)
+    if isinstance(node, cst.Name) and node.value in ("True", "False", "None"):
+        return True, {"True": True, "False": False, "None": None}[node.value]
+    return False, None
+
+
+def index_source(source: str, module: str, package: str) -> FileIndex:
+    """
+    Index the top level of a module.
+    :param source: Python source code
+    :param module: The module's name, e.g. app.models.user
+    :param package: The package it is in, e.g. app.models
+    :return: The index
+    """
+    tree = cst.parse_module(source)
+    scope = MetadataWrapper(tree, unsafe_skip_copy=True).resolve(ScopeProvider)[tree]
+    index = FileIndex(
+        hashlib.sha256(source.encode("utf-8")).hexdigest(), module, package
+    )
+
+    for stmt in tree.body:
+        if isinstance(stmt, cst.ClassDef):
+            name = stmt.name.value
+            index.symbols[name] = "class"
+            index.classes[name] = [
+                base
+                for arg in stmt.bases
+                for base in _qualified_names(scope, arg.value, module, package)
+            ]
+            if any(base in DECLARATIVE_BASE_CLASSES for base in index.classes[name]):
+                index.declarative.append(name)
+            relationships = relationship_attributes(stmt)
+            if relationships:
+                index.relationships[name] = relationships
+        elif isinstance(stmt, cst.FunctionDef):
+            index.symbols[stmt.name.value] = "function"
+        elif isinstance(stmt, cst.SimpleStatementLine):
+            for small_stmt in stmt.body:
+                if isinstance(small_stmt, (cst.Import, cst.ImportFrom)):
+                    _index_import(index, small_stmt)
+                elif isinstance(small_stmt, (cst.Assign, cst.AnnAssign)):
+                    _index_assign(index, scope, small_stmt)
+    return index
+
+
+def _index_import(index: FileIndex, stmt: Union[cst.Import, cst.ImportFrom]) -> None:
+    if isinstance(stmt.names, cst.ImportStar):
+        return
+    if isinstance(stmt, cst.ImportFrom):
+        module = cst.Module([]).code_for_node(stmt.module) if stmt.module else ""
+        prefix = absolute_name("." * len(stmt.relative) + module, index.package)
+    for alias in stmt.names:
+        name = cst.Module([]).code_for_node(alias.name)
+        if isinstance(stmt, cst.ImportFrom):
+            target = f"{prefix}.{name}"
+        else:
+            target = name
+        local = alias.evaluated_alias or name.split(".", 1)[0]
+        if isinstance(stmt, cst.Import) and alias.asname is None:
+            target = local
+        index.symbols[local] = "import"
+        index.imports[local] = target
+
+
+def _index_assign(
+    index: FileIndex, scope: Scope, stmt: Union[cst.Assign, cst.AnnAssign]
+) -> None:
+    if isinstance(stmt, cst.Assign):
+        targets = [target.target for target in stmt.targets]
+    else:
+        targets = [stmt.target]
+    names = [target.value for target in targets if isinstance(target, cst.Name)]
+    value = stmt.value
+    if value is None:
+        return
+    is_literal, literal = _literal(value)
+    is_declarative = isinstance(value, cst.Call) and any(
+        name.name in DECLARATIVE_BASE_FACTORIES
+        for name in scope.get_qualified_names_for(value.func)
+    )
+    for name in names:
+        if is_literal:
+            index.symbols[name] = "constant"
+            index.constants[name] = literal
+        else:
+            index.symbols[name] = "variable"
+        if is_declarative:
+            index.declarative.append(name)
+
+
+def index_file(root: str, filename: str) -> Tuple[str, FileIndex]:
+    """
+    Index one file.
+    :param root: The project root, that module names are relative to
+    :param filename: The file
+    :return: The file's path relative to the root, and its index
+    """
+    with open(filename, "rb") as file:
+        data = file.read()
+    names = calculate_module_and_package(root, os.path.abspath(filename))
+    try:
+        entry = index_source(data.decode("utf-8"), names.name, names.package)
+    except (UnicodeDecodeError, cst.ParserSyntaxError):
+        # Indexed as defining nothing, until its content changes
+        entry = FileIndex(hashlib.sha256(data).hexdigest(), names.name, names.package)
+    return os.path.relpath(filename, root), entry
+
+
+def _file_hash(filename: str) -> str:
+    with open(filename, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class ProjectIndex:
+    """
+    Symbols, class bases, imports and constants of every module in a project, for
+    codemods to look up things defined in other files.
+    """
+
+    def __init__(self, root: str, files: Dict[str, FileIndex]) -> None:
+        self.root = os.path.abspath(root)
+        # By path relative to the root
+        self.files = files
+        self.modules: Dict[str, FileIndex] = {
+            file_index.module: file_index for file_index in files.values()
+        }
+        self._models: Dict[Tuple[str, ...], FrozenSet[str]] = {}
+        self._fingerprint: Optional[str] = None
+
+    @classmethod
+    def load(cls, path: str) -> "ProjectIndex":
+        with open(path, "r", encoding="utf-8") as file:
+            data = json.load(file)
+        if data.get("version") != INDEX_VERSION:
+            raise ValueError(f"{path} was built by a different version of the index")
+        files = {name: FileIndex(**entry) for name, entry in data["files"].items()}
+        return cls(data["root"], files)
+
+    def save(self, path: str) -> None:
+        data = {
+            "version": INDEX_VERSION,
+            "root": self.root,
+            "files": {
+                name: asdict(entry) for name, entry in sorted(self.files.items())
+            },
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+        os.replace(tmp_path, path)
+
+    def fingerprint(self) -> str:
+        """
+        A hash of the indexed files' content, for use in cache keys.
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha256()
+            for name, entry in sorted(self.files.items()):
+                digest.update(f"{name}\0{entry.hash}\0".encode("utf-8"))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def file_for(self, filename: str) -> Optional[FileIndex]:
+        """
+        Look up the index of a file, by its path.
+        """
+        return self.files.get(os.path.relpath(os.path.abspath(filename), self.root))
+
+    def qualify(self, filename: str, name: str) -> Optional[str]:
+        """
+        The qualified name of a (dotted) name used at the top level of a file, e.g.
+        permissions.ADMIN in app/views.py is app.permissions.ADMIN if the module imports
+        permissions from app.
+        :return: The qualified name, or None if the file isn't in the index
+        """
+        entry = self.file_for(filename)
+        if entry is None:
+            return None
+        first, dot, rest = name.partition(".")
+        if first in entry.imports:
+            return entry.imports[first] + dot + rest
+        return f"{entry.module}.{name}"
+
+    def resolve(self, qualified_name: str) -> str:
+        """
+        Follow imports to where a name is defined, e.g. app.models.User to
+        app.models.user.User if app/models/__init__.py imports it from there.
+        """
+        seen = set()
+        while qualified_name not in seen:
+            seen.add(qualified_name)
+            module, _, name = qualified_name.rpartition(".")
+            entry = self.modules.get(module)
+            if entry is None or name not in entry.imports:
+                break
+            qualified_name = entry.imports[name]
+        return qualified_name
+
+    def constant(self, qualified_name: str) -> Tuple[bool, Constant]:
+        """
+        Look up the value of a module-level constant.
+        :param qualified_name: The constant, e.g. app.permissions.ADMIN_PERMISSION
+        :return: Whether it was found, and its value
+        """
+        module, _, name = self.resolve(qualified_name).rpartition(".")
+        entry = self.modules.get(module)
+        if entry is None or name not in entry.constants:
+            return False, None
+        return True, entry.constants[name]
+
+    def relationships(self, qualified_name: str) -> List[str]:
+        """
+        The relationship attributes of a class in the project, including those it
+        inherits from classes in the project.
+        :param qualified_name: The class, e.g. app.models.User
+        :return: The attribute names
+        """
+        names: List[str] = []
+        seen = set()
+        pending = [qualified_name]
+        while pending:
+            name = self.resolve(pending.pop())
+            if name in seen:
+                continue
+            seen.add(name)
+            module, _, class_name = name.rpartition(".")
+            entry = self.modules.get(module)
+            if entry is None or class_name not in entry.classes:
+                continue
+            names.extend(
+                attr
+                for attr in entry.relationships.get(class_name, ())
+                if attr not in names
+            )
+            pending.extend(entry.classes[class_name])
+        return names
+
+    def models(self, declarative_bases: Sequence[str] = ()) -> FrozenSet[str]:
+        """
+        Find every model class in the project, by following bases across modules to a
+        declarative base.
+        :param declarative_bases: Declarative bases outside the project, matched against
+            the end of qualified names (see sa_common.find_model_classes)
+        :return: The qualified names of the models
+        """
+        key = tuple(declarative_bases)
+        models = self._models.get(key)
+        if models is not None:
+            return models
+        declarative = {
+            f"{entry.module}.{name}"
+            for entry in self.files.values()
+            for name in entry.declarative
+        }
+        classes = {
+            f"{entry.module}.{name}": bases
+            for entry in self.files.values()
+            for name, bases in entry.classes.items()
+        }
+        mapped: Dict[str, bool] = {}
+
+        def is_mapped(name: str) -> bool:
+            name = self.resolve(name)
+            result = mapped.get(name)
+            if result is None:
+                # Guards against cycles
+                mapped[name] = False
+                stripped = name.lstrip(".")
+                result = (
+                    name in declarative
+                    or any(
+                        stripped == base or stripped.endswith("." + base)
+                        for base in declarative_bases
+                    )
+                    or name in classes
+                    and any(is_mapped(base) for base in classes[name])
+                )
+                mapped[name] = result
+            return result
+
+        models = self._models[key] = frozenset(
+            name for name in classes if name not in declarative and is_mapped(name)
+        )
+        return models
+
+    def is_model(
+        self,
+        qualified_name: str,
+        package: str = "",
+        declarative_bases: Sequence[str] = (),
+    ) -> bool:
+        """
+        Whether a name refers to a model class (or declarative base) in the project.
+        :param qualified_name: The name, relative to package if it starts with a dot
+        :param package: The package of the module the name is used in
+        :param declarative_bases: As for models()
+        """
+        name = self.resolve(absolute_name(qualified_name, package))
+        if name in self.models(declarative_bases):
+            return True
+        module, _, name = name.rpartition(".")
+        entry = self.modules.get(module)
+        return entry is not None and name in entry.declarative
+
+
+def build_project_index(
+    root: str,
+    filenames: Iterable[str],
+    previous: Optional[ProjectIndex] = None,
+    jobs: int = 1,
+) -> Tuple[ProjectIndex, int]:
+    """
+    Index the given files, reusing the entries of a previous index for files whose
+    content hasn't changed.
+    :param root: The project root, that module names are relative to
+    :param filenames: The project's Python files
+    :param previous: An earlier index of the project, if any
+    :param jobs: Number of worker processes to index changed files with
+    :return: The index, and the number of files (re)indexed
+    """
+    root = os.path.abspath(root)
+    files: Dict[str, FileIndex] = {}
+    to_index = []
+    for filename in filenames:
+        name = os.path.relpath(filename, root)
+        entry = previous.files.get(name) if previous is not None else None
+        if entry is not None and entry.hash == _file_hash(filename):
+            files[name] = entry
+        else:
+            to_index.append(filename)
+
+    results: Iterable[Tuple[str, FileIndex]]
+    if jobs == 1 or len(to_index) <= 1:
+        results = (index_file(root, filename) for filename in to_index)
+        files.update(results)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            files.update(
+                executor.map(
+                    index_file,
+                    [root] * len(to_index),
+                    to_index,
+                    chunksize=max(1, len(to_index) // (4 * jobs)),
+                )
+            )
+    return ProjectIndex(root, files), len(to_index)
+
+
+def update_project_index(
+    path: str, root: str, filenames: Iterable[str], jobs: int = 1
+) -> Tuple[ProjectIndex, int]:
+    """
+    Bring the index saved at path up to date with the files, building it if it doesn't
+    exist (or is unreadable, or for another root), and save it if anything changed.
+    :param path: Where the index is saved
+    :param root: The project root
+    :param filenames: The project's Python files
+    :param jobs: Number of worker processes to index changed files with
+    :return: The index, and the number of files (re)indexed
+    """
+    previous = None
+    try:
+        previous = ProjectIndex.load(path)
+    except FileNotFoundError:
+        pass
+    except (ValueError, KeyError, TypeError):
+        # Corrupt, or from an older version; rebuilt from scratch
+        pass
+    if previous is not None and previous.root != os.path.abspath(root):
+        previous = None
+    index, n_indexed = build_project_index(root, filenames, previous, jobs)
+    if previous is None or index.fingerprint() != previous.fingerprint():
+        index.save(path)
+    return index, n_indexed
+
+
+@lru_cache(maxsize=4)
+def _load_project_index(path: str, mtime_ns: int) -> ProjectIndex:
+    return ProjectIndex.load(path)
+
+
+def load_project_index(path: str) -> ProjectIndex:
+    """
+    Load an index from disk, once per process for as long as the file is unchanged.
+    """
+    return _load_project_index(path, os.stat(path).st_mtime_ns)
+
+
+def add_project_index_args(arg_parser: argparse.ArgumentParser) -> None:
+    """
+    Add the project index option, unless another codemod already added it.
+    """
+    try:
+        arg_parser.add_argument(
+            "--project-index",
+            metavar="PATH",
+            default=None,
+            help="Project index to look up definitions in other files in, e.g. "
+            f"{DEFAULT_INDEX_PATH}. The codemod runner builds and updates it.",
+        )
+    except argparse.ArgumentError:
+        pass
@@ -1,8 +1,22 @@
-from typing import Union, Optional, TypeVar
+import argparse
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import FrozenSet, Pattern, Sequence, Union, Optional, Tuple, TypeVar
 
 import libcst as cst
 import libcst.matchers as m
 from libcst.codemod import VisitorBasedCodemodCommand, CodemodContext
+from libcst.helpers import get_full_name_for_node
+
+from .failures import RecordsFailures
+from .line_ranges import in_changed_lines
+from .profiling import profiled
+from .project_index import (
+    Constant,
+    add_project_index_args,
+    load_project_index,
+)
 
 T = TypeVar("T")
 LeaveRet = Union[T, cst.RemovalSentinel]
@@ -111,24 +125,268 @@ def build_kwarg_node(keyword: str, value: cst.BaseExpression):
     )
 
 
-class RouteRedecorateCommand(VisitorBasedCodemodCommand):
+DEFAULT_ROUTE_METHODS = ("route",)
+DEFAULT_REQUIRE_CALLS = ("g.user.require",)
+DEFAULT_PERMISSION_KWARG = "permission"
+
+_identifier_re = re.compile(r"[A-Za-z_]\w*")
+
+
+@dataclass(frozen=True)
+class RoutePatterns:
+    """
+    The decorator methods, require calls and permission kwarg that identify views, compiled
+    into lookups and pre-screen regexes. Build these with build_route_patterns(), which
+    compiles each combination of options once per process.
+    """
+
+    # Decorator method names, e.g. {"route", "get", "post"}
+    route_methods: FrozenSet[str]
+    # Dotted names of require functions, e.g. {"g.user.require", "current_user.require"}
+    require_calls: FrozenSet[str]
+    # The last part of each require call's name, for rejecting most calls cheaply
+    require_attrs: FrozenSet[str]
+    permission_kwarg: str
+    route_prescreen: Pattern[str]
+    require_prescreen: Pattern[str]
+
+
+@lru_cache(maxsize=None)
+def build_route_patterns(
+    route_methods: Tuple[str, ...] = DEFAULT_ROUTE_METHODS,
+    require_calls: Tuple[str, ...] = DEFAULT_REQUIRE_CALLS,
+    permission_kwarg: str = DEFAULT_PERMISSION_KWARG,
+) -> RoutePatterns:
+    """
+    Compile the patterns for a set of options.
+    :param route_methods: Names of decorator methods that register a view, e.g. "route"
+    :param require_calls: Dotted names of functions that require a permission, e.g.
+        "g.user.require"
+    :param permission_kwarg: Name of the route decorator kwarg to move the permission to
+    :return: The patterns
+    """
+    if not route_methods or not require_calls:
+        raise ValueError("At least one route method and require call are needed")
+    for name in (*route_methods, permission_kwarg):
+        if not _identifier_re.fullmatch(name):
+            raise ValueError(f"Not a valid name: {name!r}")
+    for name in require_calls:
+        if not all(_identifier_re.fullmatch(part) for part in name.split(".")):
+            raise ValueError(f"Not a valid dotted name: {name!r}")
+
+    methods = "|".join(re.escape(name) for name in sorted(set(route_methods)))
+    calls = "|".join(
+        r"\s*\.\s*".join(re.escape(part) for part in name.split("."))
+        for name in sorted(set(require_calls))
+    )
+    return RoutePatterns(
+        route_methods=frozenset(route_methods),
+        require_calls=frozenset(require_calls),
+        require_attrs=frozenset(name.rsplit(".", 1)[-1] for name in require_calls),
+        permission_kwarg=permission_kwarg,
+        route_prescreen=re.compile(rf"\.\s*(?:{methods})\s*\("),
+        require_prescreen=re.compile(rf"\b(?:{calls})\s*\("),
+    )
+
+
+DEFAULT_ROUTE_PATTERNS = build_route_patterns(
+    DEFAULT_ROUTE_METHODS, DEFAULT_REQUIRE_CALLS, DEFAULT_PERMISSION_KWARG
+)
+
+
+def dotted_name(node: cst.BaseExpression) -> Optional[str]:
+    """
+    The dotted name of a Name or chain of Attributes on a Name, e.g. "g.user.require".
+    :param node: The expression
+    :return: The name, or None if the expression is anything else
+    """
+    parts = []
+    while isinstance(node, cst.Attribute):
+        parts.append(node.attr.value)
+        node = node.value
+    if not isinstance(node, cst.Name):
+        return None
+    parts.append(node.value)
+    return ".".join(reversed(parts))
+
+
+def is_route_decorator(
+    decorator: cst.Decorator, patterns: RoutePatterns = DEFAULT_ROUTE_PATTERNS
+) -> bool:
+    """
+    Equivalent to matching route_decorator_matcher, for the given route methods.
+    """
+    call = decorator.decorator
+    return (
+        isinstance(call, cst.Call)
+        and isinstance(call.func, cst.Attribute)
+        and call.func.attr.value in patterns.route_methods
+    )
+
+
+def has_kwarg(call: cst.Call, keyword_name: str) -> bool:
+    return any(
+        arg.keyword is not None and arg.keyword.value == keyword_name
+        for arg in call.args
+    )
+
+
+def is_require_call(
+    node: cst.BaseExpression, patterns: RoutePatterns = DEFAULT_ROUTE_PATTERNS
+) -> bool:
+    """
+    Equivalent to matching require_call_matcher, for the given require calls.
+    """
+    if not isinstance(node, cst.Call):
+        return False
+    func = node.func
+    if isinstance(func, cst.Attribute):
+        if func.attr.value not in patterns.require_attrs:
+            return False
+    elif not isinstance(func, cst.Name) or func.value not in patterns.require_attrs:
+        return False
+    return dotted_name(func) in patterns.require_calls
+
+
+@profiled()
+def is_require_call_stmt(
+    stmt: cst.BaseStatement, patterns: RoutePatterns = DEFAULT_ROUTE_PATTERNS
+) -> bool:
+    """
+    Equivalent to matching require_call_stmt_matcher, for the given require calls.
+    """
+    return (
+        isinstance(stmt, cst.SimpleStatementLine)
+        and len(stmt.body) > 0
+        and all(
+            isinstance(small_stmt, cst.Expr)
+            and is_require_call(small_stmt.value, patterns)
+            for small_stmt in stmt.body
+        )
+    )
+
+
+@dataclass(frozen=True)
+class ViewScan:
+    """
+    What a single pass over a view function's decorators and body found.
+    """
+
+    route_decorators: Tuple[cst.Decorator, ...]
+    has_permission_route: bool
+    require_stmts: Tuple[cst.SimpleStatementLine, ...]
+
+    @property
+    def eligible(self) -> bool:
+        """
+        Equivalent to matching eligible_view_function_matcher.
+        """
+        return not self.has_permission_route and len(self.require_stmts) == 1
+
+
+@profiled()
+def scan_view_function(
+    node: cst.FunctionDef, patterns: RoutePatterns = DEFAULT_ROUTE_PATTERNS
+) -> Optional[ViewScan]:
+    """
+    Scan a function's decorators and then, if it is a view, its body once, recording the
+    route decorators and top-level require statements.
+    :param node: The function
+    :param patterns: The route methods, require calls and permission kwarg to look for
+    :return: The scan, or None if the function isn't decorated with a route
+    """
+    route_decorators = tuple(
+        decorator
+        for decorator in node.decorators
+        if is_route_decorator(decorator, patterns)
+    )
+    if not route_decorators:
+        return None
+    has_permission_route = any(
+        has_kwarg(decorator.decorator, patterns.permission_kwarg)
+        for decorator in route_decorators
+    )
+    require_stmts = ()
+    if isinstance(node.body, cst.IndentedBlock):
+        require_stmts = tuple(
+            stmt for stmt in node.body.body if is_require_call_stmt(stmt, patterns)
+        )
+    return ViewScan(route_decorators, has_permission_route, require_stmts)
+
+
+class RouteRedecorateCommand(RecordsFailures, VisitorBasedCodemodCommand):
 
     DESCRIPTION = "Add permission kwarg to route decorators based on require calls in view functions"
 
-    def __init__(self, context: CodemodContext):
+    @staticmethod
+    def add_args(arg_parser: argparse.ArgumentParser) -> None:
+        arg_parser.add_argument(
+            "--route-method",
+            dest="route_methods",
+            action="append",
+            default=None,
+            help="Name of a decorator method that registers a view, e.g. get. Can be "
+            f"given more than once. Defaults to {', '.join(DEFAULT_ROUTE_METHODS)}.",
+        )
+        arg_parser.add_argument(
+            "--require-call",
+            dest="require_calls",
+            action="append",
+            default=None,
+            help="Dotted name of a function that requires a permission in a view, e.g. "
+            "current_user.require. Can be given more than once. Defaults to "
+            f"{', '.join(DEFAULT_REQUIRE_CALLS)}.",
+        )
+        arg_parser.add_argument(
+            "--permission-kwarg",
+            default=None,
+            help="Name of the route decorator kwarg to add the permission as. Defaults "
+            f"to {DEFAULT_PERMISSION_KWARG}.",
+        )
+        add_project_index_args(arg_parser)
+
+    def __init__(
+        self,
+        context: CodemodContext,
+        route_methods: Optional[Sequence[str]] = None,
+        require_calls: Optional[Sequence[str]] = None,
+        permission_kwarg: Optional[str] = None,
+        continue_on_error: bool = False,
+        project_index: Optional[str] = None,
+    ):
         super().__init__(context)
+        # Record and skip views that can't be redecorated, instead of failing
+        self.continue_on_error = continue_on_error
+        # Compiled once per process for each combination of options
+        self.patterns = build_route_patterns(
+            tuple(route_methods or DEFAULT_ROUTE_METHODS),
+            tuple(require_calls or DEFAULT_REQUIRE_CALLS),
+            permission_kwarg or DEFAULT_PERMISSION_KWARG,
+        )
+        # Used to look up permissions defined as constants in other modules, for analysis
+        self.project_index = (
+            load_project_index(project_index) if project_index else None
+        )
         self.inside_eligible_view_function = None
+        self.view_scan: Optional[ViewScan] = None
         self.permission: Optional[cst.BaseExpression] = (
             None  # Likely a Name or SimpleString.
         )
 
+    def should_transform(self, source: str) -> bool:
+        """
+        Cheaply check whether the source could contain an eligible view function,
+        without parsing it.
+        """
+        return (
+            self.patterns.route_prescreen.search(source) is not None
+            and self.patterns.require_prescreen.search(source) is not None
+        )
+
     def get_require_stmts(self, view_node: cst.FunctionDef):
         # Find all require call statements in the view function
-        stmts = []
-        for stmt in view_node.body.body:
-            if m.matches(stmt, require_call_stmt_matcher):
-                stmts.append(stmt)
-        return stmts
+        scan = scan_view_function(view_node, self.patterns)
+        return list(scan.require_stmts) if scan else []
 
     def extract_call_from_require_stmt(self, stmt: cst.SimpleStatementLine):
         # Extract the call from its statement
@@ -138,9 +396,13 @@ class RouteRedecorateCommand(VisitorBasedCodemodCommand):
         assert isinstance(call, cst.Call)
         return call
 
-    def get_permission(self, view_node: cst.FunctionDef):
+    def get_permission(
+        self, view_node: cst.FunctionDef, scan: Optional[ViewScan] = None
+    ):
         # Get the permission from the require call in the view function
-        require_stmts = self.get_require_stmts(view_node)
+        if scan is None:
+            scan = scan_view_function(view_node, self.patterns)
+        require_stmts = scan.require_stmts if scan else ()
         n_require_stmts = len(require_stmts)
         if n_require_stmts != 1:
             raise ValueError("View functions must have exactly one require call")
@@ -148,34 +410,66 @@ class RouteRedecorateCommand(VisitorBasedCodemodCommand):
         permission = call.args[0].value
         return permission
 
+    def resolve_permission(
+        self, permission: cst.BaseExpression
+    ) -> Tuple[bool, Constant]:
+        """
+        Find the value of a permission: a string literal, or a constant looked up in the
+        project index. Only analysis uses this, to count views whose permission isn't
+        known; the transform moves the permission to the decorator as written, which
+        keeps names (and e.g. enum members, which aren't indexed) intact.
+        :param permission: The require call's argument
+        :return: Whether the value is known, and the value
+        """
+        if isinstance(permission, cst.SimpleString):
+            return True, permission.evaluated_value
+        name = get_full_name_for_node(permission)
+        if name is None or self.project_index is None or self.context.filename is None:
+            return False, None
+        qualified_name = self.project_index.qualify(self.context.filename, name)
+        if qualified_name is None:
+            return False, None
+        return self.project_index.constant(qualified_name)
+
     def visit_FunctionDef(self, node: cst.FunctionDef) -> bool:
-        if m.matches(node, eligible_view_function_matcher):
+        scan = scan_view_function(node, self.patterns)
+        if scan is not None and scan.eligible and in_changed_lines(self.context, node):
             if self.inside_eligible_view_function:
-                raise ValueError("Nested view functions are not supported")
+                self.unsupported(node, "Nested view functions are not supported")
+                return True
+            require_stmt = scan.require_stmts[0]
+            if not self.extract_call_from_require_stmt(require_stmt).args:
+                self.unsupported(
+                    require_stmt, "Require call has no permission argument"
+                )
+                return True
             self.inside_eligible_view_function = node
-            self.permission = self.get_permission(node)
+            self.view_scan = scan
+            self.permission = self.get_permission(node, scan)
         return True
 
     def leave_FunctionDef(
         self, original_node: cst.FunctionDef, updated_node: cst.FunctionDef
     ) -> LeaveRet[cst.FunctionDef]:
-        if self.inside_eligible_view_function:
+        if self.inside_eligible_view_function is original_node:
             self.inside_eligible_view_function = None
+            self.view_scan = None
             self.permission = None
         return updated_node
 
     def leave_Decorator(
         self, original_node: cst.Decorator, updated_node: cst.Decorator
     ) -> Union[cst.Decorator, cst.RemovalSentinel]:
-        if self.inside_eligible_view_function:
-            # If this is a route decorator, add the permission kwarg
-            if m.matches(updated_node, route_decorator_matcher):
-                inner: cst.Call = updated_node.decorator
-                new_inner = inner.with_changes(
-                    args=list(inner.args)
-                    + [build_kwarg_node("permission", self.permission)]
-                )
-                return updated_node.with_changes(decorator=new_inner)
+        # If this is one of the view's route decorators, add the permission kwarg
+        if self.view_scan and any(
+            original_node is decorator for decorator in self.view_scan.route_decorators
+        ):
+            inner: cst.Call = updated_node.decorator
+            new_inner = inner.with_changes(
+                args=list(inner.args)
+                + [build_kwarg_node(self.patterns.permission_kwarg, self.permission)]
+            )
+            return updated_node.with_changes(decorator=new_inner)
 
         return updated_node
 
@@ -184,7 +478,7 @@ class RouteRedecorateCommand(VisitorBasedCodemodCommand):
         original_node: cst.SimpleStatementLine,
         updated_node: cst.SimpleStatementLine,
     ) -> LeaveRet[cst.SimpleStatementLine]:
-        if self.inside_eligible_view_function:
-            if m.matches(original_node, require_call_stmt_matcher):
-                return cst.RemoveFromParent()
+        # Remove the view's require statement, found when the view was scanned
+        if self.view_scan and original_node is self.view_scan.require_stmts[0]:
+            return cst.RemoveFromParent()
         return updated_node
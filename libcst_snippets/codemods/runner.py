@@ -0,0 +1,712 @@
+import argparse
+import contextlib
+import csv
+import difflib
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import asdict, dataclass, field, replace
+from itertools import islice
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import libcst as cst
+from libcst.codemod import CodemodContext
+
+from .analysis import merge_analysis
+from .cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_SIZE, ResultCache
+from .combined import AVAILABLE_CODEMODS, CombinedCodemodCommand
+from .failures import CodemodFailure, UnsupportedConstructError, recorded_failures
+from .line_ranges import (
+    CHANGED_LINES_KEY,
+    LineRanges,
+    changed_lines,
+    changed_python_files,
+)
+from .profiling import MatcherProfile, start_profiling, stop_profiling
+from .project_index import update_project_index
+
+
+def gather_python_files(paths: Iterable[str]) -> List[str]:
+    """
+    Expand the given paths into a sorted list of Python files.
+    :param paths: Files or directories to search
+    :return: The Python files found
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+                files.extend(
+                    os.path.join(dirpath, filename)
+                    for filename in filenames
+                    if filename.endswith(".py")
+                )
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def transform_source(
+    command: CombinedCodemodCommand, source: str, timings: Counter
+) -> str:
+    """
+    Parse the source once, run the combined codemods over it and generate code once.
+    :param command: The combined codemod to run
+    :param source: Python source code
+    :param timings: Counter to add parse and codegen time to
+    :return: The transformed source code
+    """
+    start = time.perf_counter()
+    tree = cst.parse_module(source)
+    timings["parse"] += time.perf_counter() - start
+
+    tree = command.transform_module(tree)
+
+    start = time.perf_counter()
+    code = tree.code
+    timings["codegen"] += time.perf_counter() - start
+    return code
+
+
+def analyze_source(
+    command: CombinedCodemodCommand, source: str, timings: Counter
+) -> Dict[str, Counter]:
+    """
+    Parse the source and count what the combined codemods would change, without
+    transforming it or generating code.
+    :param command: The combined codemod to analyse for
+    :param source: Python source code
+    :param timings: Counter to add parse time to
+    :return: Stats per codemod
+    """
+    start = time.perf_counter()
+    tree = cst.parse_module(source)
+    timings["parse"] += time.perf_counter() - start
+    return command.analyze_module(tree)
+
+
+def diff_source(filename: str, source: str, code: str, context: int) -> str:
+    """
+    Build a unified diff of one file, with a/ and b/ prefixes so it applies with
+    git apply or patch -p1.
+    :param filename: The file's name
+    :param source: The original source
+    :param code: The transformed source
+    :param context: Number of context lines
+    :return: The diff
+    """
+    # Relative to the current directory, like git diff, so the patch applies from here.
+    # Files outside it (or on another drive, where relpath raises) keep the path given.
+    try:
+        relative = os.path.relpath(filename)
+    except ValueError:
+        relative = filename
+    if relative != os.pardir and not relative.startswith(os.pardir + os.sep):
+        filename = relative
+    filename = filename.replace(os.sep, "/")
+    return "".join(
+        difflib.unified_diff(
+            source.splitlines(keepends=True),
+            code.splitlines(keepends=True),
+            fromfile=f"a/{filename}",
+            tofile=f"b/{filename}",
+            n=context,
+        )
+    )
+
+
+class FileTimeout(Exception):
+    pass
+
+
+def _raise_file_timeout(signum, frame):
+    raise FileTimeout()
+
+
+@dataclass
+class FileResult:
+    filename: str
+    # One of "skipped", "cached", "parsed", "failed" or "timeout"
+    status: str
+    changed: bool = False
+    diff: Optional[str] = None
+    error: Optional[str] = None
+    timings: Counter = field(default_factory=Counter)
+    prescreen_skips: Counter = field(default_factory=Counter)
+    # Stats per codemod, when analysing rather than transforming
+    analysis: Dict[str, Counter] = field(default_factory=dict)
+    # Sites recorded per codemod, when analysing
+    records: Dict[str, List[Dict[str, object]]] = field(default_factory=dict)
+    # Constructs the codemods didn't support
+    failures: List[CodemodFailure] = field(default_factory=list)
+    # Matcher stats, when profiling matchers
+    matcher_profile: Optional[MatcherProfile] = None
+
+
+class _PendingOutput(NamedTuple):
+    # What to do with a file once its (timed) transform is done
+    source: str
+    code: str
+    # Where to cache the result, if it should be cached
+    cache_key: Optional[str] = None
+
+
+def write_atomically(filename: str, code: str) -> None:
+    """
+    Replace a file's content by writing to a temporary file in the same directory and
+    renaming it over the file, so the file is never left half-written. The file's
+    permissions are kept.
+    """
+    tmp_path = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(code)
+        shutil.copymode(filename, tmp_path)
+        os.replace(tmp_path, filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+class FileProcessor:
+    """
+    Runs the combined codemod over one file at a time, either in the main process or
+    once per worker process in a pool.
+    """
+
+    def __init__(
+        self,
+        options: Mapping[str, object],
+        cache: Optional[ResultCache] = None,
+        diff_context: Optional[int] = None,
+        timeout: Optional[float] = None,
+        analyze: bool = False,
+        line_ranges: Optional[Mapping[str, LineRanges]] = None,
+        profile_matchers: bool = False,
+    ) -> None:
+        self.command = CombinedCodemodCommand(CodemodContext(), **options)
+        self.cache = cache
+        self.cache_key_options = self.command.cache_key_options()
+        # When set, produce a diff with this many lines of context instead of writing
+        self.diff_context = diff_context
+        self.timeout = timeout
+        # When set, only count what the codemods would change
+        self.analyze = analyze
+        # When set, codemods only change these lines of each file
+        self.line_ranges = line_ranges
+        self.profile_matchers = profile_matchers
+
+    def process(self, filename: str) -> FileResult:
+        timings_before = self.command.timings.copy()
+        skips_before = self.command.prescreen_skips.copy()
+        use_timer = self.timeout and hasattr(signal, "setitimer")
+        if use_timer:
+            previous_handler = signal.signal(signal.SIGALRM, _raise_file_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self.timeout)
+        if self.profile_matchers:
+            start_profiling()
+        output = None
+        try:
+            try:
+                result, output = self._process(filename)
+            finally:
+                # Only reading and transforming are timed, never writing the results
+                if use_timer:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+                    signal.signal(signal.SIGALRM, previous_handler)
+        except FileTimeout:
+            result = FileResult(
+                filename, "timeout", error=f"Timed out after {self.timeout}s"
+            )
+        except UnsupportedConstructError as e:
+            result = FileResult(filename, "failed", error=str(e), failures=[e.failure])
+        except Exception:
+            result = FileResult(filename, "failed", error=traceback.format_exc())
+        finally:
+            matcher_profile = stop_profiling() if self.profile_matchers else None
+        if output is not None:
+            try:
+                self._write_output(result, output)
+            except Exception:
+                result = FileResult(filename, "failed", error=traceback.format_exc())
+        result.matcher_profile = matcher_profile
+        result.timings.update(self.command.timings - timings_before)
+        result.prescreen_skips.update(self.command.prescreen_skips - skips_before)
+        return result
+
+    def _process(self, filename: str) -> Tuple[FileResult, Optional[_PendingOutput]]:
+        # Read and transform a file, leaving what to write for _write_output
+        with open(filename, "r", encoding="utf-8") as file:
+            source = file.read()
+        if not self.command.should_transform(source):
+            return FileResult(filename, "skipped"), None
+
+        if self.analyze:
+            result = FileResult(filename, "parsed")
+            self.command.context = replace(
+                self.command.context, filename=filename, scratch={}
+            )
+            result.analysis = analyze_source(self.command, source, result.timings)
+            result.records = self.command.records
+            return result, None
+
+        scratch = {}
+        key_options = self.cache_key_options
+        if self.line_ranges is not None:
+            ranges = self.line_ranges.get(filename, [])
+            if not ranges:
+                return FileResult(filename, "skipped"), None
+            scratch[CHANGED_LINES_KEY] = ranges
+            key_options = dict(key_options, changed_lines=ranges)
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(
+                source, ",".join(self.command.codemod_names), key_options
+            )
+            hit, code = self.cache.get(cache_key)
+            if hit:
+                result = FileResult(filename, "cached")
+                if code is None:
+                    return result, None
+                return result, _PendingOutput(source, code)
+
+        result = FileResult(filename, "parsed")
+        self.command.context = replace(
+            self.command.context, filename=filename, scratch=scratch
+        )
+        code = transform_source(self.command, source, result.timings)
+        result.failures = list(recorded_failures(self.command.context))
+        # Results with failures aren't cached, so the failures are reported every run
+        if result.failures:
+            cache_key = None
+        return result, _PendingOutput(source, code, cache_key)
+
+    def _write_output(self, result: FileResult, output: _PendingOutput) -> None:
+        if output.cache_key is not None:
+            self.cache.put(
+                output.cache_key, None if output.code == output.source else output.code
+            )
+        if output.code == output.source:
+            return
+        result.changed = True
+        if self.diff_context is not None:
+            result.diff = diff_source(
+                result.filename, output.source, output.code, self.diff_context
+            )
+        else:
+            write_atomically(result.filename, output.code)
+
+    def process_chunk(self, filenames: Sequence[str]) -> List[FileResult]:
+        return [self.process(filename) for filename in filenames]
+
+
+# The processor for the current worker process, set up once by the pool initializer
+_worker_processor: Optional[FileProcessor] = None
+
+
+def _init_worker(*args) -> None:
+    global _worker_processor
+    _worker_processor = FileProcessor(*args)
+
+
+def _process_chunk_in_worker(filenames: Sequence[str]) -> List[FileResult]:
+    return _worker_processor.process_chunk(filenames)
+
+
+def run_files(
+    filenames: Sequence[str],
+    options: Mapping[str, object],
+    cache: Optional[ResultCache] = None,
+    diff_context: Optional[int] = None,
+    timeout: Optional[float] = None,
+    jobs: int = 1,
+    chunksize: int = 8,
+    analyze: bool = False,
+    line_ranges: Optional[Mapping[str, LineRanges]] = None,
+    profile_matchers: bool = False,
+) -> Iterator[FileResult]:
+    """
+    Run the combined codemod over files, yielding results as they complete.
+    :param filenames: The files to process
+    :param options: Options for CombinedCodemodCommand
+    :param cache: Result cache to use, if any
+    :param diff_context: If set, produce diffs with this many context lines instead of
+        changing files in place
+    :param timeout: Seconds allowed per file
+    :param jobs: Number of worker processes, or 1 to run in this process
+    :param chunksize: Number of files sent to a worker at a time
+    :param analyze: If set, count what the codemods would change instead of changing
+        anything
+    :param line_ranges: If set, only change these lines of each file, by filename
+    :param profile_matchers: If set, record matcher stats for each file
+    :return: An iterator of results, in order of completion
+    """
+    args = (
+        options,
+        cache,
+        diff_context,
+        timeout,
+        analyze,
+        line_ranges,
+        profile_matchers,
+    )
+    if jobs == 1:
+        processor = FileProcessor(*args)
+        for filename in filenames:
+            yield processor.process(filename)
+        return
+
+    chunks = (filenames[i : i + chunksize] for i in range(0, len(filenames), chunksize))
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=args
+    ) as executor:
+        # Keep a couple of chunks per worker in flight, and let go of each chunk's
+        # results (e.g. diffs) once they are handed on, rather than holding them all.
+        pending = {
+            executor.submit(_process_chunk_in_worker, chunk)
+            for chunk in islice(chunks, 2 * jobs)
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for chunk in islice(chunks, 1):
+                    pending.add(executor.submit(_process_chunk_in_worker, chunk))
+                yield from future.result()
+
+
+def write_report(path: str, records: Mapping[str, List[Dict[str, object]]]) -> None:
+    """
+    Write the sites recorded by the analyzers, as CSV if the path ends in .csv (one row
+    per site, with the codemod in the first column) or otherwise as JSON by codemod.
+    :param path: The file to write
+    :param records: Records by codemod
+    """
+    if not path.endswith(".csv"):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(records, file, indent=2)
+        return
+    fieldnames = ["codemod"]
+    for codemod_records in records.values():
+        for record in codemod_records:
+            fieldnames.extend(name for name in record if name not in fieldnames)
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames)
+        writer.writeheader()
+        for name, codemod_records in records.items():
+            for record in codemod_records:
+                writer.writerow(
+                    {
+                        "codemod": name,
+                        **{
+                            key: (
+                                " ".join(map(str, value))
+                                if isinstance(value, (list, tuple))
+                                else value
+                            )
+                            for key, value in record.items()
+                        },
+                    }
+                )
+
+
+def format_timings(timings: Mapping[str, float]) -> str:
+    """
+    Format timings as a table, with each step's share of the total.
+    :param timings: Seconds spent per step
+    :return: The table
+    """
+    total = sum(timings.values()) or 1.0
+    width = max([len(name) for name in timings] + [len("total")])
+    lines = [
+        f"{name:<{width}}  {seconds:9.3f}s  {100 * seconds / total:5.1f}%"
+        for name, seconds in timings.items()
+    ]
+    lines.append(f"{'total':<{width}}  {sum(timings.values()):9.3f}s")
+    return "\n".join(lines)
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Run the codemods over files and directories, parsing each file once."
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="Files or directories to transform. Defaults to the current directory "
+        "with --since.",
+    )
+    parser.add_argument(
+        "--since",
+        metavar="REF",
+        default=None,
+        help="Only transform Python files changed since this git ref.",
+    )
+    parser.add_argument(
+        "--changed-lines",
+        action="store_true",
+        help="With --since, only change constructs overlapping lines added or changed "
+        "since the ref.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes (0 for one per CPU).",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=8,
+        help="Number of files handed to a worker process at a time.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Give up on a file after this many seconds.",
+    )
+    parser.add_argument(
+        "--analyze",
+        action="store_true",
+        help="Print JSON stats of what the codemods would change, without changing anything.",
+    )
+    parser.add_argument(
+        "--report",
+        metavar="PATH",
+        default=None,
+        help="With --analyze, write the sites the analyzers found (e.g. N+1 queries) to "
+        "this file, as CSV if it ends in .csv and otherwise as JSON.",
+    )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="Print unified diffs instead of changing files in place.",
+    )
+    parser.add_argument(
+        "--diff-output",
+        metavar="PATH",
+        default=None,
+        help="Write the diffs to this patch file as each file finishes (implies --diff).",
+    )
+    parser.add_argument(
+        "--diff-context",
+        type=int,
+        default=3,
+        help="Number of context lines in diffs.",
+    )
+    parser.add_argument(
+        "--profile-matchers",
+        choices=["table", "json"],
+        default=None,
+        help="Print call counts, hit rates and time spent in each matcher to stderr.",
+    )
+    parser.add_argument(
+        "--index-root",
+        default=".",
+        help="Root of the project for --project-index: all Python files under it are "
+        "indexed, with module names relative to it.",
+    )
+    parser.add_argument(
+        "--failure-report",
+        default=None,
+        help="Write a JSON list of the constructs the codemods didn't support to this file.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help="Directory to cache results in, keyed by file content and codemod options.",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE // (1024 * 1024),
+        help="Evict least recently used cache entries beyond this many megabytes.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write the result cache.",
+    )
+    CombinedCodemodCommand.add_args(parser)
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = build_arg_parser()
+    args = vars(parser.parse_args(argv))
+    paths = args.pop("paths")
+    since = args.pop("since")
+    restrict_to_changed_lines = args.pop("changed_lines")
+    if not paths and since is None:
+        parser.error("the following arguments are required: paths")
+    if restrict_to_changed_lines and since is None:
+        parser.error("--changed-lines needs --since")
+    jobs = args.pop("jobs") or os.cpu_count() or 1
+    chunksize = args.pop("chunksize")
+    timeout = args.pop("timeout")
+    analyze = args.pop("analyze")
+    report = args.pop("report")
+    if report is not None and not analyze:
+        parser.error("--report needs --analyze")
+    failure_report = args.pop("failure_report")
+    profile_matchers = args.pop("profile_matchers")
+    diff_output = args.pop("diff_output")
+    index_root = args.pop("index_root")
+    diff = args.pop("diff") or diff_output is not None
+    diff_context = args.pop("diff_context") if diff else None
+    cache = None
+    cache_dir = args.pop("cache_dir")
+    cache_max_size = args.pop("cache_max_size")
+    # Analysis is cheap and its results aren't cached
+    if not args.pop("no_cache") and not analyze:
+        cache = ResultCache(cache_dir, cache_max_size * 1024 * 1024)
+    codemod_names = args["codemods"]
+    read_only = [
+        name
+        for name in codemod_names
+        if getattr(AVAILABLE_CODEMODS[name], "READ_ONLY", False)
+    ]
+    if read_only and not analyze:
+        parser.error(f"read-only codemods require --analyze: {', '.join(read_only)}")
+
+    timings: Counter = Counter()
+    prescreen_skips: Counter = Counter()
+    counts: Counter = Counter()
+    analysis: Dict[str, Counter] = {name: Counter() for name in codemod_names}
+    records: Dict[str, List[Dict[str, object]]] = {}
+    failures: List[CodemodFailure] = []
+    matcher_profile = MatcherProfile()
+    line_ranges = None
+    try:
+        if since is not None:
+            filenames = changed_python_files(since, paths)
+            if restrict_to_changed_lines:
+                line_ranges = changed_lines(since, filenames)
+        else:
+            filenames = gather_python_files(paths)
+    except subprocess.CalledProcessError as e:
+        print(f"git failed: {e.stderr.strip()}", file=sys.stderr)
+        return 2
+
+    if args.get("project_index") is not None:
+        # The whole project is indexed, not only the files being transformed; files
+        # unchanged since the last run are reused from the saved index
+        index, n_indexed = update_project_index(
+            args["project_index"],
+            index_root,
+            gather_python_files([index_root]),
+            jobs,
+        )
+        print(
+            f"project index: {n_indexed} file(s) indexed, "
+            f"{len(index.files) - n_indexed} unchanged",
+            file=sys.stderr,
+        )
+
+    results = run_files(
+        filenames,
+        args,
+        cache=cache,
+        diff_context=diff_context,
+        timeout=timeout,
+        jobs=jobs,
+        chunksize=chunksize,
+        analyze=analyze,
+        line_ranges=line_ranges,
+        profile_matchers=profile_matchers is not None,
+    )
+    with contextlib.ExitStack() as stack:
+        diff_file = sys.stdout
+        if diff_output is not None and diff_output != "-":
+            diff_file = stack.enter_context(open(diff_output, "w", encoding="utf-8"))
+        for result in results:
+            counts[result.status] += 1
+            timings.update(result.timings)
+            prescreen_skips.update(result.prescreen_skips)
+            merge_analysis(analysis, result.analysis)
+            for name, file_records in result.records.items():
+                records.setdefault(name, []).extend(file_records)
+            failures.extend(result.failures)
+            if result.matcher_profile is not None:
+                matcher_profile.update(result.matcher_profile)
+            # Unsupported constructs are listed with the rest of the failures below
+            if result.error and not result.failures:
+                print(f"{result.filename}: {result.error}", file=sys.stderr)
+            if result.changed:
+                counts["changed"] += 1
+                if result.diff is not None:
+                    # Written as each file finishes, so diffs aren't held in memory
+                    diff_file.write(result.diff)
+                    diff_file.flush()
+                if result.diff is None or diff_file is not sys.stdout:
+                    print(result.filename)
+    if cache is not None:
+        cache.prune()
+    if failures:
+        failures.sort(key=lambda f: (f.filename or "", f.line or 0, f.column or 0))
+        print(f"{len(failures)} unsupported construct(s):", file=sys.stderr)
+        for failure in failures:
+            print(f"  {failure}", file=sys.stderr)
+    if profile_matchers == "table":
+        print(matcher_profile.format_table(), file=sys.stderr)
+    elif profile_matchers == "json":
+        print(json.dumps(matcher_profile.as_dict(), indent=2), file=sys.stderr)
+    if failure_report is not None:
+        with open(failure_report, "w", encoding="utf-8") as file:
+            json.dump([asdict(failure) for failure in failures], file, indent=2)
+    if report is not None:
+        for codemod_records in records.values():
+            codemod_records.sort(key=lambda r: (r["filename"] or "", r["line"] or 0))
+        write_report(report, records)
+    if analyze:
+        summary = {
+            "files": {
+                status: counts[status]
+                for status in ("parsed", "skipped", "failed", "timeout")
+            },
+            "codemods": {
+                name: dict(sorted(stats.items())) for name, stats in analysis.items()
+            },
+        }
+        print(json.dumps(summary, indent=2))
+
+    # Report steps in the order they happen for each file.
+    steps = ["parse", *codemod_names, "imports", "codegen"]
+    print(format_timings({step: timings[step] for step in steps}), file=sys.stderr)
+    print(
+        f"{counts['parsed']} file(s) parsed, {counts['skipped']} skipped by pre-screen, "
+        f"{counts['cached']} from cache, {counts['changed']} changed, "
+        f"{counts['failed'] + counts['timeout']} failed",
+        file=sys.stderr,
+    )
+    for name in codemod_names:
+        print(
+            f"{name}: skipped by pre-screen for {prescreen_skips[name]} file(s)",
+            file=sys.stderr,
+        )
+    return 1 if counts["failed"] or counts["timeout"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
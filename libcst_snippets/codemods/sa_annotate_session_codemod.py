@@ -1,12 +1,22 @@
 import argparse
-from typing import Sequence
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Set
 
 import libcst as cst
 import libcst.matchers as m
 from libcst.codemod import VisitorBasedCodemodCommand, CodemodContext
 from libcst.codemod.visitors import AddImportsVisitor
 
-from .sa_common import class_probably_an_sa_model
+from .line_ranges import in_changed_lines
+from .profiling import profiled
+from .project_index import add_project_index_args, load_project_index
+from .sa_common import (
+    ModelDetector,
+    add_model_detection_args,
+    add_session_name_args,
+    sa_model_prescreen,
+)
 
 before = """
 from sqlalchemy import Column, Integer, Boolean
@@ -57,6 +67,19 @@ class MyModel(Base):
 
 classmethod_decorator_matcher = m.Decorator(decorator=m.Name(value="classmethod"))
 
+# Cheap textual check for source that could contain a match for classmethod_decorator_matcher
+classmethod_decorator_prescreen = re.compile(r"@\s*classmethod\b")
+
+
+def build_session_name_prescreen(possible_session_names: Sequence[str] = ("session",)):
+    """
+    Build a cheap textual check for source that mentions any of the possible session names.
+    :param possible_session_names: The names of the session parameter
+    :return: A compiled regular expression
+    """
+    alternatives = "|".join(re.escape(name) for name in possible_session_names)
+    return re.compile(rf"\b(?:{alternatives})\b")
+
 
 def build_classmethod_with_session_arg_matcher(
     possible_session_names: Sequence[str] = ("session",)
@@ -80,10 +103,158 @@ def build_classmethod_with_session_arg_matcher(
     )
 
 
+# Kinds of function whose session parameters can be annotated: classmethods, methods and
+# staticmethods directly in a class body, and functions at the top level of a module
+SESSION_SCOPES = ("classmethod", "method", "staticmethod", "function")
+
+DEFAULT_SESSION_SCOPES = ("classmethod",)
+
+# Cheap textual checks for source that could contain a function in a scope
+_scope_prescreens = {
+    "classmethod": classmethod_decorator_prescreen.pattern,
+    "staticmethod": r"@\s*staticmethod\b",
+    "method": r"\bdef\b",
+    "function": r"\bdef\b",
+}
+
+
+def build_scope_prescreen(scopes: Sequence[str]):
+    """
+    Build a cheap textual check for source that could contain a function in any of the
+    given scopes.
+    :param scopes: Names from SESSION_SCOPES
+    :return: A compiled regular expression
+    """
+    alternatives = sorted({_scope_prescreens[scope] for scope in scopes})
+    return re.compile("|".join(alternatives))
+
+
+def _decorator_names(node: cst.FunctionDef) -> Set[str]:
+    return {
+        decorator.decorator.value
+        for decorator in node.decorators
+        if isinstance(decorator.decorator, cst.Name)
+    }
+
+
+@dataclass
+class SessionFunction:
+    """
+    A function being visited, and its session parameters.
+    """
+
+    params: List[cst.Param]
+    # Whether the session is async: the function is an async def, or its body (or that
+    # of a nested function) awaits a method of the session
+    is_async: bool
+
+
+class SessionParamFinder:
+    """
+    Finds the session parameters of functions in the configured scopes while a visitor
+    walks a module, so that every scope is handled in the same traversal. The visitor
+    reports entering and leaving classes and functions, and awaits; parameters are
+    picked out by looking their names up in a set.
+    """
+
+    def __init__(
+        self,
+        scopes: Sequence[str],
+        session_names: Sequence[str],
+        any_class: bool = False,
+    ) -> None:
+        unknown = [scope for scope in scopes if scope not in SESSION_SCOPES]
+        if unknown:
+            raise ValueError(f"Unknown session scopes: {', '.join(unknown)}")
+        self.scopes = frozenset(scopes)
+        self.session_names = frozenset(session_names)
+        # Annotate methods of any class, not only of models
+        self.any_class = any_class
+        # What each enclosing class or function is: "model", "class" or "function"
+        self.enclosing: List[str] = []
+        # The enclosing functions
+        self.functions: List[SessionFunction] = []
+
+    def reset(self) -> None:
+        self.enclosing = []
+        self.functions = []
+
+    def enter_class(self, is_model: bool) -> None:
+        self.enclosing.append("model" if is_model else "class")
+
+    def leave_class(self) -> None:
+        self.enclosing.pop()
+
+    def scope_of(self, node: cst.FunctionDef) -> Optional[str]:
+        """
+        Which of SESSION_SCOPES a function is in, given where it is, or None if it isn't
+        in any (e.g. it is nested in another function, or a method of a non-model class).
+        """
+        parent = self.enclosing[-1] if self.enclosing else None
+        if parent is None:
+            return "function"
+        if parent == "function" or parent == "class" and not self.any_class:
+            return None
+        decorators = _decorator_names(node)
+        if "classmethod" in decorators:
+            return "classmethod"
+        if "staticmethod" in decorators:
+            return "staticmethod"
+        return "method"
+
+    @profiled("find_session_params")
+    def enter_function(self, node: cst.FunctionDef) -> List[cst.Param]:
+        """
+        Find a function's session parameters, annotated or not, if it is in one of the
+        configured scopes.
+        """
+        scope = self.scope_of(node)
+        self.enclosing.append("function")
+        session_params = []
+        if scope in self.scopes:
+            params = [*node.params.posonly_params, *node.params.params]
+            if scope in ("classmethod", "method"):
+                # cls or self
+                params = params[1:]
+            params.extend(node.params.kwonly_params)
+            session_params = [
+                param for param in params if param.name.value in self.session_names
+            ]
+        self.functions.append(
+            SessionFunction(session_params, node.asynchronous is not None)
+        )
+        return session_params
+
+    def visit_await(self, node: cst.Await) -> None:
+        """
+        Mark the function whose session is awaited as async, e.g. for
+        await session.execute(...).
+        """
+        call = node.expression
+        if not (
+            isinstance(call, cst.Call)
+            and isinstance(call.func, cst.Attribute)
+            and isinstance(call.func.value, cst.Name)
+        ):
+            return
+        name = call.func.value.value
+        if name not in self.session_names:
+            return
+        # The innermost function the session is a parameter of
+        for function in reversed(self.functions):
+            if any(param.name.value == name for param in function.params):
+                function.is_async = True
+                return
+
+    def leave_function(self) -> SessionFunction:
+        self.enclosing.pop()
+        return self.functions.pop()
+
+
 class AddSessionTypeAnnotationCommand(VisitorBasedCodemodCommand):
     DESCRIPTION = (
-        "Annotate session parameter of classmethods that appear to be part of an SQLAlchemy model "
-        "(have column definitions or a __tablename__)."
+        "Annotate session parameters of classmethods (and optionally methods, staticmethods "
+        "and module-level functions) that appear to be part of an SQLAlchemy model."
     )
 
     @staticmethod
@@ -99,65 +270,186 @@ class AddSessionTypeAnnotationCommand(VisitorBasedCodemodCommand):
             help="The module to import the session type from.",
         )
         arg_parser.add_argument(
-            "--possible-session-names",
-            nargs="+",
-            default=["session"],
-            help="The names of the session parameter to annotate.",
+            "--async-session-type-name",
+            default="AsyncSession",
+            help="The name of the session type to annotate async functions with.",
+        )
+        arg_parser.add_argument(
+            "--import-async-session-from",
+            default="sqlalchemy.ext.asyncio",
+            help="The module to import the async session type from.",
         )
+        arg_parser.add_argument(
+            "--no-async-session",
+            dest="async_session",
+            action="store_false",
+            help="Annotate async functions with --session-type-name, like the rest.",
+        )
+        add_session_name_args(arg_parser)
+        arg_parser.add_argument(
+            "--session-scope",
+            dest="session_scopes",
+            action="append",
+            choices=SESSION_SCOPES,
+            default=None,
+            help="Kind of function whose session parameters to annotate. Can be given more "
+            f"than once. Defaults to {', '.join(DEFAULT_SESSION_SCOPES)}.",
+        )
+        arg_parser.add_argument(
+            "--session-any-class",
+            action="store_true",
+            help="Annotate methods of any class, e.g. repositories, not only of models.",
+        )
+        add_model_detection_args(arg_parser)
+        add_project_index_args(arg_parser)
 
     def __init__(
         self,
         context: CodemodContext,
         session_type_name: str = "Session",
         import_session_from: str = "sqlalchemy.orm",
+        async_session_type_name: str = "AsyncSession",
+        import_async_session_from: str = "sqlalchemy.ext.asyncio",
+        async_session: bool = True,
         possible_session_names: Sequence[str] = ("session",),
+        session_scopes: Optional[Sequence[str]] = None,
+        session_any_class: bool = False,
+        model_detection: str = "heuristic",
+        declarative_bases: Optional[Sequence[str]] = None,
+        project_index: Optional[str] = None,
     ) -> None:
         super().__init__(context)
-        self.in_model = False
-        self.in_classmethod = False
+        self.model_detector = ModelDetector(
+            model_detection,
+            declarative_bases,
+            load_project_index(project_index) if project_index else None,
+        )
+        # Set once any parameter is annotated, so each import is only requested once
+        self.session_import_needed = False
+        self.async_session_import_needed = False
         self.session_type_name = session_type_name
         self.import_session_from = import_session_from
+        # Annotate async functions with the async session type, instead of the session type
+        self.async_session = async_session
+        self.async_session_type_name = async_session_type_name
+        self.import_async_session_from = import_async_session_from
         self.possible_session_names = possible_session_names
-        self.classmethod_matcher = build_classmethod_with_session_arg_matcher(
+        self.param_finder = SessionParamFinder(
+            tuple(session_scopes or DEFAULT_SESSION_SCOPES),
+            possible_session_names,
+            session_any_class,
+        )
+        self.session_name_prescreen = build_session_name_prescreen(
             self.possible_session_names
         )
+        self.scope_prescreen = build_scope_prescreen(self.param_finder.scopes)
+
+    def cache_fingerprint(self) -> str:
+        """
+        Identifies the models found, which may depend on other files.
+        """
+        return self.model_detector.fingerprint()
+
+    def should_transform(self, source: str) -> bool:
+        """
+        Cheaply check whether the source could contain a function taking a session in one
+        of the scopes, without parsing it.
+        """
+        # Models found through their bases needn't mention __tablename__ or Column, and
+        # functions outside models needn't be near them
+        needs_model = (
+            self.model_detector.model_detection == "heuristic"
+            and not self.param_finder.any_class
+            and "function" not in self.param_finder.scopes
+        )
+        return (
+            (not needs_model or sa_model_prescreen.search(source) is not None)
+            and self.scope_prescreen.search(source) is not None
+            and self.session_name_prescreen.search(source) is not None
+        )
+
+    def visit_Module(self, node: cst.Module):
+        self.session_import_needed = False
+        self.async_session_import_needed = False
+        self.param_finder.reset()
+        self.model_detector.visit_module(self.context, node)
+        return True
+
+    def leave_Module(
+        self, original_node: cst.Module, updated_node: cst.Module
+    ) -> cst.Module:
+        if self.session_import_needed:
+            AddImportsVisitor.add_needed_import(
+                self.context, self.import_session_from, self.session_type_name
+            )
+        if self.async_session_import_needed:
+            AddImportsVisitor.add_needed_import(
+                self.context,
+                self.import_async_session_from,
+                self.async_session_type_name,
+            )
+        return updated_node
 
     def visit_ClassDef(self, node: cst.ClassDef):
-        if m.matches(node, class_probably_an_sa_model):
-            self.in_model = True
+        self.param_finder.enter_class(self.model_detector.is_model(self.context, node))
         return True
 
     def leave_ClassDef(
         self, original_node: cst.ClassDef, updated_node: cst.ClassDef
     ) -> cst.ClassDef:
-        self.in_model = False
+        self.param_finder.leave_class()
         return updated_node
 
     def visit_FunctionDef(self, node: cst.FunctionDef):
-        if self.in_model and m.matches(node, self.classmethod_matcher):
-            self.in_classmethod = True
+        self.param_finder.enter_function(node)
+        return True
+
+    def visit_Await(self, node: cst.Await):
+        self.param_finder.visit_await(node)
         return True
 
     def leave_FunctionDef(
         self, original_node: cst.FunctionDef, updated_node: cst.FunctionDef
     ) -> cst.FunctionDef:
-        self.in_classmethod = False
-        return updated_node
+        # Annotated on leaving, once the body shows whether the session is awaited
+        function = self.param_finder.leave_function()
+        to_annotate = {
+            param
+            for param in function.params
+            if not param.annotation and in_changed_lines(self.context, param)
+        }
+        if not to_annotate:
+            return updated_node
+        if function.is_async and self.async_session:
+            self.async_session_import_needed = True
+            type_name = self.async_session_type_name
+        else:
+            self.session_import_needed = True
+            type_name = self.session_type_name
+        annotation = cst.Annotation(annotation=cst.Name(value=type_name))
 
-    def leave_Param(
-        self, original_node: cst.Param, updated_node: cst.Param
-    ) -> cst.Param:
-        if (
-            self.in_classmethod
-            and updated_node.name.value in self.possible_session_names
-            and not updated_node.annotation
-        ):
-            AddImportsVisitor.add_needed_import(
-                self.context, self.import_session_from, self.session_type_name
-            )
-            return updated_node.with_changes(
-                annotation=cst.Annotation(
-                    annotation=cst.Name(value=self.session_type_name)
+        def annotate(
+            original_params: Sequence[cst.Param], updated_params: Sequence[cst.Param]
+        ) -> List[cst.Param]:
+            return [
+                (
+                    updated.with_changes(annotation=annotation)
+                    if original in to_annotate
+                    else updated
                 )
+                for original, updated in zip(original_params, updated_params)
+            ]
+
+        original_params = original_node.params
+        updated_params = updated_node.params
+        return updated_node.with_changes(
+            params=updated_params.with_changes(
+                posonly_params=annotate(
+                    original_params.posonly_params, updated_params.posonly_params
+                ),
+                params=annotate(original_params.params, updated_params.params),
+                kwonly_params=annotate(
+                    original_params.kwonly_params, updated_params.kwonly_params
+                ),
             )
-        return updated_node
+        )
@@ -0,0 +1,235 @@
+import argparse
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import libcst as cst
+from libcst.codemod import CodemodContext, VisitorBasedCodemodCommand
+from libcst.helpers import get_full_name_for_node
+
+from .profiling import profiled
+from .project_index import add_project_index_args, load_project_index
+from .sa_common import ModelDetector, add_model_detection_args
+
+# Cheap textual check for source that could contain column definitions
+column_prescreen = re.compile(r"\b(?:Column|mapped_column)\s*\(")
+
+COLUMN_FUNCTIONS = frozenset({"Column", "mapped_column"})
+
+
+@dataclass
+class ColumnSchema:
+    """
+    What a Column(...) or mapped_column(...) definition says about the table.
+    """
+
+    attribute: str
+    # The column's name in the table, if it differs from the attribute
+    name: Optional[str] = None
+    # The type as written, e.g. String(50)
+    type: Optional[str] = None
+    primary_key: bool = False
+    index: bool = False
+    unique: bool = False
+    # None unless nullable= is given as a literal
+    nullable: Optional[bool] = None
+    # Targets of the column's foreign keys, e.g. users.id
+    foreign_keys: List[str] = field(default_factory=list)
+    # Whether an index (including a unique constraint or the primary key) leads with
+    # the column, so that joins and lookups through it don't scan the table
+    indexed: bool = False
+
+
+def _last_name(node: cst.BaseExpression) -> Optional[str]:
+    name = get_full_name_for_node(node)
+    return name.rsplit(".", 1)[-1] if name is not None else None
+
+
+def _literal_bool(node: cst.BaseExpression) -> Optional[bool]:
+    if isinstance(node, cst.Name) and node.value in ("True", "False"):
+        return node.value == "True"
+    return None
+
+
+def _string_or_code(node: cst.BaseExpression) -> str:
+    if isinstance(node, cst.SimpleString):
+        return str(node.evaluated_value)
+    return cst.Module([]).code_for_node(node)
+
+
+@profiled()
+def parse_column_call(attribute: str, call: cst.Call) -> Optional[ColumnSchema]:
+    """
+    Read the schema of a column from its definition.
+    :param attribute: The attribute the column is assigned to
+    :param call: The Column(...) or mapped_column(...) call, plain or dotted (sa.Column)
+    :return: The column's schema, or None if the call isn't a column definition
+    """
+    if _last_name(call.func) not in COLUMN_FUNCTIONS:
+        return None
+    column = ColumnSchema(attribute)
+    for index, arg in enumerate(call.args):
+        value = arg.value
+        if arg.keyword is not None:
+            keyword = arg.keyword.value
+            if keyword in ("primary_key", "index", "unique"):
+                setattr(column, keyword, _literal_bool(value) is True)
+            elif keyword == "nullable":
+                column.nullable = _literal_bool(value)
+            elif keyword == "name" and isinstance(value, cst.SimpleString):
+                column.name = str(value.evaluated_value)
+        elif arg.star:
+            continue
+        elif isinstance(value, cst.Call) and _last_name(value.func) == "ForeignKey":
+            if value.args:
+                column.foreign_keys.append(_string_or_code(value.args[0].value))
+        elif index == 0 and isinstance(value, cst.SimpleString):
+            column.name = str(value.evaluated_value)
+        elif column.type is None:
+            column.type = cst.Module([]).code_for_node(value)
+    return column
+
+
+def _string_list(node: cst.BaseExpression) -> List[str]:
+    if isinstance(node, (cst.List, cst.Tuple)):
+        return [_column_reference(element.value) for element in node.elements]
+    return []
+
+
+def _column_reference(node: cst.BaseExpression) -> str:
+    # "user_id", or User.user_id / user_id in Index("ix", User.user_id)
+    if isinstance(node, cst.SimpleString):
+        return str(node.evaluated_value)
+    if isinstance(node, cst.Attribute):
+        return node.attr.value
+    return _string_or_code(node)
+
+
+def _table_args(
+    node: cst.ClassDef,
+) -> Tuple[List[List[str]], List[Tuple[List[str], List[str]]]]:
+    # The columns of each Index or UniqueConstraint in __table_args__, and the columns
+    # and targets of each ForeignKeyConstraint
+    indexes: List[List[str]] = []
+    foreign_keys: List[Tuple[List[str], List[str]]] = []
+    for stmt in node.body.body:
+        if not isinstance(stmt, cst.SimpleStatementLine):
+            continue
+        for small_stmt in stmt.body:
+            if not (
+                isinstance(small_stmt, cst.Assign)
+                and any(
+                    isinstance(target.target, cst.Name)
+                    and target.target.value == "__table_args__"
+                    for target in small_stmt.targets
+                )
+                and isinstance(small_stmt.value, cst.Tuple)
+            ):
+                continue
+            for element in small_stmt.value.elements:
+                value = element.value
+                if not isinstance(value, cst.Call):
+                    continue
+                kind = _last_name(value.func)
+                positional = [arg.value for arg in value.args if arg.keyword is None]
+                if kind == "Index":
+                    # The first argument is the index's name
+                    indexes.append([_column_reference(arg) for arg in positional[1:]])
+                elif kind in ("UniqueConstraint", "PrimaryKeyConstraint"):
+                    indexes.append([_column_reference(arg) for arg in positional])
+                elif kind == "ForeignKeyConstraint" and len(positional) >= 2:
+                    foreign_keys.append(
+                        (_string_list(positional[0]), _string_list(positional[1]))
+                    )
+    return indexes, foreign_keys
+
+
+def audit_model(node: cst.ClassDef) -> List[Tuple[cst.CSTNode, ColumnSchema]]:
+    """
+    Read the columns a model class defines, with their constraints, and work out which
+    are covered by an index.
+    :param node: The model class
+    :return: Each column's definition (the assignment) and schema, in order
+    """
+    columns: List[Tuple[cst.CSTNode, ColumnSchema]] = []
+    if not isinstance(node.body, cst.IndentedBlock):
+        return columns
+    for stmt in node.body.body:
+        if not isinstance(stmt, cst.SimpleStatementLine):
+            continue
+        for small_stmt in stmt.body:
+            if isinstance(small_stmt, cst.Assign) and len(small_stmt.targets) == 1:
+                target = small_stmt.targets[0].target
+            elif isinstance(small_stmt, cst.AnnAssign):
+                target = small_stmt.target
+            else:
+                continue
+            value = small_stmt.value
+            if not isinstance(target, cst.Name) or not isinstance(value, cst.Call):
+                continue
+            column = parse_column_call(target.value, value)
+            if column is not None:
+                columns.append((small_stmt, column))
+
+    indexes, foreign_keys = _table_args(node)
+    by_name: Dict[str, ColumnSchema] = {}
+    for _, column in columns:
+        by_name[column.attribute] = column
+        if column.name is not None:
+            by_name[column.name] = column
+    for local_columns, targets in foreign_keys:
+        for name, target in zip(local_columns, targets):
+            if name in by_name:
+                by_name[name].foreign_keys.append(target)
+
+    # Columns that an index leads with. A composite primary key's index leads with its
+    # first column.
+    leading: Set[str] = {names[0] for names in indexes if names}
+    primary_keys = [column for _, column in columns if column.primary_key]
+    for _, column in columns:
+        column.indexed = (
+            column.index
+            or column.unique
+            or bool(primary_keys)
+            and column is primary_keys[0]
+            or column.attribute in leading
+            or column.name in leading
+        )
+    return columns
+
+
+class ColumnAuditCommand(VisitorBasedCodemodCommand):
+    DESCRIPTION = (
+        "Report each model's columns, their indexes, unique and primary key constraints "
+        "and foreign keys, flagging foreign keys without an index. Read-only: run it with "
+        "the runner's --analyze (and --report)."
+    )
+
+    # Only reports, through its analyzer, and never changes code
+    READ_ONLY = True
+
+    @staticmethod
+    def add_args(arg_parser: argparse.ArgumentParser) -> None:
+        add_model_detection_args(arg_parser)
+        add_project_index_args(arg_parser)
+
+    def __init__(
+        self,
+        context: CodemodContext,
+        model_detection: str = "heuristic",
+        declarative_bases: Optional[Sequence[str]] = None,
+        project_index: Optional[str] = None,
+    ) -> None:
+        super().__init__(context)
+        self.model_detector = ModelDetector(
+            model_detection,
+            declarative_bases,
+            load_project_index(project_index) if project_index else None,
+        )
+
+    def should_transform(self, source: str) -> bool:
+        """
+        Cheaply check whether the source could contain column definitions, without
+        parsing it.
+        """
+        return column_prescreen.search(source) is not None
@@ -1,9 +1,25 @@
+import argparse
+import re
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import Optional, Sequence, Set, Tuple
+
 import libcst as cst
 import libcst.matchers as m
 from libcst.codemod import VisitorBasedCodemodCommand, CodemodContext
 from libcst.codemod.visitors import AddImportsVisitor
 
-from .sa_common import class_probably_an_sa_model
+from .failures import RecordsFailures
+from .line_ranges import in_changed_lines
+from .profiling import matches, profiled
+from .project_index import add_project_index_args, load_project_index
+from .sa_common import ModelDetector, add_model_detection_args
+from .sa_types import (
+    DEFAULT_SA_TYPES,
+    SATypeRegistry,
+    default_sa_type_registry,
+    template_fields,
+)
 
 
 column_def_matcher = m.Assign(
@@ -13,6 +29,9 @@ column_def_matcher = m.Assign(
     ),
 )
 
+# Cheap textual check for source that could contain a match for column_def_matcher
+column_def_prescreen = re.compile(r"\bColumn\s*\(")
+
 
 def match_pos_arg(**kwargs):
     return m.Arg(**kwargs, keyword=~m.Name())
@@ -43,22 +62,25 @@ column_call_with_type = m.Call(
 
 empty_call_matcher = m.Call(args=[m.AtMostN(n=0)])
 
+# The codemod resolves types with an SATypeRegistry (see sa_types.py), these are views of
+# its defaults.
 sa_type_to_py_type = {
-    "Integer": "int",
-    "String": "str",
-    "Text": "str",
-    "Date": "datetime.date",
-    "DateTime": "datetime.datetime",
-    "Boolean": "bool",
-    "Numeric": "decimal.Decimal",
-    "Float": "float",
+    name: sa_type.py_type
+    for name, sa_type in DEFAULT_SA_TYPES.items()
+    if not template_fields(sa_type.py_type)
 }
 
-unambiguously_inferable_sa_types = set(sa_type_to_py_type.keys()) - {"String", "Text"}
+unambiguously_inferable_sa_types = {
+    name for name, sa_type in DEFAULT_SA_TYPES.items() if sa_type.inferable
+}
 
-name_of_inferrable_type_matcher = m.OneOf(*[m.Name(value=sa_type) for sa_type in unambiguously_inferable_sa_types])
-name_or_empty_call_of_inferrable_type_matcher = (name_of_inferrable_type_matcher |
-                                                 m.Call(args=[m.AtMostN(n=0)], func=name_of_inferrable_type_matcher))
+name_of_inferrable_type_matcher = m.OneOf(
+    *[m.Name(value=sa_type) for sa_type in unambiguously_inferable_sa_types]
+)
+name_or_empty_call_of_inferrable_type_matcher = (
+    name_of_inferrable_type_matcher
+    | m.Call(args=[m.AtMostN(n=0)], func=name_of_inferrable_type_matcher)
+)
 
 
 # If not retained_type_in_mapped_column, pop the type from the call
@@ -74,108 +96,268 @@ call_has_nullable_true = m.Call(
     args=[
         m.AtLeastN(n=0),
         m.Arg(keyword=m.Name(value="nullable"), value=m.Name(value="True")),
-        m.AtLeastN(n=0)
+        m.AtLeastN(n=0),
     ]
 )
 call_has_nullable_false = m.Call(
     args=[
         m.AtLeastN(n=0),
         m.Arg(keyword=m.Name(value="nullable"), value=m.Name(value="False")),
-        m.AtLeastN(n=0)
+        m.AtLeastN(n=0),
     ]
 )
 call_has_primary_key_true = m.Call(
     args=[
         m.AtLeastN(n=0),
         m.Arg(keyword=m.Name(value="primary_key"), value=m.Name(value="True")),
-        m.AtLeastN(n=0)
+        m.AtLeastN(n=0),
     ]
 )
 
 
+def is_name(node: cst.BaseExpression, value: str) -> bool:
+    return isinstance(node, cst.Name) and node.value == value
+
+
+@dataclass(frozen=True, slots=True)
+class ColumnCall:
+    """
+    The parts of a Column(...) call that the codemod needs, found by a single scan of its
+    arguments (see classify_column_call).
+    """
+
+    name_arg: Optional[cst.Arg]
+    type_arg: cst.Arg
+    # Everything after the name and type args, i.e. the kwargs
+    other_args: Sequence[cst.Arg]
+    nullable_arg: Optional[cst.Arg]
+    primary_key: bool
+
+
+@profiled()
+def classify_column_call(col_call: cst.Call) -> Optional[ColumnCall]:
+    """
+    Classify a Column(...) call in one pass over its arguments. Accepts the same calls as
+    column_call_with_name_and_type and column_call_with_type, and dotted type names.
+    :param col_call: The call
+    :return: The classified call, or None if it isn't a Column call we understand
+    """
+    func = col_call.func
+    if not isinstance(func, cst.Name) or func.value != "Column":
+        return None
+
+    args = col_call.args
+    n_positional = 0
+    nullable_arg = None
+    primary_key = False
+    for index, arg in enumerate(args):
+        keyword = arg.keyword
+        if keyword is None:
+            if index != n_positional:
+                # Positional (or star) arg following a kwarg
+                return None
+            n_positional += 1
+        elif keyword.value == "nullable":
+            nullable_arg = arg
+        elif keyword.value == "primary_key":
+            primary_key = primary_key or is_name(arg.value, "True")
+
+    # Types may be dotted, e.g. sa.Integer
+    if n_positional == 2:
+        name_value = args[0].value
+        if isinstance(name_value, (cst.Name, cst.SimpleString)) and isinstance(
+            args[1].value, (cst.Name, cst.Attribute)
+        ):
+            return ColumnCall(args[0], args[1], args[2:], nullable_arg, primary_key)
+    elif n_positional == 1:
+        if isinstance(args[0].value, (cst.Name, cst.Attribute, cst.Call)):
+            return ColumnCall(None, args[0], args[1:], nullable_arg, primary_key)
+    return None
+
+
 def build_param_type(outer, inner):
     return cst.Subscript(
-        value=outer,
-        slice=[
-            cst.SubscriptElement(
-                slice=cst.Index(
-                    value=inner
-                )
-            )
-        ]
+        value=outer, slice=[cst.SubscriptElement(slice=cst.Index(value=inner))]
     )
 
 
-def must_retain_type_arg(column_type_arg: cst.Arg):
+def must_retain_type_arg(
+    column_type_arg: cst.Arg, sa_types: SATypeRegistry = default_sa_type_registry
+):
     if column_type_arg is None:
         return False
-    if m.matches(column_type_arg.value, name_or_empty_call_of_inferrable_type_matcher):
+    if sa_types.is_inferable(column_type_arg.value):
         return False
     return True
 
 
+# CST nodes are immutable, so the annotation for each (py_type, is_optional) is built once
+# and shared by every column with that type. Bounded, as the types come from the code.
+@lru_cache(maxsize=256)
 def attempt_to_build_annotation(py_type, is_optional):
     if py_type:
         annotation_type = cst.parse_expression(py_type)
         if is_optional:
-            annotation_type = build_param_type(cst.Name(value="Optional"), annotation_type)
-        mapped_annotation_type = build_param_type(cst.Name(value="Mapped"), annotation_type)
+            annotation_type = build_param_type(
+                cst.Name(value="Optional"), annotation_type
+            )
+        mapped_annotation_type = build_param_type(
+            cst.Name(value="Mapped"), annotation_type
+        )
         return cst.Annotation(annotation=mapped_annotation_type)
     else:
         return
 
 
-def replacement_assignment(node: cst.Assign):
-    col_call: cst.Call = node.value
+def replacement_assignment(
+    node: cst.Assign,
+    column: Optional[ColumnCall] = None,
+    sa_types: SATypeRegistry = default_sa_type_registry,
+):
+    new_assign, py_type, is_optional = build_replacement_assignment(
+        node, column, sa_types
+    )
+    return new_assign, py_type
 
-    explicit_column_name_arg, column_type_arg, other_args = process_column_call(col_call)
+
+def build_replacement_assignment(
+    node: cst.Assign,
+    column: Optional[ColumnCall] = None,
+    sa_types: SATypeRegistry = default_sa_type_registry,
+):
+    if column is None:
+        column = classify_column_call(node.value)
+        if column is None:
+            raise ValueError(
+                "Don't understand column definition "
+                f"{cst.Module([]).code_for_node(node.value)}"
+            )
 
     new_args = []
-    if explicit_column_name_arg:
-        new_args.append(explicit_column_name_arg)
+    if column.name_arg:
+        new_args.append(column.name_arg)
 
-    if must_retain_type_arg(column_type_arg):
-        new_args.append(column_type_arg)
+    if must_retain_type_arg(column.type_arg, sa_types):
+        new_args.append(column.type_arg)
 
-    new_args.extend(other_args)
+    new_args.extend(column.other_args)
 
-    py_type, is_optional = resolve_py_type_and_is_optional(col_call, column_type_arg)
+    py_type, is_optional = resolve_column_py_type_and_is_optional(column, sa_types)
 
     annotation = attempt_to_build_annotation(py_type, is_optional)
 
-    if annotation:
+    if annotation and column.nullable_arg is not None:
         # Remove nullable arg
-        new_args = [arg for arg in new_args if not m.matches(arg, m.Arg(keyword=m.Name(value="nullable")))]
+        new_args = [arg for arg in new_args if arg is not column.nullable_arg]
 
     if len(new_args) > 0:
-        new_args[-1] = new_args[-1].with_changes(
-            comma=cst.MaybeSentinel.DEFAULT
-        )
+        new_args[-1] = new_args[-1].with_changes(comma=cst.MaybeSentinel.DEFAULT)
     new_call = cst.Call(
         func=cst.Name(value="mapped_column"),
         args=new_args,
     )
     if annotation:
         new_assign = cst.AnnAssign(
-            target=node.targets[0].target,
-            annotation=annotation,
-            value=new_call
+            target=node.targets[0].target, annotation=annotation, value=new_call
         )
     else:
-        new_assign = node.with_changes(
-            value=new_call
-        )
-    return new_assign, py_type
+        new_assign = node.with_changes(value=new_call)
+    return new_assign, py_type, is_optional
 
 
-class ColumnToMappedCommand(VisitorBasedCodemodCommand):
-    def __init__(self, context: "CodemodContext"):
+class ColumnToMappedCommand(RecordsFailures, VisitorBasedCodemodCommand):
+    DESCRIPTION = (
+        "Convert Column(...) attributes of classes that appear to be SQLAlchemy models "
+        "to annotated mapped_column(...) calls."
+    )
+
+    @staticmethod
+    def add_args(arg_parser: argparse.ArgumentParser) -> None:
+        arg_parser.add_argument(
+            "--sa-types-file",
+            default=None,
+            help="JSON file mapping SQLAlchemy type names to Python types, added to the defaults.",
+        )
+        arg_parser.add_argument(
+            "--sa-type",
+            dest="sa_types",
+            action="append",
+            default=[],
+            metavar="NAME=PY_TYPE",
+            help="Map an SQLAlchemy type to a Python type, e.g. BigInteger=int or Enum={arg0}. "
+            "Prefix the Python type with ! if mapped_column() infers the SQLAlchemy type from it.",
+        )
+        arg_parser.add_argument(
+            "--sa-module-alias",
+            dest="sa_module_aliases",
+            action="append",
+            default=[],
+            help="Extra module or alias that SQLAlchemy types are referenced through, e.g. sqltypes.",
+        )
+        add_model_detection_args(arg_parser)
+        add_project_index_args(arg_parser)
+
+    def __init__(
+        self,
+        context: CodemodContext,
+        sa_types_file: Optional[str] = None,
+        sa_types: Sequence[str] = (),
+        sa_module_aliases: Sequence[str] = (),
+        continue_on_error: bool = False,
+        model_detection: str = "heuristic",
+        declarative_bases: Optional[Sequence[str]] = None,
+        project_index: Optional[str] = None,
+    ) -> None:
         super().__init__(context)
+        # Record and skip column definitions that aren't understood, instead of failing
+        self.continue_on_error = continue_on_error
+        self.model_detector = ModelDetector(
+            model_detection,
+            declarative_bases,
+            load_project_index(project_index) if project_index else None,
+        )
         self.in_model = False
         self.in_column_assignment = None
+        # The classified Column(...) call of in_column_assignment
+        self.column: Optional[ColumnCall] = None
+        # (module, name) pairs to import, added once the whole module has been visited
+        self.needed_imports: Set[Tuple[str, Optional[str]]] = set()
+        if sa_types_file or sa_types or sa_module_aliases:
+            self.sa_types = SATypeRegistry.from_options(
+                sa_types_file, sa_types, sa_module_aliases
+            )
+        else:
+            self.sa_types = default_sa_type_registry
+
+    def cache_fingerprint(self) -> str:
+        """
+        Identifies the type mappings in use, which may come from a file, and the models
+        found, which may depend on other files.
+        """
+        return f"{self.sa_types.fingerprint()}:{self.model_detector.fingerprint()}"
+
+    def should_transform(self, source: str) -> bool:
+        """
+        Cheaply check whether the source could contain column definitions, without parsing it.
+        """
+        return column_def_prescreen.search(source) is not None
+
+    def visit_Module(self, node: cst.Module):
+        self.needed_imports = set()
+        self.model_detector.visit_module(self.context, node)
+        return True
+
+    def leave_Module(
+        self, original_node: cst.Module, updated_node: cst.Module
+    ) -> cst.Module:
+        for module, obj in sorted(
+            self.needed_imports, key=lambda i: (i[0], i[1] or "")
+        ):
+            AddImportsVisitor.add_needed_import(self.context, module, obj)
+        return updated_node
 
     def visit_ClassDef(self, node: cst.ClassDef):
-        if m.matches(node, class_probably_an_sa_model):
+        if self.model_detector.is_model(self.context, node):
             self.in_model = True
         return True
 
@@ -187,17 +369,15 @@ class ColumnToMappedCommand(VisitorBasedCodemodCommand):
 
     def visit_Assign(self, node: cst.Assign):
         if self.in_model:
-            if m.matches(node, column_def_matcher):
+            if matches(
+                node, column_def_matcher, "column_def_matcher"
+            ) and in_changed_lines(self.context, node):
+                column = classify_column_call(node.value)
+                if column is None:
+                    self.unsupported(node, "Don't understand column definition")
+                    return True
                 self.in_column_assignment = node
-                col_call: cst.Call = node.value
-                if m.matches(col_call, column_call_with_name_and_type):
-                    self.explicit_column_name_arg = col_call.args[0]
-                    self.column_type_arg = col_call.args[1]
-                elif m.matches(col_call, column_call_with_type):
-                    self.explicit_column_name_arg = None
-                    self.column_type_arg = col_call.args[0]
-                else:
-                    raise ValueError(f"Don't understand column definition {node}")
+                self.column = column
         return True
 
     def leave_Assign(
@@ -205,38 +385,36 @@ class ColumnToMappedCommand(VisitorBasedCodemodCommand):
     ) -> cst.Assign:
         if self.in_column_assignment and self.in_column_assignment == original_node:
             self.in_column_assignment = None
-            replacement, py_type = replacement_assignment(updated_node)
-            if py_type and "." in py_type:
-                # This is not a good way to handle this.
+            replacement, py_type, is_optional = build_replacement_assignment(
+                updated_node, self.column, self.sa_types
+            )
+            self.needed_imports.add(("sqlalchemy.orm", "mapped_column"))
+            if py_type:
+                self.needed_imports.add(("sqlalchemy.orm", "Mapped"))
+                if is_optional:
+                    self.needed_imports.add(("typing", "Optional"))
                 # If we have something like Mapped[datetime.datetime], we'll add an import datetime
-                mod_name, type_name = py_type.rsplit(".", 1)
-                AddImportsVisitor.add_needed_import(self.context, mod_name)
+                for mod_name in self.sa_types.imports_for(py_type):
+                    self.needed_imports.add((mod_name, None))
             return replacement
         return updated_node
 
 
-def resolve_py_type_and_is_optional(col_call: cst.Call, column_type_arg: cst.Arg):
-    if m.matches(column_type_arg.value, m.Name()):
-        assert isinstance(column_type_arg.value, cst.Name)
-        column_type_name = column_type_arg.value.value
-    else:
-        assert isinstance(column_type_arg.value, cst.Call)
-        func = column_type_arg.value.func
-        assert isinstance(func, cst.Name)
-        column_type_name = func.value
-    py_type = sa_type_to_py_type.get(column_type_name)
+def resolve_column_py_type_and_is_optional(
+    column: ColumnCall, sa_types: SATypeRegistry = default_sa_type_registry
+):
+    py_type = sa_types.resolve(column.type_arg.value)
 
     if not py_type:
         # Can't determine the type
         return None, None
 
-    if m.matches(col_call, call_has_no_kwarg_nullable) & m.matches(col_call, call_has_primary_key_true):
-        is_optional = False
-    elif m.matches(col_call, call_has_no_kwarg_nullable):
+    nullable_value = column.nullable_arg.value if column.nullable_arg else None
+    if nullable_value is None:
+        is_optional = not column.primary_key
+    elif is_name(nullable_value, "True"):
         is_optional = True
-    elif m.matches(col_call, call_has_nullable_true):
-        is_optional = True
-    elif m.matches(col_call, call_has_nullable_false):
+    elif is_name(nullable_value, "False"):
         is_optional = False
     else:
         # Can't determine if it's optional or not
@@ -245,17 +423,22 @@ def resolve_py_type_and_is_optional(col_call: cst.Call, column_type_arg: cst.Arg
     return py_type, is_optional
 
 
-def process_column_call(col_call: cst.Call):
-    if m.matches(col_call, column_call_with_name_and_type):
-        explicit_column_name_arg = col_call.args[0]
-        column_type_arg = col_call.args[1]
-        other_args = col_call.args[2:]
-    elif m.matches(col_call, column_call_with_type):
-        explicit_column_name_arg = None
-        column_type_arg = col_call.args[0]
-        other_args = col_call.args[1:]
-    else:
-        raise ValueError(f"Don't understand column definition {col_call}")
-    return explicit_column_name_arg, column_type_arg, other_args
+def resolve_py_type_and_is_optional(col_call: cst.Call, column_type_arg: cst.Arg):
+    column = classify_column_call(col_call)
+    if column is None:
+        raise ValueError(
+            f"Don't understand column definition {cst.Module([]).code_for_node(col_call)}"
+        )
+    # The type is resolved from the given type arg, as found by process_column_call
+    return resolve_column_py_type_and_is_optional(
+        replace(column, type_arg=column_type_arg)
+    )
 
 
+def process_column_call(col_call: cst.Call):
+    column = classify_column_call(col_call)
+    if column is None:
+        raise ValueError(
+            f"Don't understand column definition {cst.Module([]).code_for_node(col_call)}"
+        )
+    return column.name_arg, column.type_arg, column.other_args
@@ -1,7 +1,38 @@
+import argparse
+import functools
+import re
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+import libcst as cst
 import libcst.matchers as m
+from libcst.codemod import CodemodContext
+from libcst.helpers import get_full_name_for_node
+from libcst.metadata import MetadataWrapper, Scope, ScopeProvider
+
+from .profiling import profiled
+
+if TYPE_CHECKING:
+    from .project_index import ProjectIndex
+
+# Column(...), or mapped_column(...) as left by ColumnToMappedCommand, which runs before
+# the other codemods when they are combined
+column_definition_matcher = m.Assign(
+    value=m.Call(func=m.Name(value="Column") | m.Name(value="mapped_column"))
+) | m.AnnAssign(value=m.Call(func=m.Name(value="mapped_column")))
 
 column_definition_line_matcher = m.SimpleStatementLine(
-    body=[m.AtLeastN(n=1, matcher=m.Assign(value=m.Call(func=m.Name(value="Column"))))]
+    body=[m.AtLeastN(n=1, matcher=column_definition_matcher)]
 )
 
 class_has_tablename_attribute_matcher = m.ClassDef(
@@ -46,3 +77,383 @@ class_has_column_definitions_matcher = m.ClassDef(
 class_probably_an_sa_model = (
     class_has_tablename_attribute_matcher | class_has_column_definitions_matcher
 )
+
+# Cheap textual check for source that could contain a class matching
+# class_probably_an_sa_model, used to skip files without parsing them.
+sa_model_prescreen = re.compile(r"__tablename__|\b(?:Column|mapped_column)\s*\(")
+
+
+def _is_column_assign(small_stmt: cst.BaseSmallStatement) -> bool:
+    if isinstance(small_stmt, cst.Assign):
+        functions = ("Column", "mapped_column")
+    elif isinstance(small_stmt, cst.AnnAssign):
+        functions = ("mapped_column",)
+    else:
+        return False
+    value = small_stmt.value
+    return (
+        isinstance(value, cst.Call)
+        and isinstance(value.func, cst.Name)
+        and value.func.value in functions
+    )
+
+
+def _is_tablename_assign(small_stmt: cst.BaseSmallStatement) -> bool:
+    if not isinstance(small_stmt, cst.Assign):
+        return False
+    for target in small_stmt.targets:
+        target = target.target
+        if not isinstance(target, cst.Name) or target.value != "__tablename__":
+            return False
+    return True
+
+
+def _is_tablename_or_column_line(stmt: cst.BaseStatement) -> bool:
+    # Like the matchers, every statement on the line has to be the same kind of assignment
+    if not isinstance(stmt, cst.SimpleStatementLine) or not stmt.body:
+        return False
+    return all(_is_column_assign(small_stmt) for small_stmt in stmt.body) or all(
+        _is_tablename_assign(small_stmt) for small_stmt in stmt.body
+    )
+
+
+@profiled()
+def is_probably_sa_model(node: cst.ClassDef) -> bool:
+    """
+    Equivalent to matching class_probably_an_sa_model, but with a single linear pass over
+    the class body that stops at the first __tablename__, Column(...) or mapped_column(...)
+    assignment.
+    :param node: The class definition
+    :return: Whether the class looks like an SQLAlchemy model
+    """
+    body = node.body
+    return isinstance(body, cst.IndentedBlock) and any(
+        _is_tablename_or_column_line(stmt) for stmt in body.body
+    )
+
+
+# How codemods decide which classes are models: "heuristic" looks for __tablename__,
+# Column(...) or mapped_column(...) in the class body, "bases" follows the class's bases
+# to a declarative base, and "either" accepts classes found by either method.
+MODEL_DETECTION_MODES = ("heuristic", "bases", "either")
+
+
+def relationship_attributes(node: cst.ClassDef) -> List[str]:
+    """
+    Find the attributes a class body assigns relationship(...) to, e.g. orders in
+    orders = relationship("Order") or orders: Mapped[List[Order]] = db.relationship(...).
+    :param node: The class definition
+    :return: The attribute names, in order
+    """
+    names = []
+    if not isinstance(node.body, cst.IndentedBlock):
+        return names
+    for stmt in node.body.body:
+        if not isinstance(stmt, cst.SimpleStatementLine):
+            continue
+        for small_stmt in stmt.body:
+            if isinstance(small_stmt, cst.Assign):
+                targets = [target.target for target in small_stmt.targets]
+            elif isinstance(small_stmt, cst.AnnAssign):
+                targets = [small_stmt.target]
+            else:
+                continue
+            value = small_stmt.value
+            if not isinstance(value, cst.Call):
+                continue
+            func_name = get_full_name_for_node(value.func)
+            if func_name is None or func_name.rsplit(".", 1)[-1] != "relationship":
+                continue
+            names.extend(
+                target.value for target in targets if isinstance(target, cst.Name)
+            )
+    return names
+
+
+# Functions that create a declarative base, e.g. Base = declarative_base()
+DECLARATIVE_BASE_FACTORIES = frozenset(
+    {
+        "sqlalchemy.orm.declarative_base",
+        "sqlalchemy.orm.decl_api.declarative_base",
+        "sqlalchemy.ext.declarative.declarative_base",
+    }
+)
+
+# Classes that a declarative base subclasses, e.g. class Base(DeclarativeBase)
+DECLARATIVE_BASE_CLASSES = frozenset(
+    {
+        "sqlalchemy.orm.DeclarativeBase",
+        "sqlalchemy.orm.DeclarativeBaseNoMeta",
+        "sqlalchemy.orm.decl_api.DeclarativeBase",
+        "sqlalchemy.orm.decl_api.DeclarativeBaseNoMeta",
+    }
+)
+
+# Declarative bases (or models) defined elsewhere, matched against the end of qualified
+# names, so db.Model matches app.db.Model (Flask-SQLAlchemy) and Base matches .base.Base.
+DEFAULT_DECLARATIVE_BASES = ("db.Model",)
+
+# Key prefix in CodemodContext.scratch for the model classes found by following bases,
+# so codemods run over the same source (see CombinedCodemodCommand) resolve them once.
+SA_MODEL_BASES_CACHE_KEY = "sa_common.model_classes"
+
+
+def add_model_detection_args(arg_parser: argparse.ArgumentParser) -> None:
+    """
+    Add the model detection options, unless another codemod already added them.
+    """
+    try:
+        arg_parser.add_argument(
+            "--model-detection",
+            choices=MODEL_DETECTION_MODES,
+            default="heuristic",
+            help="How to decide which classes are SQLAlchemy models: from __tablename__, "
+            "Column(...) or mapped_column(...) in the class body, by following the class's bases to a "
+            "declarative base, or either.",
+        )
+    except argparse.ArgumentError:
+        return
+    arg_parser.add_argument(
+        "--declarative-base",
+        dest="declarative_bases",
+        action="append",
+        default=None,
+        help="Qualified name (or its last parts) of a declarative base or model defined "
+        "in another module, whose subclasses are models with --model-detection bases. "
+        f"Defaults to {', '.join(DEFAULT_DECLARATIVE_BASES)}.",
+    )
+
+
+def add_session_name_args(arg_parser: argparse.ArgumentParser) -> None:
+    """
+    Add the session name option, unless another codemod already added it.
+    """
+    try:
+        arg_parser.add_argument(
+            "--possible-session-names",
+            nargs="+",
+            default=["session"],
+            help="The names sessions go by: parameters to annotate, and the last part of "
+            "the names of sessions queried through, e.g. session in self.session.",
+        )
+    except argparse.ArgumentError:
+        pass
+
+
+def method_call(node: cst.BaseExpression) -> Optional[Tuple[cst.Call, str]]:
+    """
+    Pick apart a method call such as query.filter(...).
+    :return: The call and the method's name, or None if the node isn't a method call
+    """
+    if (
+        isinstance(node, cst.Call)
+        and isinstance(node.func, cst.Attribute)
+        and isinstance(node.func.attr, cst.Name)
+    ):
+        return node, node.func.attr.value
+    return None
+
+
+def _matches_name(qualified_name: str, names: Iterable[str]) -> bool:
+    qualified_name = qualified_name.lstrip(".")
+    return any(
+        qualified_name == name or qualified_name.endswith("." + name) for name in names
+    )
+
+
+def find_model_classes(
+    module: cst.Module,
+    scope: Scope,
+    declarative_bases: Iterable[str] = DEFAULT_DECLARATIVE_BASES,
+    heuristic: bool = False,
+    is_external_model: Optional[Callable[[str], bool]] = None,
+) -> FrozenSet[str]:
+    """
+    Find the top-level classes of a module that are SQLAlchemy models, by following each
+    class's bases through the module to a declarative base. Mixins and abstract bases of
+    models count as models too, as their columns are mapped by the models.
+    :param module: The module
+    :param scope: The module's global scope, from ScopeProvider
+    :param declarative_bases: Declarative bases defined in other modules
+    :param heuristic: Also take classes that is_probably_sa_model() accepts as models,
+        so that their subclasses are models too
+    :param is_external_model: Decides whether a base that isn't a class of this module,
+        given by its qualified name, is a model defined elsewhere (see ProjectIndex)
+    :return: The names of the model classes
+    """
+    classes: Dict[str, cst.ClassDef] = {}
+    # Local names bound to a declarative base, e.g. by Base = declarative_base()
+    declarative: Set[str] = set()
+    for stmt in module.body:
+        if isinstance(stmt, cst.ClassDef):
+            classes[stmt.name.value] = stmt
+        elif isinstance(stmt, cst.SimpleStatementLine):
+            for small_stmt in stmt.body:
+                if (
+                    isinstance(small_stmt, cst.Assign)
+                    and isinstance(small_stmt.value, cst.Call)
+                    and any(
+                        name.name in DECLARATIVE_BASE_FACTORIES
+                        for name in scope.get_qualified_names_for(small_stmt.value.func)
+                    )
+                ):
+                    for target in small_stmt.targets:
+                        if isinstance(target.target, cst.Name):
+                            declarative.add(target.target.value)
+
+    # Qualified names of each class's bases, local names being the names of classes.
+    # Names that aren't bound in the module (e.g. star imports) are taken as written.
+    bases: Dict[str, List[str]] = {}
+    for name, node in classes.items():
+        bases[name] = []
+        for arg in node.bases:
+            qualified_names = scope.get_qualified_names_for(arg.value)
+            if qualified_names:
+                bases[name].extend(
+                    qualified_name.name for qualified_name in qualified_names
+                )
+            else:
+                written = get_full_name_for_node(arg.value)
+                if written is not None:
+                    bases[name].append(written)
+    for name, base_names in bases.items():
+        if any(base in DECLARATIVE_BASE_CLASSES for base in base_names):
+            declarative.add(name)
+
+    # Whether a name resolves to a declarative base or a model, memoised so each chain of
+    # bases is only followed once
+    mapped: Dict[str, bool] = {}
+
+    def is_mapped(name: str) -> bool:
+        result = mapped.get(name)
+        if result is None:
+            # Guards against cycles
+            mapped[name] = False
+            result = (
+                name in declarative
+                or _matches_name(name, declarative_bases)
+                or name not in classes
+                and is_external_model is not None
+                and is_external_model(name)
+                or name in classes
+                and (
+                    heuristic
+                    and is_probably_sa_model(classes[name])
+                    or any(is_mapped(base) for base in bases[name])
+                )
+            )
+            mapped[name] = result
+        return result
+
+    models = {name for name in classes if name not in declarative and is_mapped(name)}
+    # Local mixins and abstract bases of models
+    pending = list(models)
+    while pending:
+        for base in bases[pending.pop()]:
+            if base in classes and base not in models and base not in declarative:
+                models.add(base)
+                pending.append(base)
+    return frozenset(models)
+
+
+class ModelDetector:
+    """
+    Decides which classes codemods treat as SQLAlchemy models, in one of the
+    MODEL_DETECTION_MODES. Following bases needs scope metadata, which is only resolved
+    when that mode is used, and the models found are shared by codemods through
+    CodemodContext.scratch so that each module is resolved once. With a project index,
+    bases imported from other modules are followed through the index too.
+    """
+
+    def __init__(
+        self,
+        model_detection: str = "heuristic",
+        declarative_bases: Optional[Sequence[str]] = None,
+        project_index: Optional["ProjectIndex"] = None,
+    ) -> None:
+        if model_detection not in MODEL_DETECTION_MODES:
+            raise ValueError(f"Unknown model detection mode {model_detection!r}")
+        self.model_detection = model_detection
+        self.declarative_bases = tuple(declarative_bases or DEFAULT_DECLARATIVE_BASES)
+        self.project_index = project_index
+        self.cache_key = ":".join(
+            (
+                SA_MODEL_BASES_CACHE_KEY,
+                model_detection,
+                "index" if project_index is not None else "",
+                *self.declarative_bases,
+            )
+        )
+        # Names of model classes, and the top-level classes they are looked up for
+        self.model_classes: FrozenSet[str] = frozenset()
+        self.top_level_classes: Set[cst.ClassDef] = set()
+        # Whether each class of the current module is a model, as codemods ask about the
+        # same classes repeatedly. Cleared for each module, as nodes hash by identity.
+        self._models_by_node: Dict[cst.ClassDef, bool] = {}
+
+    def visit_module(self, context: CodemodContext, module: cst.Module) -> None:
+        """
+        Prepare to detect models in a module, before any of its classes are visited.
+        """
+        self._models_by_node = {}
+        if self.model_detection == "heuristic":
+            return
+        self.top_level_classes = {
+            stmt for stmt in module.body if isinstance(stmt, cst.ClassDef)
+        }
+        model_classes = context.scratch.get(self.cache_key)
+        if model_classes is None:
+            wrapper = context.wrapper
+            if wrapper is None or wrapper.module is not module:
+                wrapper = MetadataWrapper(module, unsafe_skip_copy=True)
+            scope = wrapper.resolve(ScopeProvider)[module]
+            model_classes = find_model_classes(
+                module,
+                scope,
+                self.declarative_bases,
+                heuristic=self.model_detection == "either",
+                is_external_model=self._external_model_check(context),
+            )
+            context.scratch[self.cache_key] = model_classes
+        self.model_classes = model_classes
+
+    def _external_model_check(
+        self, context: CodemodContext
+    ) -> Optional[Callable[[str], bool]]:
+        if self.project_index is None or context.filename is None:
+            return None
+        entry = self.project_index.file_for(context.filename)
+        if entry is None:
+            return None
+        return functools.partial(
+            self.project_index.is_model,
+            package=entry.package,
+            declarative_bases=self.declarative_bases,
+        )
+
+    def fingerprint(self) -> str:
+        """
+        Identifies the models this detector finds, for use in cache keys: with a project
+        index they (and the models codemods look up in it) depend on other files.
+        """
+        if self.project_index is None:
+            return self.cache_key
+        return f"{self.cache_key}:{self.project_index.fingerprint()}"
+
+    def is_model(self, context: CodemodContext, node: cst.ClassDef) -> bool:
+        """
+        Whether a class is a model.
+        """
+        result = self._models_by_node.get(node)
+        if result is None:
+            result = self._is_model(node)
+            self._models_by_node[node] = result
+        return result
+
+    def _is_model(self, node: cst.ClassDef) -> bool:
+        if self.model_detection != "heuristic":
+            if node in self.top_level_classes and node.name.value in self.model_classes:
+                return True
+            if self.model_detection == "bases":
+                return False
+        return is_probably_sa_model(node)
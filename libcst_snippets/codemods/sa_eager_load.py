@@ -0,0 +1,442 @@
+import argparse
+import re
+from dataclasses import dataclass
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+import libcst as cst
+import libcst.matchers as m
+from libcst.codemod import VisitorBasedCodemodCommand, CodemodContext
+from libcst.codemod.visitors import AddImportsVisitor
+from libcst.helpers import get_full_name_for_node
+
+from .line_ranges import in_changed_lines
+from .profiling import profiled
+from .project_index import add_project_index_args, load_project_index
+from .sa_common import (
+    ModelDetector,
+    add_model_detection_args,
+    add_session_name_args,
+    method_call,
+    relationship_attributes,
+)
+from .sa_query_to_select import CHAIN_METHODS
+
+before = """
+class User(Base):
+    __tablename__ = "users"
+    orders = relationship("Order")
+
+
+def order_counts(session):
+    users = session.query(User).filter(User.active).all()
+    return {user.name: len(user.orders) for user in users}
+"""
+
+after = """
+from sqlalchemy.orm import selectinload
+
+class User(Base):
+    __tablename__ = "users"
+    orders = relationship("Order")
+
+
+def order_counts(session):
+    users = session.query(User).options(selectinload(User.orders)).filter(User.active).all()
+    return {user.name: len(user.orders) for user in users}
+"""
+
+# Cheap textual check for source that could contain a query and a relationship
+query_prescreen = re.compile(r"\.\s*(?:query|scalars)\s*\(")
+relationship_prescreen = re.compile(r"\brelationship\s*\(")
+
+# Methods of Query and Select that can come between the query and iterating it
+_SELECT_METHODS = frozenset(CHAIN_METHODS.values())
+
+Comprehension = Union[cst.ListComp, cst.SetComp, cst.GeneratorExp, cst.DictComp]
+
+
+@dataclass(frozen=True)
+class QuerySite:
+    """
+    A query of a single entity: session.query(X)... or session.scalars(select(X)...).
+    """
+
+    # The query(X) or select(X) call, which loader options are added after
+    root: cst.Call
+    target: cst.BaseExpression
+    # "query" or "select"
+    style: str
+    # Relationships the query already loads through options(...)
+    loaded: FrozenSet[str]
+
+
+@dataclass(frozen=True)
+class NPlusOneSite:
+    """
+    A query whose results are iterated over, accessing relationships that would each be
+    lazy loaded with a query per row.
+    """
+
+    query: QuerySite
+    # The for loop or comprehension
+    loop: cst.CSTNode
+    relationships: Tuple[str, ...]
+
+
+def _single_arg(call: cst.Call) -> Optional[cst.BaseExpression]:
+    if len(call.args) != 1 or call.args[0].keyword is not None or call.args[0].star:
+        return None
+    return call.args[0].value
+
+
+def _is_session(node: cst.BaseExpression, session_names: FrozenSet[str]) -> bool:
+    name = get_full_name_for_node(node)
+    return name is not None and name.rsplit(".", 1)[-1] in session_names
+
+
+def _loaded_attributes(option_calls: Sequence[cst.Call]) -> FrozenSet[str]:
+    # Attributes named in options(...), e.g. orders in options(joinedload(User.orders))
+    return frozenset(
+        attribute.attr.value
+        for call in option_calls
+        for arg in call.args
+        for attribute in m.findall(arg, m.Attribute(attr=m.Name()))
+        if isinstance(attribute, cst.Attribute)
+    )
+
+
+@profiled()
+def parse_query_site(
+    node: cst.BaseExpression, session_names: FrozenSet[str]
+) -> Optional[QuerySite]:
+    """
+    Recognise an expression whose value iterates over the rows of a query of one entity,
+    e.g. session.query(User).filter(...).all() or session.scalars(select(User)).
+    :param node: The expression
+    :param session_names: Names sessions go by, matched against the last part of the
+        receiver's name
+    :return: The query, or None if it isn't one
+    """
+    call = method_call(node)
+    if call is not None and call[1] == "all" and not node.args:
+        node = node.func.value
+        call = method_call(node)
+    options: List[cst.Call] = []
+    if call is not None and call[1] == "scalars":
+        if not _is_session(node.func.value, session_names):
+            return None
+        node = _single_arg(node)
+        style, root_name, methods = "select", "select", _SELECT_METHODS
+    else:
+        style, root_name, methods = "query", "query", frozenset(CHAIN_METHODS)
+    while True:
+        if node is None:
+            return None
+        if (
+            style == "select"
+            and isinstance(node, cst.Call)
+            and m.matches(node.func, m.Name(root_name))
+        ):
+            break
+        call = method_call(node)
+        if call is None:
+            return None
+        if call[1] == root_name and style == "query":
+            if not _is_session(node.func.value, session_names):
+                return None
+            break
+        if call[1] not in methods:
+            return None
+        if call[1] == "options":
+            options.append(node)
+        node = node.func.value
+    target = _single_arg(node)
+    if target is None:
+        return None
+    return QuerySite(node, target, style, _loaded_attributes(options))
+
+
+def _accessed_attributes(nodes: Sequence[cst.CSTNode], name: str) -> Set[str]:
+    matcher = m.Attribute(value=m.Name(name), attr=m.Name())
+    return {
+        attribute.attr.value
+        for node in nodes
+        for attribute in m.findall(node, matcher)
+        if isinstance(attribute, cst.Attribute)
+    }
+
+
+class NPlusOneFinder(cst.CSTVisitor):
+    """
+    Finds queries whose rows are iterated over (directly, or through a variable assigned
+    the query in the same function) by a for loop or comprehension that accesses
+    relationships of the queried model through the loop variable.
+    """
+
+    def __init__(
+        self,
+        session_names: FrozenSet[str],
+        relationships_of: Callable[
+            [cst.BaseExpression, Optional[cst.ClassDef]], Sequence[str]
+        ],
+    ) -> None:
+        super().__init__()
+        self.session_names = session_names
+        # Relationships of a queried entity, given the innermost enclosing class
+        self.relationships_of = relationships_of
+        self.sites: List[NPlusOneSite] = []
+        self.classes: List[cst.ClassDef] = []
+        # Variables assigned queries in each enclosing function (or the module)
+        self.variables: List[Dict[str, QuerySite]] = [{}]
+
+    def visit_ClassDef(self, node: cst.ClassDef) -> bool:
+        self.classes.append(node)
+        self.variables.append({})
+        return True
+
+    def leave_ClassDef(self, original_node: cst.ClassDef) -> None:
+        self.classes.pop()
+        self.variables.pop()
+
+    def visit_FunctionDef(self, node: cst.FunctionDef) -> bool:
+        self.variables.append({})
+        return True
+
+    def leave_FunctionDef(self, original_node: cst.FunctionDef) -> None:
+        self.variables.pop()
+
+    def visit_Assign(self, node: cst.Assign) -> bool:
+        for target in node.targets:
+            if isinstance(target.target, cst.Name):
+                query = parse_query_site(node.value, self.session_names)
+                if query is not None:
+                    self.variables[-1][target.target.value] = query
+                else:
+                    self.variables[-1].pop(target.target.value, None)
+        return True
+
+    def _iterated_query(self, node: cst.BaseExpression) -> Optional[QuerySite]:
+        if isinstance(node, cst.Name):
+            return self.variables[-1].get(node.value)
+        return parse_query_site(node, self.session_names)
+
+    def _check_loop(
+        self,
+        loop: cst.CSTNode,
+        iterated: cst.BaseExpression,
+        target: cst.BaseExpression,
+        body: Sequence[cst.CSTNode],
+    ) -> None:
+        if not isinstance(target, cst.Name):
+            return
+        query = self._iterated_query(iterated)
+        if query is None:
+            return
+        relationships = self.relationships_of(
+            query.target, self.classes[-1] if self.classes else None
+        )
+        if not relationships:
+            return
+        accessed = _accessed_attributes(body, target.value)
+        lazy = tuple(
+            name
+            for name in relationships
+            if name in accessed and name not in query.loaded
+        )
+        if lazy:
+            self.sites.append(NPlusOneSite(query, loop, lazy))
+
+    def visit_For(self, node: cst.For) -> bool:
+        self._check_loop(node, node.iter, node.target, [node.body])
+        return True
+
+    def _visit_comprehension(self, node: Comprehension) -> bool:
+        for_in = node.for_in
+        if for_in.inner_for_in is None:
+            if isinstance(node, cst.DictComp):
+                body = [node.key, node.value, *for_in.ifs]
+            else:
+                body = [node.elt, *for_in.ifs]
+            self._check_loop(node, for_in.iter, for_in.target, body)
+        return True
+
+    def visit_ListComp(self, node: cst.ListComp) -> bool:
+        return self._visit_comprehension(node)
+
+    def visit_SetComp(self, node: cst.SetComp) -> bool:
+        return self._visit_comprehension(node)
+
+    def visit_GeneratorExp(self, node: cst.GeneratorExp) -> bool:
+        return self._visit_comprehension(node)
+
+    def visit_DictComp(self, node: cst.DictComp) -> bool:
+        return self._visit_comprehension(node)
+
+
+class EagerLoadRelationshipsCommand(VisitorBasedCodemodCommand):
+    DESCRIPTION = (
+        "Add selectinload(...) options to queries whose rows are iterated over while "
+        "accessing relationships, which would otherwise be lazy loaded one row at a time."
+    )
+
+    @staticmethod
+    def add_args(arg_parser: argparse.ArgumentParser) -> None:
+        add_session_name_args(arg_parser)
+        add_model_detection_args(arg_parser)
+        add_project_index_args(arg_parser)
+
+    def __init__(
+        self,
+        context: CodemodContext,
+        possible_session_names: Sequence[str] = ("session",),
+        model_detection: str = "heuristic",
+        declarative_bases: Optional[Sequence[str]] = None,
+        project_index: Optional[str] = None,
+    ) -> None:
+        super().__init__(context)
+        self.session_names = frozenset(possible_session_names)
+        self.project_index = (
+            load_project_index(project_index) if project_index else None
+        )
+        self.model_detector = ModelDetector(
+            model_detection, declarative_bases, self.project_index
+        )
+        # Top-level classes of the module, by name
+        self.module_classes: Dict[str, cst.ClassDef] = {}
+        # Relationships to load, by the query(X) or select(X) call of the original tree
+        self.eager_loads: Dict[cst.Call, Tuple[cst.BaseExpression, List[str]]] = {}
+        self.selectinload_import_needed = False
+
+    def cache_fingerprint(self) -> str:
+        """
+        Identifies the models found, which may depend on other files.
+        """
+        return self.model_detector.fingerprint()
+
+    def should_transform(self, source: str) -> bool:
+        """
+        Cheaply check whether the source could contain a query, without parsing it.
+        Relationships are only looked for in the source without a project index.
+        """
+        return query_prescreen.search(source) is not None and (
+            self.project_index is not None
+            or relationship_prescreen.search(source) is not None
+        )
+
+    def _class_relationships(self, node: cst.ClassDef, seen: Set[str]) -> List[str]:
+        if node.name.value in seen:
+            return []
+        seen.add(node.name.value)
+        names = relationship_attributes(node)
+        for arg in node.bases:
+            base = get_full_name_for_node(arg.value)
+            if base is None:
+                continue
+            for name in self._relationships_of_name(base, seen):
+                if name not in names:
+                    names.append(name)
+        return names
+
+    def _relationships_of_name(self, name: str, seen: Set[str]) -> List[str]:
+        if name in self.module_classes:
+            return self._class_relationships(self.module_classes[name], seen)
+        if self.project_index is None or self.context.filename is None:
+            return []
+        qualified_name = self.project_index.qualify(self.context.filename, name)
+        if qualified_name is None:
+            return []
+        return self.project_index.relationships(qualified_name)
+
+    def relationships_of(
+        self, target: cst.BaseExpression, enclosing_class: Optional[cst.ClassDef]
+    ) -> List[str]:
+        """
+        The relationships of a queried model: cls in a model, a model class of this
+        module, or (with a project index) a model imported from elsewhere in the project.
+        """
+        if isinstance(target, cst.Name) and target.value == "cls":
+            if enclosing_class is None or not self.model_detector.is_model(
+                self.context, enclosing_class
+            ):
+                return []
+            return self._class_relationships(enclosing_class, set())
+        name = get_full_name_for_node(target)
+        if name is None:
+            return []
+        if name in self.module_classes and not self.model_detector.is_model(
+            self.context, self.module_classes[name]
+        ):
+            return []
+        return self._relationships_of_name(name, set())
+
+    def find_sites(self, module: cst.Module) -> List[NPlusOneSite]:
+        """
+        Find the N+1 sites of a module.
+        """
+        self.model_detector.visit_module(self.context, module)
+        self.module_classes = {
+            stmt.name.value: stmt
+            for stmt in module.body
+            if isinstance(stmt, cst.ClassDef)
+        }
+        finder = NPlusOneFinder(self.session_names, self.relationships_of)
+        module.visit(finder)
+        return finder.sites
+
+    def visit_Module(self, node: cst.Module):
+        self.selectinload_import_needed = False
+        self.eager_loads = {}
+        for site in self.find_sites(node):
+            if not in_changed_lines(self.context, site.loop):
+                continue
+            _, names = self.eager_loads.setdefault(
+                site.query.root, (site.query.target, [])
+            )
+            names.extend(name for name in site.relationships if name not in names)
+        return True
+
+    def leave_Module(
+        self, original_node: cst.Module, updated_node: cst.Module
+    ) -> cst.Module:
+        if self.selectinload_import_needed:
+            AddImportsVisitor.add_needed_import(
+                self.context, "sqlalchemy.orm", "selectinload"
+            )
+        return updated_node
+
+    def leave_Call(
+        self, original_node: cst.Call, updated_node: cst.Call
+    ) -> cst.BaseExpression:
+        eager_load = self.eager_loads.get(original_node)
+        if eager_load is None:
+            return updated_node
+        target, names = eager_load
+        self.selectinload_import_needed = True
+        return cst.Call(
+            func=cst.Attribute(value=updated_node, attr=cst.Name("options")),
+            args=[
+                cst.Arg(
+                    value=cst.Call(
+                        func=cst.Name("selectinload"),
+                        args=[
+                            cst.Arg(
+                                value=cst.Attribute(
+                                    value=target.deep_clone(), attr=cst.Name(name)
+                                )
+                            )
+                        ],
+                    )
+                )
+                for name in names
+            ],
+        )
@@ -0,0 +1,300 @@
+import argparse
+import re
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import libcst as cst
+import libcst.matchers as m
+from libcst.codemod import VisitorBasedCodemodCommand, CodemodContext
+from libcst.codemod.visitors import AddImportsVisitor
+from libcst.helpers import get_full_name_for_node
+
+from .line_ranges import in_changed_lines
+from .profiling import profiled
+from .project_index import add_project_index_args, load_project_index
+from .sa_common import (
+    ModelDetector,
+    add_model_detection_args,
+    add_session_name_args,
+    method_call,
+)
+
+before = """
+class MyModel(Base):
+    __tablename__ = "mymodels"
+    archived = Column(Boolean, default=False)
+
+    @classmethod
+    def get_active(cls, session):
+        return session.query(cls).filter(cls.archived.is_(False)).all()
+
+    @classmethod
+    def get_first(cls, session):
+        return session.query(cls).first()
+"""
+
+after = """
+from sqlalchemy import select
+
+class MyModel(Base):
+    __tablename__ = "mymodels"
+    archived = Column(Boolean, default=False)
+
+    @classmethod
+    def get_active(cls, session):
+        return session.scalars(select(cls).where(cls.archived.is_(False))).all()
+
+    @classmethod
+    def get_first(cls, session):
+        return session.scalars(select(cls).limit(1)).first()
+"""
+
+# Query methods that end a chain, and the Result method each becomes. first() also limits
+# the select to one row, as Query.first() does.
+TERMINAL_METHODS = {
+    "all": "all",
+    "first": "first",
+    "one": "one",
+    "one_or_none": "one_or_none",
+}
+
+# Query methods in a chain, and the Select method each becomes
+CHAIN_METHODS = {
+    "filter": "where",
+    "where": "where",
+    "filter_by": "filter_by",
+    "order_by": "order_by",
+    "limit": "limit",
+    "offset": "offset",
+    "join": "join",
+    "outerjoin": "outerjoin",
+    "options": "options",
+    "distinct": "distinct",
+}
+
+# Chain methods after which the rows need de-duplicating with .unique(). Query did this
+# itself for single entities, whereas Result doesn't, and raises for joined eager loads of
+# collections without it.
+UNIQUE_METHODS = frozenset({"options", "join", "outerjoin"})
+
+# Cheap textual check for source that could contain a query
+query_prescreen = re.compile(r"\.\s*query\s*\(")
+
+
+@dataclass(frozen=True)
+class QueryChain:
+    """
+    A session.query(X)...all() chain, from the session to the terminal call.
+    """
+
+    session: cst.BaseExpression
+    # The queried entity, e.g. cls or User
+    target: cst.BaseExpression
+    # The calls between query() and the terminal call, innermost first
+    steps: Tuple[cst.Call, ...]
+    terminal: str
+
+    @property
+    def needs_unique(self) -> bool:
+        return any(step.func.attr.value in UNIQUE_METHODS for step in self.steps)
+
+
+@profiled()
+def parse_query_chain(
+    node: cst.Call, session_names: FrozenSet[str]
+) -> Optional[QueryChain]:
+    """
+    Pick apart a call ending a chain of Query methods on a session, e.g.
+    session.query(User).filter(User.active).all().
+    :param node: The call of the terminal method
+    :param session_names: Names sessions go by, matched against the last part of the
+        receiver's name (e.g. session for self.session)
+    :return: The chain, or None if it isn't one (or uses methods that aren't supported)
+    """
+    terminal = method_call(node)
+    if terminal is None or terminal[1] not in TERMINAL_METHODS or node.args:
+        return None
+    steps: List[cst.Call] = []
+    current = node.func.value
+    while True:
+        call = method_call(current)
+        if call is None:
+            return None
+        call_node, method = call
+        if method == "query":
+            break
+        if method not in CHAIN_METHODS:
+            return None
+        steps.append(call_node)
+        current = call_node.func.value
+
+    session = call_node.func.value
+    session_name = get_full_name_for_node(session)
+    if session_name is None or session_name.rsplit(".", 1)[-1] not in session_names:
+        return None
+    # Querying several entities or columns returns rows, not scalars
+    if len(call_node.args) != 1:
+        return None
+    arg = call_node.args[0]
+    if arg.keyword is not None or arg.star:
+        return None
+    return QueryChain(session, arg.value, tuple(reversed(steps)), terminal[1])
+
+
+def _clean_dot(dot: cst.Dot) -> cst.Dot:
+    # Line breaks between steps are dropped, as the steps move inside scalars(...),
+    # unless they carry a comment
+    return dot if m.findall(dot, m.Comment()) else cst.Dot()
+
+
+def build_scalars_call(chain: QueryChain) -> cst.Call:
+    """
+    Build session.scalars(select(X)...), the 2.0 style equivalent of a query chain
+    without its terminal call.
+    """
+    select: cst.BaseExpression = cst.Call(
+        func=cst.Name("select"), args=[cst.Arg(value=chain.target)]
+    )
+    for step in chain.steps:
+        func = step.func
+        select = step.with_changes(
+            func=func.with_changes(
+                value=select,
+                attr=cst.Name(CHAIN_METHODS[func.attr.value]),
+                dot=_clean_dot(func.dot),
+            )
+        )
+    if chain.terminal == "first":
+        select = cst.Call(
+            func=cst.Attribute(value=select, attr=cst.Name("limit")),
+            args=[cst.Arg(value=cst.Integer("1"))],
+        )
+    return cst.Call(
+        func=cst.Attribute(value=chain.session, attr=cst.Name("scalars")),
+        args=[cst.Arg(value=select)],
+    )
+
+
+class QueryToSelectCommand(VisitorBasedCodemodCommand):
+    DESCRIPTION = (
+        "Rewrite legacy session.query(Model).filter(...).all()/first()/one() chains to "
+        "2.0 style session.scalars(select(Model).where(...)) calls."
+    )
+
+    @staticmethod
+    def add_args(arg_parser: argparse.ArgumentParser) -> None:
+        add_session_name_args(arg_parser)
+        add_model_detection_args(arg_parser)
+        add_project_index_args(arg_parser)
+
+    def __init__(
+        self,
+        context: CodemodContext,
+        possible_session_names: Sequence[str] = ("session",),
+        model_detection: str = "heuristic",
+        declarative_bases: Optional[Sequence[str]] = None,
+        project_index: Optional[str] = None,
+    ) -> None:
+        super().__init__(context)
+        self.session_names = frozenset(possible_session_names)
+        self.project_index = (
+            load_project_index(project_index) if project_index else None
+        )
+        self.model_detector = ModelDetector(
+            model_detection, declarative_bases, self.project_index
+        )
+        # Top-level classes of the module, by name
+        self.module_classes: Dict[str, cst.ClassDef] = {}
+        # Whether each enclosing class is a model
+        self.enclosing_models: List[bool] = []
+        self.select_import_needed = False
+
+    def cache_fingerprint(self) -> str:
+        """
+        Identifies the models found, which may depend on other files.
+        """
+        return self.model_detector.fingerprint()
+
+    def should_transform(self, source: str) -> bool:
+        """
+        Cheaply check whether the source could contain a query, without parsing it.
+        """
+        return query_prescreen.search(source) is not None
+
+    def enter_module(self, node: cst.Module) -> None:
+        self.model_detector.visit_module(self.context, node)
+        self.module_classes = {
+            stmt.name.value: stmt
+            for stmt in node.body
+            if isinstance(stmt, cst.ClassDef)
+        }
+        self.enclosing_models = []
+
+    def enter_class(self, node: cst.ClassDef) -> None:
+        self.enclosing_models.append(self.model_detector.is_model(self.context, node))
+
+    def leave_class(self) -> None:
+        self.enclosing_models.pop()
+
+    def is_model_target(self, target: cst.BaseExpression) -> bool:
+        """
+        Whether a queried entity is a model, so the query can become a select of scalars:
+        cls in a model, a model class of this module, or (with a project index)
+        a model imported from elsewhere in the project.
+        """
+        if isinstance(target, cst.Name) and target.value == "cls":
+            return bool(self.enclosing_models) and self.enclosing_models[-1]
+        name = get_full_name_for_node(target)
+        if name is None:
+            return False
+        if name in self.module_classes:
+            return self.model_detector.is_model(self.context, self.module_classes[name])
+        if self.project_index is None or self.context.filename is None:
+            return False
+        qualified_name = self.project_index.qualify(self.context.filename, name)
+        return qualified_name is not None and self.project_index.is_model(
+            qualified_name, declarative_bases=self.model_detector.declarative_bases
+        )
+
+    def visit_Module(self, node: cst.Module):
+        self.select_import_needed = False
+        self.enter_module(node)
+        return True
+
+    def leave_Module(
+        self, original_node: cst.Module, updated_node: cst.Module
+    ) -> cst.Module:
+        if self.select_import_needed:
+            AddImportsVisitor.add_needed_import(self.context, "sqlalchemy", "select")
+        return updated_node
+
+    def visit_ClassDef(self, node: cst.ClassDef):
+        self.enter_class(node)
+        return True
+
+    def leave_ClassDef(
+        self, original_node: cst.ClassDef, updated_node: cst.ClassDef
+    ) -> cst.ClassDef:
+        self.leave_class()
+        return updated_node
+
+    def leave_Call(
+        self, original_node: cst.Call, updated_node: cst.Call
+    ) -> cst.BaseExpression:
+        chain = parse_query_chain(updated_node, self.session_names)
+        if (
+            chain is None
+            or not self.is_model_target(chain.target)
+            or not in_changed_lines(self.context, original_node)
+        ):
+            return updated_node
+        self.select_import_needed = True
+        result = build_scalars_call(chain)
+        if chain.needs_unique:
+            result = cst.Call(func=cst.Attribute(value=result, attr=cst.Name("unique")))
+        return updated_node.with_changes(
+            func=updated_node.func.with_changes(
+                value=result,
+                attr=cst.Name(TERMINAL_METHODS[chain.terminal]),
+            )
+        )
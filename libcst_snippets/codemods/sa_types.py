@@ -0,0 +1,242 @@
+import hashlib
+import json
+import re
+import string
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, Mapping, Optional, Sequence, Tuple
+
+import libcst as cst
+from libcst.helpers import get_full_name_for_node
+
+
+@dataclass(frozen=True)
+class SAType:
+    """
+    How to annotate a column of an SQLAlchemy type.
+
+    py_type is the Python type to use in Mapped[...]. It may refer to the type's positional
+    arguments: {arg0} is replaced with the first argument as written (e.g. the enum class
+    in Enum(Status)), and {py0} with the Python type of the first argument if it is
+    itself an SQLAlchemy type (e.g. the int in ARRAY(Integer)).
+
+    inferable is True if mapped_column() infers exactly this SQLAlchemy type from the
+    annotation, so the type can be dropped from the call when it has no arguments.
+    """
+
+    py_type: str
+    inferable: bool = False
+
+
+DEFAULT_SA_TYPES: Dict[str, SAType] = {
+    "Integer": SAType("int", inferable=True),
+    # A str annotation would lose the length, so these are always kept
+    "String": SAType("str"),
+    "Text": SAType("str"),
+    "Date": SAType("datetime.date", inferable=True),
+    "DateTime": SAType("datetime.datetime", inferable=True),
+    "Boolean": SAType("bool", inferable=True),
+    "Numeric": SAType("decimal.Decimal", inferable=True),
+    "Float": SAType("float", inferable=True),
+    "BigInteger": SAType("int"),
+    "SmallInteger": SAType("int"),
+    "Time": SAType("datetime.time", inferable=True),
+    "Interval": SAType("datetime.timedelta", inferable=True),
+    "LargeBinary": SAType("bytes", inferable=True),
+    "Uuid": SAType("uuid.UUID", inferable=True),
+    "UUID": SAType("uuid.UUID"),
+    "JSON": SAType("typing.Any"),
+    "Enum": SAType("{arg0}"),
+    "ARRAY": SAType("list[{py0}]"),
+}
+
+# Modules (or aliases of them) that SQLAlchemy types are commonly referenced through,
+# e.g. sa.Integer or db.Integer with Flask-SQLAlchemy.
+DEFAULT_SA_MODULE_ALIASES = (
+    "sa",
+    "sqlalchemy",
+    "sqlalchemy.types",
+    "db",
+)
+
+_dotted_name_re = re.compile(r"[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)+")
+
+
+def template_fields(template: str) -> FrozenSet[str]:
+    return frozenset(
+        field for _, field, _, _ in string.Formatter().parse(template) if field
+    )
+
+
+def _template_imports(template: str) -> FrozenSet[str]:
+    # Modules to import for dotted names written in the template itself. Names that
+    # come from the column's own arguments are already available in the module.
+    literal = "".join(text for text, _, _, _ in string.Formatter().parse(template))
+    return frozenset(
+        name.rsplit(".", 1)[0] for name in _dotted_name_re.findall(literal)
+    )
+
+
+def parse_sa_type_option(option: str) -> Tuple[str, SAType]:
+    """
+    Parse a NAME=PY_TYPE option, e.g. "BigInteger=int". Prefix the Python type with "!" if
+    mapped_column() can infer the SQLAlchemy type from it.
+    """
+    name, sep, py_type = option.partition("=")
+    if not sep or not name or not py_type:
+        raise ValueError(f"Expected NAME=PY_TYPE, got {option!r}")
+    inferable = py_type.startswith("!")
+    return name.strip(), SAType(py_type.lstrip("!").strip(), inferable=inferable)
+
+
+def load_sa_types_file(path: str) -> Dict[str, SAType]:
+    """
+    Load type mappings from a JSON file, an object whose keys are SQLAlchemy type names and
+    whose values are either a Python type or an object with "py_type" and "inferable" keys.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    sa_types = {}
+    for name, value in data.items():
+        if isinstance(value, str):
+            sa_types[name] = SAType(value)
+        else:
+            sa_types[name] = SAType(
+                value["py_type"], bool(value.get("inferable", False))
+            )
+    return sa_types
+
+
+@dataclass(frozen=True)
+class _CompiledSAType:
+    py_type: str
+    inferable: bool
+    # Placeholders in py_type, e.g. {"arg0"}
+    fields: FrozenSet[str]
+    # Modules to import for dotted names in py_type
+    imports: FrozenSet[str]
+
+
+def _compile_sa_type(sa_type: SAType) -> _CompiledSAType:
+    fields = template_fields(sa_type.py_type)
+    for field in fields:
+        if field[:-1] not in ("arg", "py") or not field[-1:].isdigit():
+            raise ValueError(
+                f"Unsupported placeholder {{{field}}} in {sa_type.py_type!r}"
+            )
+    return _CompiledSAType(
+        sa_type.py_type, sa_type.inferable, fields, _template_imports(sa_type.py_type)
+    )
+
+
+class SATypeRegistry:
+    """
+    Maps SQLAlchemy column types to Python types. All the accepted spellings of each type
+    (Integer, sa.Integer, sqlalchemy.types.Integer, ...) are compiled into a single dict
+    up front, so resolving a column's type is one lookup.
+    """
+
+    def __init__(
+        self,
+        sa_types: Mapping[str, SAType] = DEFAULT_SA_TYPES,
+        module_aliases: Iterable[str] = DEFAULT_SA_MODULE_ALIASES,
+    ) -> None:
+        self.sa_types = dict(sa_types)
+        self.module_aliases = tuple(module_aliases)
+        self.lookup: Dict[str, _CompiledSAType] = {}
+        for name, sa_type in self.sa_types.items():
+            compiled = _compile_sa_type(sa_type)
+            self.lookup[name] = compiled
+            if "." not in name:
+                for alias in self.module_aliases:
+                    self.lookup.setdefault(f"{alias}.{name}", compiled)
+        # Modules to import for each Python type this registry has produced
+        self._imports: Dict[str, FrozenSet[str]] = {}
+
+    @classmethod
+    def from_options(
+        cls,
+        sa_types_file: Optional[str] = None,
+        sa_types: Sequence[str] = (),
+        sa_module_aliases: Sequence[str] = (),
+    ) -> "SATypeRegistry":
+        """
+        Build a registry from the defaults, updated from a JSON file and then from
+        NAME=PY_TYPE options.
+        """
+        merged = dict(DEFAULT_SA_TYPES)
+        if sa_types_file:
+            merged.update(load_sa_types_file(sa_types_file))
+        merged.update(parse_sa_type_option(option) for option in sa_types)
+        return cls(merged, DEFAULT_SA_MODULE_ALIASES + tuple(sa_module_aliases))
+
+    def fingerprint(self) -> str:
+        """
+        A hash of the mappings, for use in cache keys.
+        """
+        data = json.dumps(
+            sorted((k, v.py_type, v.inferable) for k, v in self.lookup.items())
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _get(self, type_expr: cst.BaseExpression) -> Optional[_CompiledSAType]:
+        if isinstance(type_expr, cst.Call):
+            type_expr = type_expr.func
+        name = get_full_name_for_node(type_expr)
+        if name is None:
+            return None
+        return self.lookup.get(name)
+
+    def is_inferable(self, type_expr: cst.BaseExpression) -> bool:
+        """
+        Whether mapped_column() would infer this type from the annotation alone, i.e. the
+        type is inferable and isn't called with arguments.
+        """
+        if isinstance(type_expr, cst.Call) and type_expr.args:
+            return False
+        sa_type = self._get(type_expr)
+        return sa_type is not None and sa_type.inferable
+
+    def resolve(self, type_expr: cst.BaseExpression) -> Optional[str]:
+        """
+        Resolve the Python type for a column type expression.
+        :param type_expr: The column type, e.g. a Name, Attribute or Call
+        :return: The Python type, or None if it can't be determined
+        """
+        sa_type = self._get(type_expr)
+        if sa_type is None:
+            return None
+        if not sa_type.fields:
+            self._imports.setdefault(sa_type.py_type, sa_type.imports)
+            return sa_type.py_type
+
+        args = type_expr.args if isinstance(type_expr, cst.Call) else ()
+        positional = [arg.value for arg in args if arg.keyword is None and not arg.star]
+        imports = sa_type.imports
+        values = {}
+        for field in sa_type.fields:
+            index = int(field[-1])
+            if index >= len(positional):
+                return None
+            if field.startswith("arg"):
+                if isinstance(positional[index], cst.Call):
+                    return None
+                value = get_full_name_for_node(positional[index])
+            else:
+                value = self.resolve(positional[index])
+                if value is not None:
+                    imports = imports | self.imports_for(value)
+            if value is None:
+                return None
+            values[field] = value
+        py_type = sa_type.py_type.format(**values)
+        self._imports.setdefault(py_type, imports)
+        return py_type
+
+    def imports_for(self, py_type: str) -> FrozenSet[str]:
+        """
+        Modules that need importing to use a Python type previously returned by resolve().
+        """
+        return self._imports.get(py_type, frozenset())
+
+
+default_sa_type_registry = SATypeRegistry()
@@ -0,0 +1,142 @@
+import libcst as cst
+from libcst.codemod import CodemodContext
+
+from codemods.combined import CombinedCodemodCommand
+
+source = """
+class MyModel(Base):
+    __tablename__ = "mymodels"
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+    payload = Column(Pickled)
+    flags = Column("flags", sa.Integer(), server_default="0")
+
+    @classmethod
+    def get_active(cls, session):
+        return session.query(cls).all()
+
+    @classmethod
+    def get_archived(cls, session: Session):
+        return session.query(cls).all()
+
+
+class NotAModel:
+    name = "x"
+
+
+@admin.route("/users")
+def users():
+    g.user.require(ADMIN_PERMISSION)
+    ...
+
+
+@admin.route("/buy", permission=BUY_PERMISSION)
+def buy():
+    g.user.require(ADDITIONAL_PERMISSION)
+
+
+@admin.route("/twice")
+def twice():
+    g.user.require(A)
+    g.user.require(B)
+
+
+@admin.route("/open")
+def open_view():
+    ...
+
+
+@admin.route("/empty")
+def empty():
+    g.user.require()
+"""
+
+
+def analyze(source, **options):
+    command = CombinedCodemodCommand(CodemodContext(), **options)
+    assert command.should_transform(source)
+    return command.analyze_module(cst.parse_module(source))
+
+
+def test_analyze_counts_candidates():
+    analysis = analyze(source)
+    assert analysis["column_to_mapped"] == {
+        "models": 1,
+        "columns": 4,
+        "columns_typed": 2,
+        "columns_untyped": 1,
+        "columns_not_understood": 1,
+    }
+    assert analysis["annotate_session"] == {
+        "session_params_to_annotate": 1,
+        "session_params_already_annotated": 1,
+    }
+    assert analysis["route_redecorate"] == {
+        "views": 5,
+        "views_eligible": 1,
+        "views_rejected.permission_already_set": 1,
+        "views_rejected.multiple_require_calls": 1,
+        "views_rejected.no_require_call": 1,
+        "views_rejected.require_call_without_permission": 1,
+    }
+
+
+def test_analyze_uses_codemod_options():
+    analysis = analyze(
+        source, codemods=["column_to_mapped"], sa_types=["Pickled=bytes"]
+    )
+    assert list(analysis) == ["column_to_mapped"]
+    assert analysis["column_to_mapped"]["columns_typed"] == 3
+    assert analysis["column_to_mapped"]["columns_untyped"] == 0
+
+
+def test_analyze_with_model_detection_by_bases():
+    code = source.replace("class NotAModel:", "class Admin(MyModel):")
+    # Base isn't defined or imported, so nothing is a model
+    analysis = analyze(code, codemods=["annotate_session"], model_detection="bases")
+    assert analysis["annotate_session"] == {}
+    analysis = analyze(
+        code,
+        codemods=["annotate_session"],
+        model_detection="bases",
+        declarative_bases=["Base"],
+    )
+    assert analysis["annotate_session"] == {
+        "session_params_to_annotate": 1,
+        "session_params_already_annotated": 1,
+    }
+    analysis = analyze(code, codemods=["column_to_mapped"], model_detection="either")
+    assert analysis["column_to_mapped"]["models"] == 2
+
+
+def test_analyze_async_sessions():
+    code = """
+async def list_users(session):
+    return await session.scalars(select(User))
+
+
+def count_users(session):
+    ...
+"""
+    analysis = analyze(code, codemods=["annotate_session"], session_scopes=["function"])
+    assert analysis["annotate_session"] == {
+        "session_params_to_annotate": 2,
+        "session_params_to_annotate.async": 1,
+    }
+
+
+def test_analyze_queries():
+    code = (
+        source
+        + """
+
+def reports(session):
+    return session.query(NotAModel).first()
+"""
+    )
+    analysis = analyze(code, codemods=["query_to_select"])
+    assert analysis["query_to_select"] == {
+        "queries": 3,
+        "queries_to_rewrite.all": 2,
+        "queries_rejected.not_a_model": 1,
+    }
@@ -0,0 +1,49 @@
+import os
+
+from codemods.cache import ResultCache
+from codemods.runner import main
+
+
+def test_cache_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    key = cache.key("x = 1\n", "column_to_mapped", {})
+    assert cache.get(key) == (False, None)
+    cache.put(key, None)
+    assert cache.get(key) == (True, None)
+    cache.put(key, "x: int = 1\n")
+    assert cache.get(key) == (True, "x: int = 1\n")
+
+
+def test_cache_key_depends_on_options():
+    cache = ResultCache()
+    assert cache.key("x = 1\n", "a", {"o": 1}) != cache.key("x = 1\n", "a", {"o": 2})
+    assert cache.key("x = 1\n", "a", {}) != cache.key("x = 1\n", "b", {})
+    assert cache.key("x = 1\n", "a", {}) != cache.key("x = 2\n", "a", {})
+
+
+def test_prune_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path), max_size=150)
+    keys = [cache.key(str(i), "a", {}) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, "x" * 60)
+        path = os.path.join(str(tmp_path), key[:2], key)
+        os.utime(path, (i, i))
+    assert cache.prune() == 1
+    assert cache.get(keys[0]) == (False, None)
+    assert cache.get(keys[2])[0]
+
+
+def test_runner_uses_cache(tmp_path, capsys):
+    source = 'class A(Base):\n    __tablename__ = "a"\n    id = Column(Integer, primary_key=True)\n'
+    model_file = tmp_path / "models.py"
+    model_file.write_text(source)
+    cache_dir = str(tmp_path / ".cache")
+
+    main([str(model_file), "--cache-dir", cache_dir])
+    transformed = model_file.read_text()
+    assert "mapped_column" in transformed
+
+    model_file.write_text(source)
+    main([str(model_file), "--cache-dir", cache_dir])
+    assert model_file.read_text() == transformed
+    assert "1 from cache" in capsys.readouterr().err
@@ -0,0 +1,109 @@
+import libcst as cst
+from libcst.codemod import CodemodContext, CodemodTest
+
+from codemods.combined import CombinedCodemodCommand, codemod_options
+from codemods.sa_annotate_session_codemod import AddSessionTypeAnnotationCommand
+
+
+before = """
+class MyModel(Base):
+    __tablename__ = "mymodels"
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+
+    @classmethod
+    def get_active(cls, session):
+        return session.query(cls).all()
+
+
+@admin.route("/users")
+def users():
+    g.user.require(ADMIN_PERMISSION)
+    ...
+"""
+
+after = """
+import datetime
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+class MyModel(Base):
+    __tablename__ = "mymodels"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    created_at: Mapped[datetime.datetime] = mapped_column()
+
+    @classmethod
+    def get_active(cls, session: Session):
+        return session.query(cls).all()
+
+
+@admin.route("/users", permission=ADMIN_PERMISSION)
+def users():
+    ...
+"""
+
+
+def test_codemod_options_filters_by_constructor():
+    options = {"possible_session_names": ("db",), "unrelated": True}
+    assert codemod_options(AddSessionTypeAnnotationCommand, options) == {
+        "possible_session_names": ("db",)
+    }
+
+
+def test_timings_recorded_per_codemod():
+    command = CombinedCodemodCommand(CodemodContext())
+    command.transform_module(cst.parse_module(before))
+    assert set(command.timings) == {
+        "column_to_mapped",
+        "annotate_session",
+        "route_redecorate",
+        "imports",
+    }
+
+
+class TestCombinedCodemodCommand(CodemodTest):
+    TRANSFORM = CombinedCodemodCommand
+
+    def test_all_codemods(self):
+        self.assertCodemod(before, after)
+
+    def test_model_without_tablename(self):
+        # annotate_session still finds the model once column_to_mapped has rewritten
+        # its columns
+        before = """
+class MyModel(Base):
+    id = Column(Integer, primary_key=True)
+
+    @classmethod
+    def f(cls, session):
+        ...
+"""
+        after = """
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+class MyModel(Base):
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+    @classmethod
+    def f(cls, session: Session):
+        ...
+"""
+        self.assertCodemod(before, after)
+
+    def test_selected_codemods(self):
+        expected = before.replace(
+            '@admin.route("/users")',
+            '@admin.route("/users", permission=ADMIN_PERMISSION)',
+        ).replace("    g.user.require(ADMIN_PERMISSION)\n", "")
+        self.assertCodemod(before, expected, codemods=["route_redecorate"])
+
+
+def test_should_transform_selects_codemods():
+    command = CombinedCodemodCommand(CodemodContext())
+    assert not command.should_transform("import os\n\nprint(os.getcwd())\n")
+    assert command.should_transform("class A(Base):\n    id = Column(Integer)\n")
+    assert [name for name, _ in command.selected_commands] == ["column_to_mapped"]
+    assert command.prescreen_skips == {
+        "column_to_mapped": 1,
+        "annotate_session": 2,
+        "route_redecorate": 2,
+    }
@@ -0,0 +1,82 @@
+import subprocess
+
+import libcst as cst
+from libcst.codemod import CodemodContext
+
+from codemods.line_ranges import (
+    CHANGED_LINES_KEY,
+    changed_lines,
+    changed_python_files,
+    parse_changed_lines,
+)
+from codemods.runner import main
+from codemods.sa_column_to_mapped import ColumnToMappedCommand
+
+model_source = """\
+class User(Base):
+    __tablename__ = "user"
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+"""
+
+
+def test_parse_changed_lines():
+    diff = """\
+diff --git a/models.py b/models.py
+--- a/models.py
++++ b/models.py
+@@ -3 +3 @@ class User(Base):
+-    id = Column(Integer)
++    id = Column(Integer, primary_key=True)
+@@ -10,0 +11,2 @@ class User(Base):
++    a = Column(String)
++    b = Column(String)
+@@ -20,2 +22,0 @@ class User(Base):
+-    c = Column(String)
+-    d = Column(String)
+diff --git a/gone.py b/gone.py
+--- a/gone.py
++++ /dev/null
+@@ -1 +0,0 @@
+-import os
+"""
+    assert parse_changed_lines(diff) == {"models.py": [(3, 3), (11, 12)]}
+
+
+def test_codemod_only_changes_given_lines():
+    context = CodemodContext(scratch={CHANGED_LINES_KEY: [(4, 4)]})
+    command = ColumnToMappedCommand(context)
+    code = command.transform_module(cst.parse_module(model_source)).code
+    assert "id = Column(Integer, primary_key=True)" in code
+    assert "name: Mapped[str] = mapped_column(String)" in code
+
+
+def git(*args):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        check=True,
+        capture_output=True,
+    )
+
+
+def test_main_since_ref_with_changed_lines(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "models.py").write_text(model_source)
+    (tmp_path / "other.py").write_text(model_source)
+    git("init", "-q")
+    git("add", ".")
+    git("commit", "-q", "-m", "Initial")
+    (tmp_path / "models.py").write_text(
+        model_source + "    email = Column(String, nullable=False)\n"
+    )
+    (tmp_path / "notes.txt").write_text("Not python")
+
+    assert changed_python_files("HEAD") == ["models.py"]
+    assert changed_lines("HEAD", ["models.py"]) == {"models.py": [(5, 5)]}
+
+    assert main(["--since", "HEAD", "--changed-lines", "--no-cache"]) == 0
+    assert capsys.readouterr().out == "models.py\n"
+    code = (tmp_path / "models.py").read_text()
+    assert "id = Column(Integer, primary_key=True)" in code
+    assert "email: Mapped[str] = mapped_column(String)" in code
+    assert (tmp_path / "other.py").read_text() == model_source
@@ -0,0 +1,67 @@
+import libcst as cst
+import libcst.display
+import pytest
+
+from utils.print_cst import CSTDumper, parse_line_range, select_nodes
+
+code = """
+@app.route("/users")
+def users():
+    g.user.require(ADMIN_PERMISSION)
+    return render_template("users.html", users=get_users())
+"""
+
+
+def dump(node, **kwargs):
+    return "".join(CSTDumper(**kwargs).dump(node))
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"show_defaults": True},
+        {"show_syntax": True},
+        {"show_whitespace": True},
+        {"show_defaults": True, "show_syntax": True, "show_whitespace": True},
+    ],
+)
+def test_dump_matches_libcst(options):
+    module = cst.parse_module(code)
+    assert dump(module, **options) == libcst.display.dump(
+        module, indent="    ", **options
+    )
+
+
+def test_dump_max_depth():
+    assert dump(cst.parse_expression("f(x)"), max_depth=1) == (
+        "Call(\n"
+        "    func=Name(...),\n"
+        "    args=[\n"
+        "        Arg(...),\n"
+        "    ],\n"
+        ")"
+    )
+
+
+def test_select_nodes_by_type():
+    module = cst.parse_module(code)
+    calls = [node for node, _ in select_nodes(module, [cst.Call])]
+    # Only the outermost calls
+    assert [module.code_for_node(call) for call in calls] == [
+        'app.route("/users")',
+        "g.user.require(ADMIN_PERMISSION)",
+        'render_template("users.html", users=get_users())',
+    ]
+
+
+def test_select_nodes_by_line_range():
+    module = cst.parse_module(code)
+    [(node, line)] = select_nodes(module, line_range=parse_line_range("4"))
+    assert isinstance(node, cst.SimpleStatementLine) and line == 4
+    # The outermost node within the lines
+    [(node, line)] = select_nodes(module, line_range=parse_line_range("4-5"))
+    assert isinstance(node, cst.IndentedBlock)
+
+    calls = list(select_nodes(module, [cst.Call], parse_line_range("5")))
+    assert [line for _, line in calls] == [5]
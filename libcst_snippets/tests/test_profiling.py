@@ -0,0 +1,73 @@
+import libcst as cst
+from libcst.codemod import CodemodContext
+
+from codemods.combined import CombinedCodemodCommand
+from codemods.profiling import (
+    MatcherProfile,
+    profiled,
+    start_profiling,
+    stop_profiling,
+)
+from codemods.runner import run_files
+
+source = """
+class MyModel(Base):
+    __tablename__ = "mymodels"
+    id = Column(Integer, primary_key=True)
+
+    @classmethod
+    def get_active(cls, session):
+        return session.query(cls).all()
+
+
+@admin.route("/users")
+def users():
+    g.user.require(ADMIN_PERMISSION)
+    ...
+"""
+
+
+@profiled("is_even")
+def is_even(n):
+    return n % 2 == 0
+
+
+def test_profiled_records_only_while_profiling():
+    is_even(1)
+    profile = start_profiling()
+    for n in range(5):
+        is_even(n)
+    assert stop_profiling() is profile
+    is_even(2)
+    assert profile.calls["is_even"] == 5
+    assert profile.hits["is_even"] == 3
+    assert profile.as_dict()["is_even"]["hit_rate"] == 0.6
+
+
+def test_profile_codemods():
+    command = CombinedCodemodCommand(CodemodContext())
+    profile = start_profiling()
+    try:
+        command.transform_module(cst.parse_module(source))
+    finally:
+        stop_profiling()
+    assert profile.calls["is_probably_sa_model"] == 2
+    assert profile.calls["column_def_matcher"] == 2
+    assert profile.hits["find_session_params"] == 1
+    assert profile.hits["scan_view_function"] == 1
+    assert "scan_view_function" in profile.format_table()
+
+
+def test_profiles_merged_across_workers(tmp_path):
+    filenames = []
+    for i in range(4):
+        path = tmp_path / f"module{i}.py"
+        path.write_text(source)
+        filenames.append(str(path))
+    total = MatcherProfile()
+    for result in run_files(
+        filenames, {}, diff_context=3, jobs=2, chunksize=1, profile_matchers=True
+    ):
+        total.update(result.matcher_profile)
+    assert total.hits["scan_view_function"] == 4
+    assert total.calls["column_def_matcher"] == 8
@@ -0,0 +1,257 @@
+import json
+import os
+
+from libcst.codemod import CodemodContext
+
+from codemods.project_index import (
+    ProjectIndex,
+    absolute_name,
+    build_project_index,
+    index_source,
+    load_project_index,
+    update_project_index,
+)
+from codemods.runner import gather_python_files, main, run_files
+from codemods.sa_eager_load import EagerLoadRelationshipsCommand
+from codemods.sa_query_to_select import QueryToSelectCommand
+
+base_source = """
+from sqlalchemy.orm import declarative_base
+
+Base = declarative_base()
+"""
+
+models_init_source = """
+from .user import User
+"""
+
+user_source = """
+from sqlalchemy import Column, Integer
+from .base import Base
+
+
+class User(Base):
+    id = Column(Integer, primary_key=True)
+"""
+
+admin_source = """
+from sqlalchemy import Column, Integer
+from app.models import User
+
+
+class Admin(User):
+    level = Column(Integer)
+
+    @classmethod
+    def get(cls, session):
+        ...
+
+
+class Form:
+    level = Column(Integer)
+"""
+
+permissions_source = """
+ADMIN = "admin"
+"""
+
+views_source = """
+from app import permissions
+from app.permissions import ADMIN
+
+
+@admin.route("/a")
+def a():
+    g.user.require(ADMIN)
+
+
+@admin.route("/b")
+def b():
+    g.user.require(permissions.ADMIN)
+
+
+@admin.route("/c")
+def c():
+    g.user.require(UNKNOWN)
+"""
+
+
+def make_project(tmp_path):
+    files = {
+        "app/__init__.py": "",
+        "app/models/__init__.py": models_init_source,
+        "app/models/base.py": base_source,
+        "app/models/user.py": user_source,
+        "app/admin.py": admin_source,
+        "app/permissions.py": permissions_source,
+        "app/views.py": views_source,
+    }
+    for name, source in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(source)
+    return gather_python_files([str(tmp_path)])
+
+
+def test_absolute_name():
+    assert absolute_name(".base.Base", "app.models") == "app.models.base.Base"
+    assert absolute_name("..user.User", "app.models") == "app.user.User"
+    assert absolute_name("sqlalchemy.orm.Mapped", "app") == "sqlalchemy.orm.Mapped"
+
+
+def test_index_source():
+    entry = index_source(user_source, "app.models.user", "app.models")
+    assert entry.imports == {
+        "Column": "sqlalchemy.Column",
+        "Integer": "sqlalchemy.Integer",
+        "Base": "app.models.base.Base",
+    }
+    assert entry.classes == {"User": ["app.models.base.Base"]}
+    assert entry.symbols["User"] == "class"
+
+    entry = index_source(base_source, "app.models.base", "app.models")
+    assert entry.declarative == ["Base"]
+
+    entry = index_source(permissions_source, "app.permissions", "app")
+    assert entry.constants == {"ADMIN": "admin"}
+
+
+def test_models_across_files(tmp_path):
+    index, n_indexed = build_project_index(str(tmp_path), make_project(tmp_path))
+    assert n_indexed == 7
+    assert index.resolve("app.models.User") == "app.models.user.User"
+    assert index.models() == {"app.models.user.User", "app.admin.Admin"}
+    assert index.is_model(".models.User", "app")
+    assert not index.is_model("app.admin.Form")
+
+
+def test_constants_across_files(tmp_path):
+    index, _ = build_project_index(str(tmp_path), make_project(tmp_path))
+    views = str(tmp_path / "app" / "views.py")
+    assert index.constant(index.qualify(views, "ADMIN")) == (True, "admin")
+    assert index.constant(index.qualify(views, "permissions.ADMIN")) == (True, "admin")
+    assert index.constant(index.qualify(views, "UNKNOWN")) == (False, None)
+
+
+def test_rebuild_reuses_unchanged_files(tmp_path):
+    filenames = make_project(tmp_path)
+    path = str(tmp_path / "index.json")
+    index, n_indexed = update_project_index(path, str(tmp_path), filenames)
+    assert n_indexed == 7
+    assert load_project_index(path).fingerprint() == index.fingerprint()
+
+    index, n_indexed = update_project_index(path, str(tmp_path), filenames)
+    assert n_indexed == 0
+
+    (tmp_path / "app" / "permissions.py").write_text('ADMIN = "superuser"\n')
+    index, n_indexed = update_project_index(path, str(tmp_path), filenames)
+    assert n_indexed == 1
+    assert index.constant("app.permissions.ADMIN") == (True, "superuser")
+    assert ProjectIndex.load(path).fingerprint() == index.fingerprint()
+
+
+def test_rebuild_ignores_other_versions(tmp_path):
+    filenames = make_project(tmp_path)
+    path = tmp_path / "index.json"
+    path.write_text(json.dumps({"version": 0}))
+    _, n_indexed = update_project_index(str(path), str(tmp_path), filenames)
+    assert n_indexed == 7
+
+
+def test_unparseable_file_is_indexed_empty(tmp_path):
+    (tmp_path / "broken.py").write_text("def (:\n")
+    index, _ = build_project_index(str(tmp_path), [str(tmp_path / "broken.py")])
+    assert index.files["broken.py"].symbols == {}
+
+
+def test_run_files_with_project_index(tmp_path):
+    filenames = make_project(tmp_path)
+    path = str(tmp_path / "index.json")
+    update_project_index(path, str(tmp_path), filenames)
+    admin = str(tmp_path / "app" / "admin.py")
+    options = {
+        "codemods": ["column_to_mapped", "annotate_session"],
+        "model_detection": "bases",
+        "project_index": path,
+    }
+    [result] = run_files([admin], options)
+    assert result.changed, result.error
+    code = (tmp_path / "app" / "admin.py").read_text()
+    assert "level: Mapped[Optional[int]] = mapped_column()" in code
+    assert "def get(cls, session: Session)" in code
+    # Not a model, so left alone
+    assert code.endswith("class Form:\n    level = Column(Integer)\n")
+
+
+def test_main_builds_index_and_analyzes_permissions(tmp_path, capsys):
+    make_project(tmp_path)
+    path = str(tmp_path / "index.json")
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        status = main(
+            [
+                "app",
+                "--analyze",
+                "--codemods",
+                "route_redecorate",
+                "--project-index",
+                path,
+            ]
+        )
+    finally:
+        os.chdir(cwd)
+    assert status == 0
+    captured = capsys.readouterr()
+    assert "project index: 7 file(s) indexed, 0 unchanged" in captured.err
+    stats = json.loads(captured.out)["codemods"]["route_redecorate"]
+    assert stats["views_eligible"] == 3
+    assert stats["views_eligible.permission_unresolved"] == 1
+    assert os.path.exists(path)
+
+
+def test_query_to_select_with_project_index(tmp_path):
+    make_project(tmp_path)
+    service = tmp_path / "app" / "service.py"
+    service.write_text(
+        "from app.models import User\n"
+        "from app.admin import Form\n\n\n"
+        "def users(session):\n"
+        "    return session.query(User).all()\n\n\n"
+        "def forms(session):\n"
+        "    return session.query(Form).all()\n"
+    )
+    path = str(tmp_path / "index.json")
+    update_project_index(path, str(tmp_path), gather_python_files([str(tmp_path)]))
+    options = {"codemods": ["query_to_select"], "project_index": path}
+    [result] = run_files([str(service)], options)
+    assert result.changed, result.error
+    code = service.read_text()
+    assert "return session.scalars(select(User)).all()" in code
+    assert "return session.query(Form).all()" in code
+
+
+def test_query_codemods_fingerprint_index_once(tmp_path):
+    make_project(tmp_path)
+    path = str(tmp_path / "index.json")
+    index, _ = update_project_index(
+        path, str(tmp_path), gather_python_files([str(tmp_path)])
+    )
+    for command_class in (QueryToSelectCommand, EagerLoadRelationshipsCommand):
+        for model_detection in ("heuristic", "bases"):
+            command = command_class(
+                CodemodContext(), model_detection=model_detection, project_index=path
+            )
+            fingerprint = command.cache_fingerprint()
+            assert fingerprint.count(index.fingerprint()) == 1
+
+
+def test_relationships_follow_bases(tmp_path):
+    make_project(tmp_path)
+    (tmp_path / "app" / "models" / "user.py").write_text(
+        user_source + '    orders = relationship("Order")\n'
+    )
+    index, _ = build_project_index(str(tmp_path), gather_python_files([str(tmp_path)]))
+    assert index.relationships("app.models.User") == ["orders"]
+    assert index.relationships("app.admin.Admin") == ["orders"]
+    assert index.relationships("app.admin.Form") == []
@@ -13,8 +13,13 @@ from codemods.route_redecorator import (
     view_with_permission_decorator_matcher,
     func_with_single_require_call_matcher,
     simple_view_function_matcher,
+    scan_view_function,
+    build_route_patterns,
+    DEFAULT_ROUTE_PATTERNS,
 )
-from libcst.codemod import CodemodTest
+from libcst.codemod import CodemodContext, CodemodTest
+
+from codemods.failures import recorded_failures
 
 
 def project_file(filename):
@@ -130,6 +135,94 @@ def buy():
     assert len(res) == 0
 
 
+def test_scan_view_function_agrees_with_matchers(route_example_cst: cst.Module):
+    code = (
+        route_example_cst.code
+        + """
+@app.route("/buy", methods=["GET", "POST"], permission=BUY_PERMISSION)
+def buy_again():
+    g.user.require(BUY_PERMISSION)
+
+@app.route("/twice")
+def twice():
+    g.user.require(A); g.user.require(B)
+    g.user.require(C)
+"""
+    )
+    tree = cst.parse_module(code)
+    for func in m.findall(tree, m.FunctionDef()):
+        scan = scan_view_function(func)
+        assert (scan is not None) == m.matches(func, simple_view_function_matcher)
+        assert (scan is not None and scan.eligible) == m.matches(
+            func, eligible_view_function_matcher
+        ), func.name.value
+        if scan is not None:
+            assert list(scan.require_stmts) == get_require_stmts(func)
+
+
+def test_should_transform_prescreen(route_example_cst: cst.Module):
+    command = RouteRedecorateCommand(CodemodContext())
+    assert command.should_transform(route_example_cst.code)
+    assert not command.should_transform("@app.route('/')\ndef index():\n    ...\n")
+
+
+def test_build_route_patterns_compiles_once():
+    first = RouteRedecorateCommand(
+        CodemodContext(), route_methods=["get", "post"], permission_kwarg="perm"
+    )
+    second = RouteRedecorateCommand(
+        CodemodContext(), route_methods=["get", "post"], permission_kwarg="perm"
+    )
+    assert first.patterns is second.patterns
+    assert RouteRedecorateCommand(CodemodContext()).patterns is DEFAULT_ROUTE_PATTERNS
+
+
+def test_build_route_patterns_rejects_bad_names():
+    with pytest.raises(ValueError):
+        build_route_patterns(require_calls=("g.user.require()",))
+    with pytest.raises(ValueError):
+        build_route_patterns(permission_kwarg="not valid")
+
+
+def test_should_transform_prescreen_with_custom_patterns():
+    command = RouteRedecorateCommand(
+        CodemodContext(),
+        route_methods=["get"],
+        require_calls=["current_user.require"],
+    )
+    code = "@bp.get('/')\ndef index():\n    current_user . require(X)\n"
+    assert command.should_transform(code)
+    assert not command.should_transform(code.replace("current_user", "g.user"))
+    assert not command.should_transform(code.replace(".get", ".route"))
+
+
+def test_unsupported_views_recorded_when_continuing_on_error():
+    code = """
+@app.route("/outer")
+def outer():
+    g.user.require(OUTER_PERMISSION)
+
+    @app.route("/inner")
+    def inner():
+        g.user.require(INNER_PERMISSION)
+
+@app.route("/empty")
+def empty():
+    g.user.require()
+"""
+    command = RouteRedecorateCommand(CodemodContext(), continue_on_error=True)
+    new_code = command.transform_module(cst.parse_module(code)).code
+    assert '@app.route("/outer", permission=OUTER_PERMISSION)' in new_code
+    assert "g.user.require(INNER_PERMISSION)" in new_code
+    assert "g.user.require()" in new_code
+    assert [
+        (failure.line, failure.reason) for failure in recorded_failures(command.context)
+    ] == [
+        (7, "Nested view functions are not supported"),
+        (12, "Require call has no permission argument"),
+    ]
+
+
 class TestRouteRedecorateCommand(CodemodTest):
     TRANSFORM = RouteRedecorateCommand
 
@@ -185,6 +278,30 @@ def item(item_id):
 """
         self.assertCodemod(code, code)
 
+    def test_transform_keeps_nested_require(self):
+        code = """
+@app.route("/items/<item_id>")
+def item(item_id):
+    g.user.require(VIEW_PERMISSION)
+    if item.archived:
+        g.user.require(ADMIN_PERMISSION)
+
+    @other.route("/inner")
+    def inner():
+        ...
+"""
+        expected = """
+@app.route("/items/<item_id>", permission=VIEW_PERMISSION)
+def item(item_id):
+    if item.archived:
+        g.user.require(ADMIN_PERMISSION)
+
+    @other.route("/inner")
+    def inner():
+        ...
+"""
+        self.assertCodemod(code, expected)
+
     def test_transform_multiple_routes_on_view(self):
         code = """
 @app.route("/buy", methods=["GET", "POST"], defaults={"offer": None})
@@ -216,3 +333,44 @@ def buy():
         with open(project_file("fixed_examples/route_example_after.py"), "r") as file:
             after = file.read()
         self.assertCodemod(before, after)
+
+    def test_transform_with_custom_patterns(self):
+        code = """
+@bp.get("/items")
+@bp.post("/items")
+def items():
+    current_user.require(ITEMS_PERMISSION)
+    ...
+
+@app.route("/users")
+def users():
+    g.user.require(ADMIN_PERMISSION)
+    ...
+
+@bp.get("/buy", perm=BUY_PERMISSION)
+def buy():
+    g.user.require(ADDITIONAL_PERMISSION)
+    ...
+"""
+        expected = """
+@bp.get("/items", perm=ITEMS_PERMISSION)
+@bp.post("/items", perm=ITEMS_PERMISSION)
+def items():
+    ...
+
+@app.route("/users", perm=ADMIN_PERMISSION)
+def users():
+    ...
+
+@bp.get("/buy", perm=BUY_PERMISSION)
+def buy():
+    g.user.require(ADDITIONAL_PERMISSION)
+    ...
+"""
+        self.assertCodemod(
+            code,
+            expected,
+            route_methods=["route", "get", "post"],
+            require_calls=["g.user.require", "current_user.require"],
+            permission_kwarg="perm",
+        )
@@ -0,0 +1,164 @@
+import json
+import os
+import subprocess
+import time
+
+from codemods import runner
+from codemods.runner import (
+    diff_source,
+    gather_python_files,
+    main,
+    run_files,
+    write_atomically,
+)
+
+model_source = """
+class User(Base):
+    __tablename__ = "user"
+    id = Column(Integer, primary_key=True)
+"""
+
+view_source = """
+@admin.route("/users")
+def users():
+    g.user.require(ADMIN_PERMISSION)
+    ...
+"""
+
+
+def make_tree(tmp_path):
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / "models.py").write_text(model_source)
+    (tmp_path / "pkg" / "views.py").write_text(view_source)
+    (tmp_path / "pkg" / "util.py").write_text("import os\n")
+    (tmp_path / ".hidden").mkdir()
+    (tmp_path / ".hidden" / "ignored.py").write_text(model_source)
+    (tmp_path / "README.md").write_text("Not python")
+
+
+def test_gather_python_files(tmp_path):
+    make_tree(tmp_path)
+    found = gather_python_files([str(tmp_path)])
+    assert [f[len(str(tmp_path)) + 1 :] for f in found] == [
+        "pkg/models.py",
+        "pkg/util.py",
+        "pkg/views.py",
+    ]
+
+
+def test_run_files_in_parallel(tmp_path):
+    make_tree(tmp_path)
+    filenames = gather_python_files([str(tmp_path)])
+    results = list(run_files(filenames, {}, jobs=2, chunksize=1))
+    assert sorted(r.filename for r in results) == filenames
+    statuses = {r.filename.rsplit("/", 1)[1]: r.status for r in results}
+    assert statuses == {
+        "models.py": "parsed",
+        "util.py": "skipped",
+        "views.py": "parsed",
+    }
+    assert "mapped_column" in (tmp_path / "pkg" / "models.py").read_text()
+    assert "permission=ADMIN_PERMISSION" in (tmp_path / "pkg" / "views.py").read_text()
+
+
+def test_run_files_diff_leaves_files_alone(tmp_path):
+    make_tree(tmp_path)
+    filename = str(tmp_path / "pkg" / "views.py")
+    [result] = run_files([filename], {}, diff_context=0)
+    assert result.changed
+    assert '+@admin.route("/users", permission=ADMIN_PERMISSION)' in result.diff
+    assert (tmp_path / "pkg" / "views.py").read_text() == view_source
+
+
+def test_diff_source_paths(tmp_path, monkeypatch):
+    (tmp_path / "pkg").mkdir()
+    monkeypatch.chdir(tmp_path / "pkg")
+    inside = diff_source(str(tmp_path / "pkg" / "views.py"), "a\n", "b\n", 0)
+    assert inside.startswith("--- a/views.py\n+++ b/views.py\n")
+    # Outside the current directory the path is kept rather than climbing out with ..
+    outside = str(tmp_path / "models.py")
+    diff = diff_source(outside, "a\n", "b\n", 0)
+    assert diff.startswith(f"--- a/{outside}\n+++ b/{outside}\n")
+
+
+def test_write_atomically_keeps_permissions(tmp_path):
+    path = tmp_path / "script.py"
+    path.write_text("old\n")
+    path.chmod(0o755)
+    write_atomically(str(path), "new\n")
+    assert path.read_text() == "new\n"
+    assert os.stat(path).st_mode & 0o777 == 0o755
+    assert os.listdir(tmp_path) == ["script.py"]
+
+
+def test_writing_is_not_timed(tmp_path, monkeypatch):
+    make_tree(tmp_path)
+    path = tmp_path / "pkg" / "views.py"
+
+    def slow_write(filename, code):
+        time.sleep(0.3)
+        write_atomically(filename, code)
+
+    monkeypatch.setattr(runner, "write_atomically", slow_write)
+    [result] = run_files([str(path)], {}, timeout=0.2)
+    assert result.status == "parsed" and result.changed
+    assert "permission=ADMIN_PERMISSION" in path.read_text()
+
+
+def test_run_files_records_failures(tmp_path):
+    bad = tmp_path / "bad.py"
+    bad.write_text("x = Column(\n")
+    [result] = run_files([str(bad)], {})
+    assert result.status == "failed"
+    assert "ParserSyntaxError" in result.error
+
+
+def test_main_exit_status(tmp_path, capsys):
+    make_tree(tmp_path)
+    assert main([str(tmp_path), "--no-cache", "--jobs", "2"]) == 0
+    assert "2 file(s) parsed, 1 skipped by pre-screen" in capsys.readouterr().err
+
+
+def test_main_analyze_changes_nothing(tmp_path, capsys):
+    make_tree(tmp_path)
+    cache_dir = tmp_path / ".codemod_cache"
+    args = [str(tmp_path), "--analyze", "--jobs", "2", "--cache-dir", str(cache_dir)]
+    assert main(args) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report["files"]["parsed"] == 2
+    assert report["codemods"]["column_to_mapped"]["columns_typed"] == 1
+    assert report["codemods"]["route_redecorate"]["views_eligible"] == 1
+    assert (tmp_path / "pkg" / "models.py").read_text() == model_source
+    assert not cache_dir.exists()
+
+
+def test_main_reports_unsupported_constructs(tmp_path, capsys):
+    bad = tmp_path / "bad.py"
+    bad.write_text(model_source + '    name = Column("name", sa.String(50))\n')
+    report = tmp_path / "failures.json"
+    args = [str(bad), "--no-cache", "--failure-report", str(report)]
+
+    assert main(args) == 1
+    assert "bad.py:5:5: ColumnToMappedCommand" in capsys.readouterr().err
+    assert "id = Column" in bad.read_text()
+
+    assert main(args + ["--continue-on-error"]) == 0
+    assert "1 unsupported construct(s)" in capsys.readouterr().err
+    assert "id: Mapped[int]" in bad.read_text()
+    [failure] = json.loads(report.read_text())
+    assert (failure["line"], failure["column"]) == (5, 5)
+
+
+def test_main_streams_diffs_to_patch_file(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    for i in range(6):
+        (tmp_path / f"views{i}.py").write_text(view_source)
+    patch = tmp_path / "changes.patch"
+    args = [".", "--no-cache", "--jobs", "2", "--chunksize", "1"]
+    assert main(args + ["--diff-output", str(patch)]) == 0
+    assert len(capsys.readouterr().out.splitlines()) == 6
+    assert patch.read_text().count("+++ b/") == 6
+    assert (tmp_path / "views0.py").read_text() == view_source
+
+    subprocess.run(["git", "apply", str(patch)], check=True)
+    assert "permission=ADMIN_PERMISSION" in (tmp_path / "views5.py").read_text()
@@ -1,20 +1,24 @@
 import libcst as cst
 import libcst.matchers as m
-from libcst.codemod import CodemodTest
+from libcst.codemod import CodemodContext, CodemodTest
+from libcst.metadata import MetadataWrapper, ScopeProvider
 
+from codemods.profiling import start_profiling, stop_profiling
 from codemods.sa_annotate_session_codemod import (
     AddSessionTypeAnnotationCommand,
     build_classmethod_with_session_arg_matcher,
 )
-
 from codemods.sa_common import (
     class_has_tablename_attribute_matcher,
     column_definition_line_matcher,
     class_has_column_definitions_matcher,
+    ModelDetector,
+    class_probably_an_sa_model,
+    find_model_classes,
+    is_probably_sa_model,
 )
 
 
-
 def test_class_has_tablename_attribute_found():
     code = """
 class MyModel(Base):
@@ -69,6 +73,57 @@ class MyModel(Base):
     assert len(found) == 0
 
 
+def test_is_probably_sa_model_agrees_with_matcher():
+    code = """
+class WithTablename(Base):
+    __tablename__ = "mymodels"
+
+class WithColumns(Base):
+    x = 1; id = Column(Integer, primary_key=True)
+
+class WithBoth(Base):
+    __tablename__ = "both"
+    id = Column(Integer)
+
+class ChainedTablename(Base):
+    __tablename__ = name = "chained"
+
+class NotAModel:
+    id = Columns(Integer)
+    def __tablename__(self):
+        ...
+
+class OneLiner(Base): __tablename__ = "one_liner"
+
+class WithMappedColumns(Base):
+    id: Mapped[int] = mapped_column(primary_key=True)
+"""
+    tree = cst.parse_module(code)
+    found = []
+    for class_def in tree.body:
+        expected = m.matches(class_def, class_probably_an_sa_model)
+        assert is_probably_sa_model(class_def) == expected, class_def.name.value
+        found.append(expected)
+    assert sum(found) == 3
+
+
+def test_model_detector_checks_each_class_once_per_module():
+    [model] = cst.parse_module('class User(Base):\n    __tablename__ = "user"\n').body
+    detector = ModelDetector()
+    context = CodemodContext()
+    profile = start_profiling()
+    try:
+        detector.visit_module(context, cst.Module([model]))
+        assert detector.is_model(context, model)
+        assert detector.is_model(context, model)
+        assert profile.calls["is_probably_sa_model"] == 1
+        detector.visit_module(context, cst.Module([model]))
+        assert detector.is_model(context, model)
+    finally:
+        stop_profiling()
+    assert profile.calls["is_probably_sa_model"] == 2
+
+
 def test_classmethod_with_session_arg_matcher():
     code = """
 @classmethod
@@ -83,6 +138,81 @@ def get_active(cls, session, **kwargs):
     assert len(found) == 1
 
 
+def test_should_transform_prescreen():
+    command = AddSessionTypeAnnotationCommand(
+        CodemodContext(), possible_session_names=("db",)
+    )
+    code = """
+class MyModel(Base):
+    __tablename__ = "mymodels"
+
+    @classmethod
+    def get_all(cls, db):
+        ...
+"""
+    assert command.should_transform(code)
+    assert not command.should_transform(code.replace("db", "session"))
+    assert not command.should_transform(code.replace("__tablename__", "name"))
+
+
+def model_classes(code, **kwargs):
+    module = cst.parse_module(code)
+    scope = MetadataWrapper(module, unsafe_skip_copy=True).resolve(ScopeProvider)[
+        module
+    ]
+    return find_model_classes(module, scope, **kwargs)
+
+
+def test_find_model_classes_follows_bases():
+    code = """
+import sqlalchemy as sa
+from sqlalchemy.orm import DeclarativeBase, declarative_base
+from app import db
+from .base import Base as ImportedBase
+
+LegacyBase = declarative_base()
+
+class Base(sa.orm.DeclarativeBase):
+    pass
+
+class TimestampMixin:
+    created_at = Column(DateTime)
+
+class AbstractModel(Base):
+    __abstract__ = True
+
+class User(TimestampMixin, AbstractModel):
+    __tablename__ = "user"
+
+class Admin(User):
+    pass
+
+class Legacy(LegacyBase):
+    pass
+
+class Flask(db.Model):
+    pass
+
+class Imported(ImportedBase):
+    pass
+
+class Unrelated(Helper):
+    pass
+
+class Cycle(Cycle):
+    pass
+"""
+    assert model_classes(code) == {
+        "TimestampMixin",
+        "AbstractModel",
+        "User",
+        "Admin",
+        "Legacy",
+        "Flask",
+    }
+    assert "Imported" in model_classes(code, declarative_bases=["base.Base"])
+
+
 class TestAddSessionTypeAnnotationCommand(CodemodTest):
     TRANSFORM = AddSessionTypeAnnotationCommand
 
@@ -188,3 +318,156 @@ class NotActuallyAModel:
         ...
 """
         self.assertCodemod(before, before)
+
+    def test_model_detection_by_bases(self):
+        before = """
+from .models import User
+
+class Admin(User):
+    @classmethod
+    def get_admins(cls, session):
+        ...
+
+class NotAModel:
+    __tablename__ = "confusing"
+
+    @classmethod
+    def get(cls, session):
+        ...
+"""
+        after = """
+from .models import User
+from sqlalchemy.orm import Session
+
+class Admin(User):
+    @classmethod
+    def get_admins(cls, session: Session):
+        ...
+
+class NotAModel:
+    __tablename__ = "confusing"
+
+    @classmethod
+    def get(cls, session):
+        ...
+"""
+        self.assertCodemod(
+            before,
+            after,
+            model_detection="bases",
+            declarative_bases=["models.User"],
+        )
+        command = AddSessionTypeAnnotationCommand(
+            CodemodContext(), model_detection="bases"
+        )
+        assert command.should_transform(before)
+
+    def test_session_scopes(self):
+        before = """
+class UserRepository:
+    def __init__(self, session):
+        self.session = session
+
+    def get(self, user_id, *, session):
+        ...
+
+    @staticmethod
+    def count(session):
+        def inner(session):
+            ...
+
+        return sorted([], key=lambda session: session)
+
+
+async def list_users(db, session, session_id):
+    ...
+"""
+        after = """
+from sqlalchemy.orm import Session
+
+class UserRepository:
+    def __init__(self, session: Session):
+        self.session = session
+
+    def get(self, user_id, *, session: Session):
+        ...
+
+    @staticmethod
+    def count(session: Session):
+        def inner(session):
+            ...
+
+        return sorted([], key=lambda session: session)
+
+
+async def list_users(db, session: Session, session_id):
+    ...
+"""
+        self.assertCodemod(
+            before,
+            after,
+            session_scopes=["method", "staticmethod", "function"],
+            session_any_class=True,
+            async_session=False,
+        )
+
+    def test_session_scopes_only_in_models_by_default(self):
+        before = """
+class UserRepository:
+    def get(self, session):
+        ...
+
+    @classmethod
+    def find(cls, session):
+        ...
+"""
+        self.assertCodemod(before, before, session_scopes=["method", "classmethod"])
+        command = AddSessionTypeAnnotationCommand(
+            CodemodContext(), session_scopes=["function"]
+        )
+        assert command.should_transform("def get(session):\n    ...\n")
+        assert not command.should_transform("def get(db):\n    ...\n")
+
+    def test_async_session(self):
+        before = """
+class MyModel(Base):
+    __tablename__ = "mymodels"
+
+    @classmethod
+    async def get_active(cls, session):
+        return await session.scalars(select(cls))
+
+    @classmethod
+    def get_archived(cls, session):
+        return session.scalars(select(cls))
+
+    @classmethod
+    def deferred(cls, session):
+        async def run():
+            await session.execute(select(cls))
+
+        return run
+"""
+        after = """
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+class MyModel(Base):
+    __tablename__ = "mymodels"
+
+    @classmethod
+    async def get_active(cls, session: AsyncSession):
+        return await session.scalars(select(cls))
+
+    @classmethod
+    def get_archived(cls, session: Session):
+        return session.scalars(select(cls))
+
+    @classmethod
+    def deferred(cls, session: AsyncSession):
+        async def run():
+            await session.execute(select(cls))
+
+        return run
+"""
+        self.assertCodemod(before, after)
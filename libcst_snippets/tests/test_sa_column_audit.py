@@ -0,0 +1,138 @@
+import json
+
+import libcst as cst
+import pytest
+from libcst.codemod import CodemodContext
+
+from codemods.combined import CombinedCodemodCommand
+from codemods.runner import main
+from codemods.sa_column_audit import audit_model, parse_column_call
+
+models = """
+class Order(Base):
+    __tablename__ = "orders"
+    __table_args__ = (
+        Index("ix_orders_shop", "shop_id", "created"),
+        ForeignKeyConstraint(["shop_id"], ["shops.id"]),
+    )
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    shop_id = Column(Integer)
+    created = Column(DateTime)
+    coupon_id: Mapped[int] = mapped_column("coupon", sa.ForeignKey(Coupon.id), index=True)
+    email = db.Column(String(120), unique=True)
+"""
+
+
+def test_parse_column_call():
+    column = parse_column_call(
+        "user_id",
+        cst.parse_expression(
+            'sa.Column("uid", Integer, ForeignKey("users.id"), nullable=False)'
+        ),
+    )
+    assert column.name == "uid"
+    assert column.type == "Integer"
+    assert column.foreign_keys == ["users.id"]
+    assert column.nullable is False
+    assert not (column.primary_key or column.index or column.unique)
+    assert parse_column_call("x", cst.parse_expression("relationship(User)")) is None
+
+
+def test_audit_model():
+    [order] = cst.parse_module(models).body
+    columns = {column.attribute: column for _, column in audit_model(order)}
+    assert list(columns) == [
+        "id",
+        "user_id",
+        "shop_id",
+        "created",
+        "coupon_id",
+        "email",
+    ]
+    assert columns["id"].indexed
+    assert columns["user_id"].foreign_keys == ["users.id"]
+    assert not columns["user_id"].indexed
+    # Covered by the composite index and foreign key in __table_args__
+    assert columns["shop_id"].foreign_keys == ["shops.id"]
+    assert columns["shop_id"].indexed
+    # Not the index's leading column
+    assert not columns["created"].indexed
+    assert columns["coupon_id"].name == "coupon"
+    assert columns["coupon_id"].foreign_keys == ["Coupon.id"]
+    assert columns["coupon_id"].indexed
+    assert columns["email"].type == "String(120)"
+    assert columns["email"].unique and columns["email"].indexed
+
+
+def test_composite_primary_key():
+    [link] = cst.parse_module(
+        """
+class Link(Base):
+    __tablename__ = "links"
+    user_id = Column(ForeignKey("users.id"), primary_key=True)
+    group_id = Column(ForeignKey("groups.id"), primary_key=True)
+"""
+    ).body
+    indexed = {column.attribute: column.indexed for _, column in audit_model(link)}
+    assert indexed == {"user_id": True, "group_id": False}
+
+
+def test_analysis():
+    command = CombinedCodemodCommand(
+        CodemodContext(filename="models.py"), codemods=["column_audit"]
+    )
+    assert not command.should_transform("class Order(Base):\n    pass\n")
+    assert command.should_transform(models)
+    analysis = command.analyze_module(cst.parse_module(models))
+    assert analysis["column_audit"] == {
+        "models": 1,
+        "columns": 6,
+        "columns_indexed": 4,
+        "columns_unique": 1,
+        "primary_keys": 1,
+        "foreign_keys": 3,
+        "foreign_keys_without_index": 1,
+    }
+    records = command.records["column_audit"]
+    assert [record["line"] for record in records] == [8, 9, 10, 11, 12, 13]
+    assert records[1] == {
+        "filename": "models.py",
+        "line": 9,
+        "model": "Order",
+        "column": "user_id",
+        "name": "user_id",
+        "type": "Integer",
+        "primary_key": False,
+        "index": False,
+        "unique": False,
+        "nullable": False,
+        "foreign_keys": ["users.id"],
+        "indexed": False,
+        "fk_without_index": True,
+    }
+
+
+def test_main_writes_schema_report(tmp_path, capsys):
+    path = tmp_path / "models.py"
+    path.write_text(models)
+    report = tmp_path / "schema.json"
+    status = main(
+        [str(path), "--analyze", "--codemods", "column_audit", "--report", str(report)]
+    )
+    assert status == 0
+    stats = json.loads(capsys.readouterr().out)["codemods"]["column_audit"]
+    assert stats["foreign_keys_without_index"] == 1
+    records = json.loads(report.read_text())["column_audit"]
+    assert [r["column"] for r in records if r["fk_without_index"]] == ["user_id"]
+
+
+def test_main_needs_analyze(tmp_path, capsys):
+    path = tmp_path / "models.py"
+    path.write_text(models)
+    with pytest.raises(SystemExit):
+        main([str(path), "--codemods", "column_audit"])
+    assert (
+        "read-only codemods require --analyze: column_audit" in capsys.readouterr().err
+    )
+    assert path.read_text() == models
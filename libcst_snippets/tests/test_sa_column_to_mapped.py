@@ -1,8 +1,27 @@
 import libcst as cst
 import libcst.matchers as m
 
-from codemods.sa_column_to_mapped import column_def_matcher, name_or_empty_call_of_inferrable_type_matcher, ColumnToMappedCommand, process_column_call, resolve_py_type_and_is_optional, replacement_assignment
-from libcst.codemod import CodemodTest
+from codemods.sa_column_to_mapped import (
+    column_def_matcher,
+    name_or_empty_call_of_inferrable_type_matcher,
+    ColumnToMappedCommand,
+    process_column_call,
+    resolve_py_type_and_is_optional,
+    replacement_assignment,
+    classify_column_call,
+    attempt_to_build_annotation,
+    column_call_with_name_and_type,
+    column_call_with_type,
+)
+from libcst.codemod import Codemod, CodemodContext, CodemodTest
+from libcst.codemod.visitors import AddImportsVisitor
+import pytest
+
+from codemods.failures import (
+    CodemodFailure,
+    UnsupportedConstructError,
+    recorded_failures,
+)
 
 before = """
 class User(Base):
@@ -19,6 +38,8 @@ class User(Base):
 
 after = """
 import datetime
+from sqlalchemy.orm import Mapped, mapped_column
+from typing import Optional
 
 class User(Base):
     __tablename__ = "user"
@@ -52,12 +73,19 @@ sa_type_to_py_type = {
 # Ignore Columns with ForeignKey
 
 
-
 def test_find_column_assignment():
     tree = cst.parse_module(before)
     found = m.findall(tree, column_def_matcher)
     assert len(found) == 6
 
+
+def test_should_transform_prescreen():
+    command = ColumnToMappedCommand(CodemodContext())
+    assert command.should_transform(before)
+    assert command.should_transform("x = Column (\n    Integer)")
+    assert not command.should_transform("ColumnList = []")
+
+
 def test_name_or_empty_call_of_inferrable_type_matcher():
     challenges = [
         ("Integer", True),
@@ -65,12 +93,13 @@ def test_name_or_empty_call_of_inferrable_type_matcher():
         ("JSONB", False),
         ("Text", False),
         ("Numeric", True),
-        ("Numeric(4,2)", False)
+        ("Numeric(4,2)", False),
     ]
     for challenge, expected in challenges:
         node = cst.parse_expression(challenge)
-        assert m.matches(node, name_or_empty_call_of_inferrable_type_matcher) == expected, \
-            f"Challenge: {challenge} failed, expected {expected}"
+        assert (
+            m.matches(node, name_or_empty_call_of_inferrable_type_matcher) == expected
+        ), f"Challenge: {challenge} failed, expected {expected}"
 
 
 def test_process_column_call_type_only():
@@ -82,13 +111,52 @@ def test_process_column_call_type_only():
 
 
 def test_process_column_call_name_and_type():
-    node = cst.parse_expression("Column(\"id\", Integer, primary_key=True)")
+    node = cst.parse_expression('Column("id", Integer, primary_key=True)')
     explicit_column_name_arg, column_type_arg, other_args = process_column_call(node)
     assert explicit_column_name_arg.value.value == '"id"'
     assert column_type_arg.value.value == "Integer"
     assert len(other_args) == 1
 
 
+def test_classify_column_call_agrees_with_matchers():
+    challenges = [
+        "Column(Integer)",
+        "Column(Integer, primary_key=True)",
+        'Column("id", Integer, nullable=False)',
+        "Column(id_name, Integer)",
+        "Column(String(50), nullable=True, index=True)",
+        'Column("id", String(50))',
+        'Column(Integer, ForeignKey("user.id"))',
+        "Column(Integer, default=1, *extra)",
+        "Column(**kwargs)",
+        "Column()",
+        "Other(Integer)",
+    ]
+    for challenge in challenges:
+        node = cst.parse_expression(challenge)
+        column = classify_column_call(node)
+        if m.matches(node, column_call_with_name_and_type):
+            assert (
+                column.name_arg is node.args[0] and column.type_arg is node.args[1]
+            ), challenge
+        elif m.matches(node, column_call_with_type):
+            assert (
+                column.name_arg is None and column.type_arg is node.args[0]
+            ), challenge
+        else:
+            assert column is None, challenge
+
+
+def test_classify_column_call_kwargs():
+    node = cst.parse_expression(
+        "Column(Integer, nullable=False, primary_key=True, index=True)"
+    )
+    column = classify_column_call(node)
+    assert column.nullable_arg is node.args[1]
+    assert column.primary_key
+    assert len(column.other_args) == 3
+
+
 def test_resolve_py_type_and_is_optional_for_int_pk():
     node = cst.parse_expression("Column(Integer, primary_key=True)")
     explicit_column_name_arg, column_type_arg, other_args = process_column_call(node)
@@ -104,6 +172,7 @@ def test_resolve_py_type_and_is_optional_for_int():
     assert py_type == "int"
     assert is_optional
 
+
 def test_resolve_py_type_and_is_optional_for_int_nullable():
     node = cst.parse_expression("Column(Integer, nullable=True)")
     explicit_column_name_arg, column_type_arg, other_args = process_column_call(node)
@@ -111,6 +180,7 @@ def test_resolve_py_type_and_is_optional_for_int_nullable():
     assert py_type == "int"
     assert is_optional
 
+
 def test_resolve_py_type_and_is_optional_for_int_nonnullable():
     node = cst.parse_expression("Column(Integer, nullable=False)")
     explicit_column_name_arg, column_type_arg, other_args = process_column_call(node)
@@ -136,15 +206,58 @@ def test_resolve_py_type_and_is_optional_for_some_custom_type():
     assert is_optional is None
 
 
+def test_resolve_py_type_and_is_optional_uses_given_type_arg():
+    node = cst.parse_expression("Column(Integer)")
+    py_type, is_optional = resolve_py_type_and_is_optional(
+        node, cst.Arg(value=cst.Name("String"))
+    )
+    assert py_type == "str"
+    assert is_optional
+
+
+def test_attempt_to_build_annotation_is_memoised():
+    annotation = attempt_to_build_annotation("datetime.datetime", True)
+    assert (
+        cst.Module(body=[]).code_for_node(annotation.annotation)
+        == "Mapped[Optional[datetime.datetime]]"
+    )
+    assert attempt_to_build_annotation("datetime.datetime", True) is annotation
+    other = attempt_to_build_annotation("datetime.datetime", False)
+    assert other is not annotation
+    assert (
+        cst.Module(body=[]).code_for_node(other.annotation)
+        == "Mapped[datetime.datetime]"
+    )
+    assert attempt_to_build_annotation(None, None) is None
+
+
 def test_replacement_assignment():
     challenges = [
-        ("id = Column(Integer, primary_key=True)", "id: Mapped[int] = mapped_column(primary_key=True)"),
-        ("name = Column(String(50), nullable=False)", "name: Mapped[str] = mapped_column(String(50))"),
-        ("fullname = Column(String)", "fullname: Mapped[Optional[str]] = mapped_column(String)"),
-        ("nickname = Column(String(30))", "nickname: Mapped[Optional[str]] = mapped_column(String(30))"),
+        (
+            "id = Column(Integer, primary_key=True)",
+            "id: Mapped[int] = mapped_column(primary_key=True)",
+        ),
+        (
+            "name = Column(String(50), nullable=False)",
+            "name: Mapped[str] = mapped_column(String(50))",
+        ),
+        (
+            "fullname = Column(String)",
+            "fullname: Mapped[Optional[str]] = mapped_column(String)",
+        ),
+        (
+            "nickname = Column(String(30))",
+            "nickname: Mapped[Optional[str]] = mapped_column(String(30))",
+        ),
         ("data = Column(JSONB)", "data = mapped_column(JSONB)"),
-        ("data = Column(JSONB, nullable=True)", "data = mapped_column(JSONB, nullable=True)"),
-        ("cost = Column(Numeric(4,2), nullable=False)", "cost: Mapped[decimal.Decimal] = mapped_column(Numeric(4,2))"),
+        (
+            "data = Column(JSONB, nullable=True)",
+            "data = mapped_column(JSONB, nullable=True)",
+        ),
+        (
+            "cost = Column(Numeric(4,2), nullable=False)",
+            "cost: Mapped[decimal.Decimal] = mapped_column(Numeric(4,2))",
+        ),
     ]
     for before, after in challenges:
         node = cst.parse_statement(before).body[0]
@@ -154,8 +267,87 @@ def test_replacement_assignment():
         assert new_module.code.strip() == after
 
 
+def test_replacement_assignment_error_shows_code():
+    node = cst.parse_statement("data = Column(nullable=False)").body[0]
+    with pytest.raises(ValueError) as e:
+        replacement_assignment(node)
+    assert str(e.value) == "Don't understand column definition Column(nullable=False)"
+
+
+def test_imports_requested_once_per_module():
+    code = "class Log(Base):\n" + "".join(
+        f"    at_{i} = Column(DateTime)\n" for i in range(300)
+    )
+    command = ColumnToMappedCommand(CodemodContext())
+    Codemod.transform_module(command, cst.parse_module(code))
+    requested = command.context.scratch[AddImportsVisitor.CONTEXT_KEY]
+    assert len(requested) == 4
+
+
+unsupported_column = """
+class User(Base):
+    id = Column(Integer, primary_key=True)
+    name = Column("name", sa.String(50))
+    email = Column(String)
+"""
+
+
+def test_unsupported_column_fails_with_position():
+    command = ColumnToMappedCommand(CodemodContext(filename="models.py"))
+    with pytest.raises(UnsupportedConstructError) as e:
+        command.transform_module(cst.parse_module(unsupported_column))
+    assert str(e.value) == (
+        "models.py:4:5: ColumnToMappedCommand: Don't understand column definition"
+    )
+
+
+def test_unsupported_column_recorded_when_continuing_on_error():
+    context = CodemodContext(filename="models.py")
+    command = ColumnToMappedCommand(context, continue_on_error=True)
+    code = command.transform_module(cst.parse_module(unsupported_column)).code
+    assert 'name = Column("name", sa.String(50))' in code
+    assert "email: Mapped[Optional[str]] = mapped_column(String)" in code
+    assert recorded_failures(command.context) == [
+        CodemodFailure(
+            "models.py",
+            4,
+            5,
+            "ColumnToMappedCommand",
+            "Don't understand column definition",
+        )
+    ]
+
+
 class TestColumnToMappedCommand(CodemodTest):
     TRANSFORM = ColumnToMappedCommand
 
     def test_mixed_example(self):
         self.assertCodemod(before, after)
+
+    def test_extended_types(self):
+        before = """
+class Event(Base):
+    __tablename__ = "event"
+
+    id = Column(sa.BigInteger, primary_key=True)
+    at = Column(sa.Time, nullable=False)
+    status = Column(Enum(Status), nullable=False)
+    tags = Column(ARRAY(Date))
+    money = Column(Money, nullable=False)
+"""
+        after = """
+import datetime
+import decimal
+from sqlalchemy.orm import Mapped, mapped_column
+from typing import Optional
+
+class Event(Base):
+    __tablename__ = "event"
+
+    id: Mapped[int] = mapped_column(sa.BigInteger, primary_key=True)
+    at: Mapped[datetime.time] = mapped_column()
+    status: Mapped[Status] = mapped_column(Enum(Status))
+    tags: Mapped[Optional[list[datetime.date]]] = mapped_column(ARRAY(Date))
+    money: Mapped[decimal.Decimal] = mapped_column(Money)
+"""
+        self.assertCodemod(before, after, sa_types=["Money=decimal.Decimal"])
@@ -0,0 +1,166 @@
+import json
+
+import libcst as cst
+from libcst.codemod import CodemodContext, CodemodTest
+
+from codemods.combined import CombinedCodemodCommand
+from codemods.runner import main
+from codemods.sa_eager_load import (
+    EagerLoadRelationshipsCommand,
+    after,
+    before,
+    parse_query_site,
+)
+from codemods.sa_common import relationship_attributes
+
+models = """
+class User(Base):
+    __tablename__ = "users"
+    orders = relationship("Order")
+    address: Mapped["Address"] = db.relationship()
+    name = Column(String)
+
+
+class Admin(User):
+    ...
+"""
+
+
+def test_relationship_attributes():
+    module = cst.parse_module(models)
+    assert relationship_attributes(module.body[0]) == ["orders", "address"]
+    assert relationship_attributes(module.body[1]) == []
+
+
+def test_parse_query_site():
+    sessions = frozenset({"session"})
+    site = parse_query_site(
+        cst.parse_expression(
+            "session.query(User).options(joinedload(User.orders)).filter(x).all()"
+        ),
+        sessions,
+    )
+    assert site.style == "query"
+    assert site.target.value == "User"
+    assert site.loaded == {"orders"}
+    site = parse_query_site(
+        cst.parse_expression("self.session.scalars(select(User).where(x))"), sessions
+    )
+    assert site.style == "select"
+    assert site.root.func.value == "select"
+    for code in ("session.query(User).first()", "api.scalars(select(User))"):
+        assert parse_query_site(cst.parse_expression(code), sessions) is None
+
+
+def test_analysis_reports_sites():
+    code = (
+        models
+        + """
+
+def report(session):
+    for user in session.query(Admin).all():
+        print(user.orders, user.address, user.name)
+
+
+def loaded(session):
+    users = session.query(User).options(selectinload(User.orders)).all()
+    return [user.orders for user in users]
+
+
+def unrelated(session):
+    users = session.query(User).all()
+    return [user.name for user in users]
+"""
+    )
+    command = CombinedCodemodCommand(
+        CodemodContext(filename="models.py"),
+        codemods=["eager_load"],
+        model_detection="either",
+    )
+    assert command.should_transform(code)
+    analysis = command.analyze_module(cst.parse_module(code))
+    assert analysis["eager_load"] == {
+        "n_plus_one_sites": 1,
+        "lazy_loaded_relationships": 2,
+    }
+    assert command.records["eager_load"] == [
+        {
+            "filename": "models.py",
+            "line": 14,
+            "loop_line": 14,
+            "model": "Admin",
+            "relationships": ["orders", "address"],
+            "style": "query",
+        }
+    ]
+
+
+def test_main_writes_report(tmp_path, capsys):
+    path = tmp_path / "models.py"
+    path.write_text(before)
+    report = tmp_path / "report.csv"
+    status = main(
+        [str(path), "--analyze", "--codemods", "eager_load", "--report", str(report)]
+    )
+    assert status == 0
+    assert json.loads(capsys.readouterr().out)["codemods"]["eager_load"] == {
+        "n_plus_one_sites": 1,
+        "lazy_loaded_relationships": 1,
+    }
+    assert report.read_text().splitlines() == [
+        "codemod,filename,line,loop_line,model,relationships,style",
+        f"eager_load,{path},8,9,User,orders,query",
+    ]
+
+
+class TestEagerLoadRelationshipsCommand(CodemodTest):
+    TRANSFORM = EagerLoadRelationshipsCommand
+
+    def test_module_example(self):
+        self.assertCodemod(before, after)
+
+    def test_loops_and_select(self):
+        before = (
+            models
+            + """
+
+    @classmethod
+    def with_orders(cls, session):
+        return [u.orders for u in session.scalars(select(cls).where(cls.active))]
+
+
+def addresses(session):
+    users = session.scalars(select(User)).all()
+    for user in users:
+        print(user.address.city, user.orders)
+"""
+        )
+        after = (
+            "\nfrom sqlalchemy.orm import selectinload\n"
+            + models
+            + """
+
+    @classmethod
+    def with_orders(cls, session):
+        return [u.orders for u in session.scalars(select(cls).options(selectinload(cls.orders)).where(cls.active))]
+
+
+def addresses(session):
+    users = session.scalars(select(User).options(selectinload(User.orders), selectinload(User.address))).all()
+    for user in users:
+        print(user.address.city, user.orders)
+"""
+        )
+        self.assertCodemod(before, after, model_detection="either")
+
+    def test_not_a_model(self):
+        before = """
+class Report:
+    sections = relationship("Section")
+
+
+def render(session):
+    for report in session.query(Report).all():
+        print(report.sections)
+"""
+        self.assertCodemod(before, before)
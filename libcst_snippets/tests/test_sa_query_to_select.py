@@ -0,0 +1,182 @@
+import libcst as cst
+from libcst.codemod import CodemodContext, CodemodTest
+
+from codemods.sa_query_to_select import (
+    QueryToSelectCommand,
+    after,
+    before,
+    parse_query_chain,
+)
+
+
+def parse_chain(code, session_names=("session",)):
+    return parse_query_chain(cst.parse_expression(code), frozenset(session_names))
+
+
+def test_parse_query_chain():
+    chain = parse_chain("self.session.query(User).filter(a).order_by(b).one()")
+    assert chain is not None
+    assert chain.target.value == "User"
+    assert [step.func.attr.value for step in chain.steps] == ["filter", "order_by"]
+    assert chain.terminal == "one"
+
+
+def test_parse_query_chain_rejects():
+    # Not a session
+    assert parse_chain("requests.query(User).all()") is None
+    # Several entities
+    assert parse_chain("session.query(User, Address).all()") is None
+    # Unsupported method in the chain
+    assert parse_chain("session.query(User).group_by(x).all()") is None
+    # Not a terminal method
+    assert parse_chain("session.query(User).count()") is None
+    assert parse_chain("db.query(User).all()", session_names=("db",)) is not None
+
+
+def test_needs_unique():
+    assert not parse_chain("session.query(User).filter(a).all()").needs_unique
+    assert parse_chain("session.query(User).options(x).all()").needs_unique
+    assert parse_chain("session.query(User).join(Address).first()").needs_unique
+
+
+def test_should_transform_prescreen():
+    command = QueryToSelectCommand(CodemodContext())
+    assert command.should_transform(before)
+    assert not command.should_transform(after)
+
+
+class TestQueryToSelectCommand(CodemodTest):
+    TRANSFORM = QueryToSelectCommand
+
+    def test_module_example(self):
+        self.assertCodemod(before, after)
+
+    def test_model_classes_and_chains(self):
+        before = """
+class User(Base):
+    __tablename__ = "users"
+
+
+class Report:
+    ...
+
+
+def active_users(session):
+    return (
+        session.query(User)
+        .filter(User.active, User.verified)
+        .order_by(User.name)
+        .all()
+    )
+
+
+def one_user(db, name):
+    return db.session.query(User).filter_by(name=name).one()
+
+
+def reports(session):
+    return session.query(Report).all()
+"""
+        after = """
+from sqlalchemy import select
+
+class User(Base):
+    __tablename__ = "users"
+
+
+class Report:
+    ...
+
+
+def active_users(session):
+    return (
+        session.scalars(select(User).where(User.active, User.verified).order_by(User.name))
+        .all()
+    )
+
+
+def one_user(db, name):
+    return db.session.scalars(select(User).filter_by(name=name)).one()
+
+
+def reports(session):
+    return session.query(Report).all()
+"""
+        self.assertCodemod(before, after)
+
+    def test_cls_outside_model_unchanged(self):
+        before = """
+class Repository:
+    @classmethod
+    def everything(cls, session):
+        return session.query(cls).all()
+"""
+        self.assertCodemod(before, before)
+
+    def test_model_detection_by_bases(self):
+        before = """
+from sqlalchemy.orm import declarative_base
+
+Base = declarative_base()
+
+
+class User(Base):
+    ...
+
+
+def admins(session):
+    return session.query(User).filter(User.admin).first()
+"""
+        after = """
+from sqlalchemy.orm import declarative_base
+from sqlalchemy import select
+
+Base = declarative_base()
+
+
+class User(Base):
+    ...
+
+
+def admins(session):
+    return session.scalars(select(User).where(User.admin).limit(1)).first()
+"""
+        self.assertCodemod(before, before)
+        self.assertCodemod(before, after, model_detection="bases")
+
+    def test_options_and_joins_are_unique(self):
+        before = """
+class User(Base):
+    __tablename__ = "users"
+
+
+def with_addresses(session):
+    return session.query(User).options(joinedload(User.addresses)).all()
+
+
+def with_orders(session):
+    return session.query(User).join(User.orders).filter(Order.open).one()
+
+
+def outer(session):
+    return session.query(User).outerjoin(User.orders).first()
+"""
+        after = """
+from sqlalchemy import select
+
+class User(Base):
+    __tablename__ = "users"
+
+
+def with_addresses(session):
+    return session.scalars(select(User).options(joinedload(User.addresses))).unique().all()
+
+
+def with_orders(session):
+    return session.scalars(select(User).join(User.orders).where(Order.open)).unique().one()
+
+
+def outer(session):
+    return session.scalars(select(User).outerjoin(User.orders).limit(1)).unique().first()
+"""
+        self.assertCodemod(before, after)
@@ -0,0 +1,68 @@
+import json
+
+import libcst as cst
+import pytest
+
+from codemods.sa_types import SAType, SATypeRegistry, parse_sa_type_option
+
+
+def resolve(registry, code):
+    return registry.resolve(cst.parse_expression(code))
+
+
+def test_resolve_dotted_and_parameterised_types():
+    registry = SATypeRegistry()
+    challenges = [
+        ("Integer", "int"),
+        ("sa.BigInteger", "int"),
+        ("sqlalchemy.types.DateTime", "datetime.datetime"),
+        ("db.String(40)", "str"),
+        ("Enum(Status)", "Status"),
+        ("Enum(models.Status, name='status')", "models.Status"),
+        ('Enum("a", "b")', None),
+        ("ARRAY(Date)", "list[datetime.date]"),
+        ("ARRAY(Bucket)", None),
+        ("other.Integer", None),
+        ("Bucket", None),
+    ]
+    for code, expected in challenges:
+        assert resolve(registry, code) == expected, code
+
+
+def test_imports_for_resolved_types():
+    registry = SATypeRegistry()
+    assert registry.imports_for(resolve(registry, "ARRAY(Date)")) == {"datetime"}
+    assert registry.imports_for(resolve(registry, "Enum(models.Status)")) == set()
+    assert registry.imports_for(resolve(registry, "JSON")) == {"typing"}
+
+
+def test_is_inferable():
+    registry = SATypeRegistry()
+    assert registry.is_inferable(cst.parse_expression("sa.Integer()"))
+    assert not registry.is_inferable(cst.parse_expression("Numeric(4, 2)"))
+    assert not registry.is_inferable(cst.parse_expression("BigInteger"))
+
+
+def test_from_options(tmp_path):
+    types_file = tmp_path / "types.json"
+    types_file.write_text(
+        json.dumps(
+            {"Money": "decimal.Decimal", "Flag": {"py_type": "bool", "inferable": True}}
+        )
+    )
+    registry = SATypeRegistry.from_options(
+        str(types_file), ["Bucket=!str", "Integer=int"], ["sqltypes"]
+    )
+    assert resolve(registry, "sqltypes.Money") == "decimal.Decimal"
+    assert registry.is_inferable(cst.parse_expression("Flag"))
+    assert registry.is_inferable(cst.parse_expression("Bucket"))
+    assert resolve(registry, "Bucket") == "str"
+    assert registry.fingerprint() != SATypeRegistry().fingerprint()
+
+
+def test_parse_sa_type_option_errors():
+    assert parse_sa_type_option("BigInteger=int") == ("BigInteger", SAType("int"))
+    with pytest.raises(ValueError):
+        parse_sa_type_option("BigInteger")
+    with pytest.raises(ValueError):
+        SATypeRegistry({"Odd": SAType("{foo}")})
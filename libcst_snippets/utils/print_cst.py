@@ -1,15 +1,248 @@
 import argparse
+import dataclasses
+from typing import Dict, Iterator, Optional, Sequence, Tuple, Type
+
 import libcst as cst
-from libcst.display import dump
+from libcst.helpers import (
+    get_field_default_value,
+    is_syntax_node_field,
+    is_whitespace_node_field,
+)
+from libcst.metadata import MetadataWrapper, PositionProvider
+
+DEFAULT_INDENT = "    "
+
+_MISSING = object()
+
+
+def _equals_default(value: object, default: object) -> bool:
+    if isinstance(value, cst.CSTNode):
+        return isinstance(default, cst.CSTNode) and value.deep_equals(default)
+    if isinstance(value, Sequence) and not isinstance(value, (str, bytes)):
+        return (
+            isinstance(default, Sequence)
+            and len(value) == len(default)
+            and all(map(_equals_default, value, default))
+        )
+    return value == default
+
+
+class CSTDumper:
+    """
+    Dumps nodes in the same format as libcst.display.dump(), but streams the output in pieces
+    instead of building and re-indenting strings at every level, and can stop at a
+    maximum depth. Which fields each node class shows is worked out once per class.
+    """
+
+    def __init__(
+        self,
+        indent: str = DEFAULT_INDENT,
+        max_depth: Optional[int] = None,
+        show_defaults: bool = False,
+        show_syntax: bool = False,
+        show_whitespace: bool = False,
+    ) -> None:
+        self.indent = indent
+        self.max_depth = max_depth
+        self.show_defaults = show_defaults
+        self.show_syntax = show_syntax
+        self.show_whitespace = show_whitespace
+        # Fields to show for each node class, with their default values if fields
+        # equal to their default are hidden
+        self._fields: Dict[type, Tuple[Tuple[str, object], ...]] = {}
+
+    def _fields_for(self, node: cst.CSTNode) -> Tuple[Tuple[str, object], ...]:
+        # Which fields are whitespace or syntax only depends on the node's class
+        fields = self._fields.get(type(node))
+        if fields is None:
+            shown = []
+            for field in dataclasses.fields(node):
+                if field.name.startswith("_"):
+                    continue
+                if not self.show_whitespace and is_whitespace_node_field(node, field):
+                    continue
+                if not self.show_syntax and is_syntax_node_field(node, field):
+                    continue
+                default = _MISSING
+                if not self.show_defaults:
+                    default = get_field_default_value(field)
+                shown.append((field.name, default))
+            fields = self._fields[type(node)] = tuple(shown)
+        return fields
+
+    def dump(self, node: object, prefix: str = "", depth: int = 0) -> Iterator[str]:
+        """
+        Dump a node (or any other value) in pieces. The first piece continues the
+        current line, and following lines start with prefix.
+        :param node: The node
+        :param prefix: Indentation of the line the node starts on
+        :param depth: Depth of the node below the dumped root
+        :return: An iterator of pieces of the output
+        """
+        if not isinstance(node, cst.CSTNode):
+            yield repr(node)
+            return
+
+        name = type(node).__name__
+        if self.max_depth is not None and depth >= self.max_depth:
+            yield f"{name}(...)"
+            return
+        fields = []
+        for field_name, default in self._fields_for(node):
+            value = getattr(node, field_name)
+            if default is not _MISSING and (
+                value is default or _equals_default(value, default)
+            ):
+                continue
+            fields.append((field_name, value))
+        if not fields:
+            yield f"{name}()"
+            return
+
+        yield f"{name}(\n"
+        field_prefix = prefix + self.indent
+        for field_name, value in fields:
+            yield f"{field_prefix}{field_name}="
+            if isinstance(value, Sequence) and not isinstance(value, (str, bytes)):
+                if value:
+                    item_prefix = field_prefix + self.indent
+                    yield "[\n"
+                    for item in value:
+                        yield item_prefix
+                        yield from self.dump(item, item_prefix, depth + 1)
+                        yield ",\n"
+                    yield f"{field_prefix}]"
+                else:
+                    yield "[]"
+            else:
+                yield from self.dump(value, field_prefix, depth + 1)
+            yield ",\n"
+        yield f"{prefix})"
+
+
+def parse_line_range(value: str) -> Tuple[int, int]:
+    """
+    Parse a line range like 10-20, or a single line like 10.
+    """
+    first, _, last = value.partition("-")
+    try:
+        line_range = int(first), int(last or first)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected START-END, got {value!r}")
+    if line_range[0] > line_range[1]:
+        raise argparse.ArgumentTypeError(f"Empty line range {value!r}")
+    return line_range
+
+
+def parse_node_type(value: str) -> Type[cst.CSTNode]:
+    """
+    Look up a LibCST node class by name, e.g. Call.
+    """
+    node_type = getattr(cst, value, None)
+    if not isinstance(node_type, type) or not issubclass(node_type, cst.CSTNode):
+        raise argparse.ArgumentTypeError(f"Not a LibCST node type: {value!r}")
+    return node_type
+
+
+def select_nodes(
+    module: cst.Module,
+    node_types: Sequence[Type[cst.CSTNode]] = (),
+    line_range: Optional[Tuple[int, int]] = None,
+) -> Iterator[Tuple[cst.CSTNode, Optional[int]]]:
+    """
+    Find the outermost nodes of the given types that overlap the line range or, with no
+    types, the outermost nodes entirely within the line range.
+    :param module: The parsed module
+    :param node_types: Node classes to select
+    :param line_range: Inclusive first and last lines
+    :return: An iterator of the nodes and the lines they start on, if known
+    """
+    positions = None
+    if line_range is not None:
+        positions = MetadataWrapper(module, unsafe_skip_copy=True).resolve(
+            PositionProvider
+        )
+    types = tuple(node_types)
+
+    def visit(node: cst.CSTNode) -> Iterator[Tuple[cst.CSTNode, Optional[int]]]:
+        position = positions.get(node) if positions is not None else None
+        if position is not None:
+            first, last = line_range
+            if position.end.line < first or position.start.line > last:
+                return
+            inside = first <= position.start.line and position.end.line <= last
+        else:
+            inside = positions is None
+        selected = isinstance(node, types) if types else inside
+        if selected:
+            yield node, position.start.line if position is not None else None
+            return
+        for child in node.children:
+            yield from visit(child)
+
+    if not types and line_range is None:
+        yield module, None
+    else:
+        yield from visit(module)
 
 
-argparser = argparse.ArgumentParser()
-argparser.add_argument("INPUT", type=argparse.FileType("r"), default="-")
+argparser = argparse.ArgumentParser(
+    description="Print the CST of a Python file, for use when writing matchers."
+)
+argparser.add_argument("INPUT", type=argparse.FileType("r"), nargs="?", default="-")
 argparser.add_argument("-o", "--output", type=argparse.FileType("w"), default="-")
+argparser.add_argument(
+    "-d",
+    "--max-depth",
+    type=int,
+    default=None,
+    help="Show nodes deeper than this as Name(...).",
+)
+argparser.add_argument(
+    "-t",
+    "--type",
+    dest="node_types",
+    type=parse_node_type,
+    action="append",
+    default=[],
+    help="Only print nodes of this type, e.g. Call. Can be given more than once.",
+)
+argparser.add_argument(
+    "-l",
+    "--lines",
+    type=parse_line_range,
+    default=None,
+    metavar="START-END",
+    help="Only print nodes within these lines (or, with --type, overlapping them).",
+)
+argparser.add_argument(
+    "--show-whitespace", action="store_true", help="Include whitespace fields."
+)
+argparser.add_argument(
+    "--show-defaults",
+    action="store_true",
+    help="Include fields that have their default value.",
+)
+argparser.add_argument(
+    "--show-syntax",
+    action="store_true",
+    help="Include syntax fields like commas and optional tokens.",
+)
 
 
 if __name__ == "__main__":
     args = argparser.parse_args()
     module_cst = cst.parse_module(args.INPUT.read())
-    dumped_tree = dump(module_cst)
-    args.output.write(dumped_tree)
+    dumper = CSTDumper(
+        max_depth=args.max_depth,
+        show_defaults=args.show_defaults,
+        show_syntax=args.show_syntax,
+        show_whitespace=args.show_whitespace,
+    )
+    filtering = bool(args.node_types) or args.lines is not None
+    for node, line in select_nodes(module_cst, args.node_types, args.lines):
+        if filtering and line is not None:
+            args.output.write(f"# line {line}\n")
+        args.output.writelines(dumper.dump(node))
+        if filtering:
+            args.output.write("\n")